@@ -0,0 +1,90 @@
+""" Benchmark materialization of search hits with date fields.
+
+Builds hits of a document class with several ``DateTimeField`` and
+``TimeField`` fields, with values in the format ``JSONSerializer``
+writes, and materializes them with ``from_es`` the way search results
+are. Reports time with the fast ISO parsing path and with ``dateutil``
+parsing every value.
+
+Run with::
+
+    python benchmarks/bench_dates.py [number of hits] [rounds]
+
+from repository root with nefertari_es installed or on PYTHONPATH.
+"""
+import datetime
+import sys
+import timeit
+
+from dateutil import parser
+
+from nefertari_es import documents, fields
+from nefertari_es.serializers import JSONSerializer
+
+
+class DatesBenchItem(documents.BaseDocument):
+    id = fields.IdField()
+    name = fields.StringField()
+    created_at = fields.DateTimeField()
+    updated_at = fields.DateTimeField()
+    published_at = fields.DateTimeField()
+    expires_at = fields.DateTimeField()
+    opens_at = fields.TimeField()
+    closes_at = fields.TimeField()
+
+
+def make_hits(count):
+    serializer = JSONSerializer(codec='json')
+    now = datetime.datetime(2015, 6, 1, 12, 30, 15)
+    hits = []
+    for idx in range(count):
+        source = {
+            'id': str(idx),
+            'name': 'Document number {}'.format(idx),
+            'created_at': now,
+            'updated_at': now + datetime.timedelta(minutes=idx),
+            'published_at': now + datetime.timedelta(hours=idx),
+            'expires_at': now + datetime.timedelta(days=idx % 365),
+            'opens_at': datetime.time(9, idx % 60),
+            'closes_at': datetime.time(18, idx % 60, idx % 60),
+        }
+        hits.append({
+            '_index': 'benchmark', '_type': 'DatesBenchItem',
+            '_id': str(idx), '_score': 1.0,
+            '_source': serializer.loads(serializer.dumps(source)),
+        })
+    return hits
+
+
+def materialize(hits):
+    return [DatesBenchItem.from_es(hit) for hit in hits]
+
+
+def main(count=10000, rounds=3):
+    hits = make_hits(count)
+    item = materialize(hits[:1])[0]
+    assert isinstance(item.created_at, datetime.datetime)
+    assert isinstance(item.opens_at, datetime.time)
+
+    fast = min(timeit.repeat(
+        lambda: materialize(hits), number=1, repeat=rounds))
+
+    parse_datetime, parse_time = fields._parse_datetime, fields._parse_time
+    fields._parse_datetime = parser.parse
+    fields._parse_time = lambda data: parser.parse(data).time()
+    try:
+        slow = min(timeit.repeat(
+            lambda: materialize(hits), number=1, repeat=rounds))
+    finally:
+        fields._parse_datetime = parse_datetime
+        fields._parse_time = parse_time
+
+    print('Materialized {} hits with 6 date fields, best of {} rounds'.format(
+        count, rounds))
+    print('fast path: {:.3f}s, dateutil: {:.3f}s, {:.1f}x'.format(
+        fast, slow, slow / fast))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,102 @@
+""" Benchmark JSON codecs of ``JSONSerializer`` on bulk payloads.
+
+Builds bulk actions the way ``BaseDocument._update_many`` and ``_bulk``
+do, serializes them the way ``elasticsearch.helpers.bulk`` does (one
+``dumps`` call per action line and per source line) and parses a bulk
+response and a search response of matching size.
+
+Run with::
+
+    python benchmarks/bench_serializers.py [number of documents]
+
+from repository root with nefertari_es installed or on PYTHONPATH.
+"""
+import datetime
+import decimal
+import json
+import sys
+import timeit
+
+from elasticsearch.helpers import expand_action
+
+from nefertari_es.serializers import CODECS, JSONSerializer
+
+
+def make_source(idx):
+    now = datetime.datetime(2015, 6, 1, 12, 30, 15)
+    return {
+        'id': str(idx),
+        'name': 'Document number {}'.format(idx),
+        'description': 'Lorem ipsum dolor sit amet ' * 10,
+        'price': decimal.Decimal('{}.99'.format(idx % 1000)),
+        'quantity': idx % 50,
+        'active': idx % 2 == 0,
+        'created_at': now,
+        'updated_at': now + datetime.timedelta(minutes=idx),
+        'birth_date': now.date(),
+        'open_time': datetime.time(9, 30),
+        'duration': datetime.timedelta(seconds=idx),
+        'tags': ['tag{}'.format(t) for t in range(idx % 10)],
+        'settings': {'color': 'red', 'size': idx % 5, 'enabled': True},
+        'version': 1,
+    }
+
+
+def make_actions(count):
+    return [{
+        '_op_type': 'index',
+        '_index': 'benchmark',
+        '_type': 'Item',
+        '_id': str(idx),
+        '_source': make_source(idx),
+    } for idx in range(count)]
+
+
+def dump_bulk(serializer, actions):
+    lines = []
+    for action in actions:
+        action_line, data = expand_action(action)
+        lines.append(serializer.dumps(action_line))
+        if data is not None:
+            lines.append(serializer.dumps(data))
+    return '\n'.join(lines) + '\n'
+
+
+def make_responses(serializer, actions):
+    bulk = {'took': 30, 'errors': False, 'items': [
+        {'index': {'_index': 'benchmark', '_type': 'Item',
+                   '_id': a['_id'], '_version': 1, 'status': 201}}
+        for a in actions]}
+    search = {'took': 12, 'timed_out': False, 'hits': {
+        'total': len(actions), 'max_score': 1.0, 'hits': [
+            {'_index': 'benchmark', '_type': 'Item', '_id': a['_id'],
+             '_score': 1.0, '_source': a['_source']}
+            for a in actions]}}
+    return json.dumps(bulk), serializer.dumps(search)
+
+
+def main(count=5000, repeat=5):
+    actions = make_actions(count)
+    print('{} documents, best of {} runs'.format(count, repeat))
+    for codec_cls in CODECS:
+        try:
+            serializer = JSONSerializer(codec=codec_cls.name)
+        except ImportError:
+            print('{:>8}: not installed'.format(codec_cls.name))
+            continue
+        bulk_resp, search_resp = make_responses(serializer, actions)
+        dumps_time = min(timeit.repeat(
+            lambda: dump_bulk(serializer, actions),
+            number=1, repeat=repeat))
+        bulk_time = min(timeit.repeat(
+            lambda: serializer.loads(bulk_resp), number=1, repeat=repeat))
+        search_time = min(timeit.repeat(
+            lambda: serializer.loads(search_resp),
+            number=1, repeat=repeat))
+        print('{:>8}: bulk dumps {:.4f}s, bulk response loads {:.4f}s, '
+              'search response loads {:.4f}s'.format(
+                  codec_cls.name, dumps_time, bulk_time, search_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
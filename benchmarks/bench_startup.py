@@ -0,0 +1,75 @@
+""" Benchmark definition of a large schema of document classes.
+
+Defines a synthetic schema the way models module of a big project
+would: document classes with a dozen fields each, some inheriting
+fields from plain mixins, linked by relationships with backrefs which
+reference both earlier and later defined classes. Reports time it
+takes to define all classes.
+
+Run with::
+
+    python benchmarks/bench_startup.py [number of models] [rounds]
+
+from repository root with nefertari_es installed or on PYTHONPATH.
+"""
+import sys
+import time
+
+from nefertari_es import documents, fields, meta
+
+
+class TimestampsMixin(object):
+    created_at = fields.DateTimeField()
+    updated_at = fields.DateTimeField()
+
+
+def define_schema(count, prefix):
+    """ Define :count: document classes named "<prefix><number>". """
+    classes = []
+    for idx in range(count):
+        name = '{}{}'.format(prefix, idx)
+        attrs = {
+            'id': fields.IdField(),
+            'name': fields.StringField(required=True),
+            'description': fields.TextField(),
+            'slug': fields.StringField(index='not_analyzed'),
+            'price': fields.FloatField(),
+            'quantity': fields.IntegerField(),
+            'active': fields.BooleanField(),
+            'settings': fields.DictField(),
+            'tags': fields.ListField(),
+            'published': fields.DateField(),
+        }
+        # Relationship to previous class and to class defined later
+        if idx:
+            attrs['parent'] = fields.Relationship(
+                document='{}{}'.format(prefix, idx - 1), uselist=False,
+                backref_name='children_{}'.format(idx))
+        attrs['next'] = fields.Relationship(
+            document='{}{}'.format(prefix, (idx + 1) % count),
+            uselist=True, backref_name='previous_{}'.format(idx))
+        bases = (documents.BaseDocument,)
+        if idx % 2:
+            bases = (TimestampsMixin,) + bases
+        classes.append(type(name, bases, attrs))
+    return classes
+
+
+def main(count=500, rounds=3):
+    results = []
+    for round_ in range(rounds):
+        prefix = 'BenchModel{}x'.format(round_)
+        start = time.time()
+        define_schema(count, prefix)
+        results.append(time.time() - start)
+        for name in list(meta._document_registry):
+            if name.startswith(prefix):
+                del meta._document_registry[name]
+    best = min(results)
+    print('Defined {} models: best {:.3f}s, {:.2f}ms per model '
+          '({} rounds)'.format(count, best, best * 1000 / count, rounds))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
@@ -1,5 +1,15 @@
 from __future__ import absolute_import
 
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
 from elasticsearch_dsl.connections import connections as es_connections
 from nefertari.utils import (
     dictset,
@@ -8,10 +18,23 @@ from nefertari.utils import (
 from .documents import BaseDocument
 from .serializers import JSONSerializer
 from .connections import ESHttpConnection
+from .transport import ESTransport, HedgingTransport, LatencyAwareSelector
+from .indices import (
+    create_versioned_index,
+    partition_pattern,
+    put_partition_template,
+    update_index_settings,
+    update_mappings,
+)
+from . import instrumentation
 from .meta import (
     get_document_cls,
     get_document_classes,
     create_index,
+    defer_index_setup,
+    get_index_groups,
+    get_index_settings,
+    get_unresolved_backrefs,
 )
 from .fields import (
     IdField,
@@ -26,6 +49,7 @@ from .fields import (
     TextField,
     UnicodeField,
     UnicodeTextField,
+    KeywordField,
     BigIntegerField,
     BooleanField,
     FloatField,
@@ -55,6 +79,7 @@ __all__ = [
     'TextField',
     'UnicodeField',
     'UnicodeTextField',
+    'KeywordField',
     'BigIntegerField',
     'BooleanField',
     'FloatField',
@@ -75,25 +100,52 @@ __all__ = [
 ]
 
 
+log = logging.getLogger(__name__)
+
 Settings = dictset()
 
+# Maps names of startup phases to their duration in seconds
+_startup_timings = OrderedDict()
+
+
+@contextmanager
+def _timed(phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        _startup_timings[phase] = (
+            _startup_timings.get(phase, 0.0) + time.time() - start)
+
+
+def get_startup_timings():
+    """ Get durations of ``setup_database`` phases in seconds. """
+    return _startup_timings.copy()
+
 
 def includeme(config):
     pass
 
 
 def setup_database(config):
+    _startup_timings.clear()
+    start = time.time()
     settings = dictset(config.registry.settings).mget('elasticsearch')
     Settings.update(settings)
     params = {}
     params['chunk_size'] = settings.get('chunk_size', 500)
-    params['hosts'] = []
-    for hp in split_strip(settings['hosts']):
-        h, p = split_strip(hp, ':')
-        params['hosts'].append(dict(host=h, port=p))
+    params['hosts'] = parse_hosts(settings['hosts'])
     if settings.asbool('sniff'):
         params['sniff_on_start'] = True
         params['sniff_on_connection_fail'] = True
+    params.update(transport_params(settings))
+    if settings.get('selector') == 'latency':
+        params['selector_class'] = LatencyAwareSelector
+    params['transport_class'] = ESTransport
+    if settings.asbool('hedge_reads', False):
+        params['transport_class'] = HedgingTransport
+    if settings.asbool('instrument', False):
+        instrumentation.add_sink(instrumentation.request_stats)
 
     # XXX if this connection has to deal with mongo and sqla objects,
     # then we'll need to use their es serializers instead. should
@@ -101,25 +153,267 @@ def setup_database(config):
     # lots of repeated code, plus other engines shouldn't have to know
     # about es - they should just know how to serialize their
     # documents to JSON.
-    conn = es_connections.create_connection(
-        serializer=JSONSerializer(),
-        connection_class=ESHttpConnection,
-        **params)
+    with _timed('connection'):
+        serializer = JSONSerializer(codec=settings.get('json_codec'))
+        conn = es_connections.create_connection(
+            serializer=serializer,
+            connection_class=ESHttpConnection,
+            **params)
+        # Optional separate connection for searches, counts and gets,
+        # e.g. to a search replica cluster
+        if settings.get('read_hosts'):
+            params['hosts'] = parse_hosts(settings['read_hosts'])
+            es_connections.create_connection(
+                'read',
+                serializer=serializer,
+                connection_class=ESHttpConnection,
+                **params)
+            Settings.setdefault('read_using', 'read')
     setup_index(conn, settings)
+    for target, backrefs in sorted(get_unresolved_backrefs().items()):
+        log.warning('Backrefs {} point to undefined document class {}'.format(
+            ', '.join('{}.{}'.format(doc_cls.__name__, field_name)
+                      for doc_cls, field_name in backrefs), target))
+    _startup_timings['total'] = time.time() - start
+    log.info('nefertari_es setup took {}'.format(', '.join(
+        '{} {:.3f}s'.format(phase, duration)
+        for phase, duration in _startup_timings.items())))
+
+
+# Transport, connection and connection pool settings which may be set
+# as "elasticsearch.<name>", mapped to names of dictset converters
+TRANSPORT_SETTINGS = {
+    # Transport
+    'max_retries': 'asint',
+    'retry_on_timeout': 'asbool',
+    'sniffer_timeout': 'asfloat',
+    'sniff_timeout': 'asfloat',
+    'send_get_body_as': None,
+    # Connections pool
+    'dead_timeout': 'asfloat',
+    'timeout_cutoff': 'asint',
+    # Connection
+    'timeout': 'asfloat',
+    'url_prefix': None,
+    'http_auth': None,
+    'use_ssl': 'asbool',
+    'verify_certs': 'asbool',
+    'ca_certs': None,
+    'client_cert': None,
+    'maxsize': 'asint',
+    'pool_block': 'asbool',
+    'pool_timeout': 'asfloat',
+    'keep_alive': 'asbool',
+    'http_compress': 'asbool',
+    'http_compress_threshold': 'asint',
+    'http_compress_level': 'asint',
+    'breaker_failure_threshold': 'asint',
+    'breaker_latency_threshold': 'asfloat',
+    'breaker_reset_timeout': 'asfloat',
+    'read_retries': 'asint',
+    'retry_backoff': 'asfloat',
+    'retry_backoff_max': 'asfloat',
+    'retry_deadline': 'asfloat',
+    'latency_decay': 'asfloat',
+    'hedge_percentile': 'asfloat',
+    'hedge_min_delay': 'asfloat',
+    'hedge_window': 'asint',
+    'hedge_min_samples': 'asint',
+    'hedge_max_workers': 'asint',
+}
+
+
+def transport_params(settings):
+    """ Get ES client transport params from :settings:.
+
+    Only settings which are present in :settings: are returned.
+    """
+    params = {}
+    for name, converter in TRANSPORT_SETTINGS.items():
+        if name not in settings:
+            continue
+        if converter is None:
+            params[name] = settings[name]
+        else:
+            params[name] = getattr(settings, converter)(name)
+    for name in ('retry_on_status', 'read_retry_on_status'):
+        if name in settings:
+            params[name] = tuple(
+                int(code) for code in settings.aslist(name))
+    return params
+
+
+def parse_hosts(hosts):
+    """ Parse comma-separated "host:port" string into list of dicts. """
+    parsed = []
+    for hp in split_strip(hosts):
+        h, p = split_strip(hp, ':')
+        parsed.append(dict(host=h, port=p))
+    return parsed
 
 
 def setup_index(conn, settings):
-    from nefertari.json_httpexceptions import JHTTPNotFound
+    """ Make sure index exists and bind document classes to it.
+
+    How index is checked depends on "startup_mode" setting:
+        * "eager" (default): Index is checked and created if missing.
+        * "cached": Index is fully checked only when mapping
+          fingerprint differs from the one cached in
+          "mapping_cache_file" after last successful check, or when
+          some index is missing, e.g. on a new or wiped cluster.
+        * "lazy": Index is checked when documents are first used.
+
+    When "use_aliases" setting is true, missing index is created as
+    versioned index "<index_name>_v1" behind alias "<index_name>".
+
+    Index settings from "elasticsearch.index.*" config and
+    ``Meta.index_settings`` of document classes are applied when index
+    is created. Dynamic settings of existing index are updated to
+    match them and fields missing in its mappings are added. Use
+    "cached" mode to skip these checks when mappings didn't change.
+    """
     index_name = settings['index_name']
+    use_aliases = settings.asbool('use_aliases', False)
+    mode = settings.get('startup_mode', 'eager')
+    if mode == 'lazy':
+        _bind_index(index_name)
+        defer_index_setup(
+            partial(_verify_index, conn, index_name, use_aliases))
+        return
+    if mode == 'cached':
+        with _timed('fingerprint'):
+            fingerprint = mapping_fingerprint(
+                index_name, settings.get('hosts'))
+            cache_file = settings.get('mapping_cache_file') or os.path.join(
+                tempfile.gettempdir(),
+                'nefertari_es_{}.fingerprint'.format(index_name))
+            cached = _read_file(cache_file)
+        if cached == fingerprint:
+            # Single request makes sure cluster still has all indices
+            names = sorted(_index_groups(index_name))
+            if _indices_exist(conn, names):
+                _bind_index(index_name)
+                return
+        _verify_index(conn, index_name, use_aliases)
+        _write_file(cache_file, fingerprint)
+        return
+    _verify_index(conn, index_name, use_aliases)
+
+
+def _verify_index(conn, index_name, use_aliases=False):
+    """ Create default index or alias :index_name: and indices of
+    document classes placed in other indices if they don't exist.
+    """
+    for name, doc_classes in sorted(_index_groups(index_name).items()):
+        if not _indices_exist(conn, [name]):
+            with _timed('index_create'):
+                if use_aliases:
+                    create_versioned_index(name, doc_classes)
+                else:
+                    create_index(name, doc_classes)
+            continue
+        index_settings = get_index_settings(doc_classes)
+        if index_settings:
+            with _timed('index_settings'):
+                update_index_settings(name, index_settings)
+        if doc_classes:
+            with _timed('mappings'):
+                update_mappings(name, doc_classes)
+    _bind_index(index_name)
+    _put_partition_templates(index_name)
+
+
+def _index_groups(index_name):
+    """ Get dict of {index name: document classes} of indices which
+    should exist.
+
+    Partitioned document classes are stored in partitions created
+    from their index templates, so their base index is not created.
+    """
+    doc_classes = dict(
+        (name, doc_cls) for name, doc_cls in get_document_classes().items()
+        if getattr(doc_cls, '_partition_field', None) is None)
+    return get_index_groups(index_name, doc_classes)
+
+
+def _indices_exist(conn, names):
+    """ Check whether all indices or aliases :names: exist. """
+    from nefertari.json_httpexceptions import JHTTPNotFound
+    with _timed('index_exists'):
+        try:
+            return conn.indices.exists(names)
+        except JHTTPNotFound:
+            return False
+
+
+def _put_partition_templates(index_name):
+    """ Put index templates of partitioned document classes and add
+    their new fields to mappings of existing partitions.
+    """
+    from nefertari.json_httpexceptions import JHTTPNotFound
+    partitioned = {}
+    for doc_cls in get_document_classes().values():
+        if getattr(doc_cls, '_partition_field', None) is None:
+            continue
+        base = getattr(doc_cls, '_explicit_index', None) or index_name
+        partitioned.setdefault(base, []).append(doc_cls)
+    for base, doc_classes in sorted(partitioned.items()):
+        with _timed('index_templates'):
+            put_partition_template(base, doc_classes)
+        # Template only applies to partitions created after it
+        with _timed('mappings'):
+            try:
+                update_mappings(partition_pattern(base), doc_classes)
+            except JHTTPNotFound:
+                pass
+
+
+def _bind_index(index_name):
+    """ Bind document classes to their indices.
+
+    :param index_name: Name of index classes without explicit index
+        are bound to.
+    """
+    for doc_cls in get_document_classes().values():
+        doc_cls._doc_type.index = (
+            getattr(doc_cls, '_explicit_index', None) or index_name)
+
+
+def mapping_fingerprint(index_name, hosts=None):
+    """ Get hash of index name, ES hosts, index settings, placement and
+    mappings of all document classes.
+
+    :param hosts: ES hosts setting, so pointing application at another
+        cluster invalidates cached fingerprint.
+    """
+    mappings = [
+        (name, getattr(doc_cls, '_explicit_index', None),
+         getattr(doc_cls, '_index_settings', None),
+         getattr(doc_cls, '_partition_field', None),
+         getattr(doc_cls, '_partition_interval', None),
+         doc_cls._doc_type.mapping.to_dict())
+        for name, doc_cls in sorted(get_document_classes().items())]
+    index_settings = get_index_settings([])
+    data = json.dumps(
+        [index_name, hosts, index_settings, mappings],
+        sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _write_file(path, data):
     try:
-        index_exists = conn.indices.exists([index_name])
-    except JHTTPNotFound:
-        index_exists = False
-    if not index_exists:
-        create_index(index_name)
-    else:
-        for doc_cls in get_document_classes().values():
-            doc_cls._doc_type.index = index_name
+        with open(path, 'w') as f:
+            f.write(data)
+    except (IOError, OSError) as ex:
+        log.warning('Failed to write {}: {}'.format(path, ex))
 
 
 def is_relationship_field(field, model_cls):
@@ -0,0 +1,341 @@
+""" asyncio counterparts of the synchronous document API.
+
+Requires Python 3.5+ and ``aiohttp``. Query building and hits
+materialization are shared with the synchronous ``BaseDocument``
+methods, only HTTP transport is different.
+"""
+import asyncio
+import logging
+import time
+
+import six
+from elasticsearch import helpers
+from elasticsearch_dsl.document import DOC_META_FIELDS, META_FIELDS
+from elasticsearch_dsl.result import Response
+from nefertari.json_httpexceptions import (
+    JHTTPNotFound,
+    exception_response,
+)
+
+from .meta import ensure_index, index_setup_pending
+from .serializers import JSONSerializer
+from .slowlog import get_slow_query_log
+
+
+log = logging.getLogger(__name__)
+
+# Maps connection aliases to AsyncESHttpConnection instances
+_async_connections = {}
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            'aiohttp is required to use asyncio nefertari_es API')
+    return aiohttp
+
+
+def _make_path(*parts):
+    """ Build URL path from :parts:, skipping empty parts and joining
+    list parts with comma.
+    """
+    path = []
+    for part in parts:
+        if part in (None, '', [], ()):
+            continue
+        if isinstance(part, (list, tuple)):
+            part = ','.join(part)
+        path.append(str(part))
+    return '/' + '/'.join(path)
+
+
+def _query_params(params):
+    result = {}
+    for key, val in params.items():
+        if val is None:
+            continue
+        if isinstance(val, bool):
+            val = 'true' if val else 'false'
+        elif isinstance(val, (list, tuple)):
+            val = ','.join(val)
+        result[key] = str(val)
+    return result
+
+
+class AsyncESHttpConnection(object):
+    """ Non-blocking HTTP connection to ES nodes built on ``aiohttp``.
+
+    Errors are converted to nefertari HTTP exceptions the same way
+    ``ESHttpConnection`` does it. Nodes are selected in round-robin.
+
+    :param hosts: List of dicts with "host" and "port" keys.
+    :param serializer: Serializer used to (de)serialize bodies.
+    :param timeout: Total request timeout in seconds.
+    :param maxsize: Max number of open connections.
+    """
+    def __init__(self, hosts, serializer=None, timeout=10, maxsize=10):
+        self.hosts = [
+            'http://{}:{}'.format(h['host'], h['port']) for h in hosts]
+        self.serializer = serializer or JSONSerializer()
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self._session = None
+        self._rr = -1
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            aiohttp = _import_aiohttp()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.maxsize),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _select_host(self):
+        self._rr = (self._rr + 1) % len(self.hosts)
+        return self.hosts[self._rr]
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def perform_request(self, method, url, params=None, body=None):
+        if body is not None and not isinstance(body, six.string_types):
+            body = self.serializer.dumps(body)
+        full_url = self._select_host() + url
+        headers = {'Content-Type': 'application/json'}
+        try:
+            async with self._get_session().request(
+                    method, full_url, params=_query_params(params or {}),
+                    data=body, headers=headers) as response:
+                status = response.status
+                raw_data = await response.text()
+        except Exception as e:
+            log.error(str(e))
+            raise exception_response(
+                400, explanation=six.b(str(e)), extra=dict(data=e))
+
+        if not (200 <= status < 300):
+            log.error(raw_data)
+            raise exception_response(
+                status, explanation=six.b(raw_data),
+                extra=dict(data=raw_data))
+        if not raw_data:
+            return {}
+        return self.serializer.loads(raw_data)
+
+    async def search(self, index=None, doc_type=None, body=None, **params):
+        return await self.perform_request(
+            'POST', _make_path(index, doc_type, '_search'),
+            params=params, body=body)
+
+    async def count(self, index=None, doc_type=None, body=None, **params):
+        return await self.perform_request(
+            'POST', _make_path(index, doc_type, '_count'),
+            params=params, body=body)
+
+    async def get(self, index, doc_type, id, **params):
+        return await self.perform_request(
+            'GET', _make_path(index, doc_type, id), params=params)
+
+    async def index(self, index, doc_type, body, id=None, **params):
+        method = 'POST' if id is None else 'PUT'
+        return await self.perform_request(
+            method, _make_path(index, doc_type, id),
+            params=params, body=body)
+
+    async def delete(self, index, doc_type, id, **params):
+        return await self.perform_request(
+            'DELETE', _make_path(index, doc_type, id), params=params)
+
+    async def bulk(self, body, **params):
+        return await self.perform_request(
+            'POST', '/_bulk', params=params, body=body)
+
+
+def create_async_connection(alias='default', **kwargs):
+    """ Create and register async connection under :alias:. """
+    conn = _async_connections[alias] = AsyncESHttpConnection(**kwargs)
+    return conn
+
+
+def get_async_connection(alias='default'):
+    """ Get async connection registered under :alias:.
+
+    When connection was not created yet, it is created using
+    ``elasticsearch.hosts`` setting for "default" alias and
+    ``elasticsearch.<alias>_hosts`` setting for other aliases.
+    """
+    if alias not in _async_connections:
+        from nefertari_es import Settings, parse_hosts
+        hosts_key = 'hosts' if alias == 'default' else alias + '_hosts'
+        if hosts_key not in Settings:
+            raise KeyError(
+                'There is no async connection with alias %r' % alias)
+        create_async_connection(
+            alias,
+            hosts=parse_hosts(Settings[hosts_key]),
+            serializer=JSONSerializer())
+    return _async_connections[alias]
+
+
+async def _aensure_index():
+    """ Perform deferred index setup in default executor, so it
+    doesn't block the event loop.
+    """
+    if index_setup_pending():
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, ensure_index)
+
+
+async def aget_collection(cls, _count=False, _strict=True, _sort=None,
+                          _fields=None, _limit=None, _page=None,
+                          _start=None, _explain=None,
+                          _search_fields=None, q=None,
+                          _raise_on_empty=False, **params):
+    """ Async counterpart of ``BaseDocument.get_collection``. """
+    await _aensure_index()
+    params.pop('_query_set', None)
+    params.pop('_item_request', None)
+    search_obj, _start, params = cls._build_search(
+        _strict=_strict, _fields=_fields, _limit=_limit, _page=_page,
+        _start=_start, _search_fields=_search_fields, q=q,
+        **params)
+    conn = get_async_connection(cls._read_alias())
+
+    if _count:
+        response = await conn.count(
+            index=search_obj._index, doc_type=search_obj._doc_type,
+            body=search_obj.to_dict(count=True), **search_obj._params)
+        return response['count']
+
+    if _explain:
+        return search_obj.to_dict()
+
+    search_obj = cls._sort_search(search_obj, _sort, _strict)
+    start = time.time()
+    response = await conn.search(
+        index=search_obj._index, doc_type=search_obj._doc_type,
+        body=search_obj.to_dict(), **search_obj._params)
+    response = Response(response, callbacks=search_obj._doc_type_map)
+    slow_log = get_slow_query_log()
+    if slow_log.enabled:
+        slow_log.check(cls, search_obj, response, time.time() - start)
+    hits = response.hits
+    return cls._process_hits(
+        hits, params, _start=_start, _fields=_fields,
+        _raise_on_empty=_raise_on_empty)
+
+
+async def aget_item(cls, **kw):
+    """ Async counterpart of ``BaseDocument.get_item``. """
+    kw.setdefault('_raise_on_empty', True)
+    doc_id, routing = cls._realtime_target(kw)
+    if doc_id is not None:
+        await _aensure_index()
+        conn = get_async_connection(cls._read_alias())
+        params = cls._get_params(
+            kw.get('_fields'), kw.get('_strict', True), routing)
+        try:
+            doc = await conn.get(
+                index=cls._doc_type.index, doc_type=cls._doc_type.name,
+                id=doc_id, **params)
+        except JHTTPNotFound:
+            doc = {}
+        item = cls.from_es(doc) if doc.get('found') else None
+        found, item = cls._check_realtime_item(item, doc_id, kw)
+        if found:
+            return item
+    result = await aget_collection(cls, _limit=1, _item_request=True, **kw)
+    return result[0]
+
+
+async def asave(doc, refresh=None, **kwargs):
+    """ Async counterpart of ``BaseDocument.save``.
+
+    Backref hooks registered on :doc: perform synchronous writes, so
+    they are run in default executor to not block the event loop.
+    """
+    if refresh is None:
+        from nefertari_es import Settings
+        refresh = Settings.asbool('refresh_on_save', True)
+    await _aensure_index()
+    doc._sync_routing()
+    doc._set_pk_id()
+    doc._bump_version()
+    doc.full_clean()
+    doc_meta = dict(
+        (k, doc.meta[k]) for k in DOC_META_FIELDS if k in doc.meta)
+    doc_meta.update(kwargs)
+    conn = get_async_connection(doc._write_alias())
+    meta = await conn.index(
+        index=doc._get_index(),
+        doc_type=doc._doc_type.name,
+        body=doc.to_dict(),
+        refresh=refresh,
+        **doc_meta)
+    for k in META_FIELDS:
+        if '_' + k in meta:
+            setattr(doc.meta, k, meta['_' + k])
+    doc._sync_id_field()
+
+    loop = asyncio.get_event_loop()
+    hooks, doc._backref_hooks = doc._backref_hooks, ()
+    for hook in hooks:
+        await loop.run_in_executor(None, hook)
+    return doc
+
+
+async def adelete(doc, **kwargs):
+    """ Async counterpart of ``BaseDocument.delete``. """
+    await _aensure_index()
+    doc._sync_routing()
+    doc_meta = dict(
+        (k, doc.meta[k]) for k in DOC_META_FIELDS if k in doc.meta)
+    doc_meta.update(kwargs)
+    conn = get_async_connection(doc._write_alias())
+    await conn.delete(
+        index=doc._get_index(),
+        doc_type=doc._doc_type.name,
+        **doc_meta)
+
+
+async def abulk(actions, op_type='index', using='default', refresh=None,
+                chunk_size=None):
+    """ Async counterpart of ``documents._bulk``.
+
+    :returns: Number of successfully executed actions.
+    """
+    if chunk_size is None:
+        from nefertari_es import Settings
+        chunk_size = Settings.asint('chunk_size', 500)
+    await _aensure_index()
+    conn = get_async_connection(using)
+    dumps = conn.serializer.dumps
+
+    executed_num = 0
+    errors = []
+    for start in range(0, len(actions), chunk_size):
+        lines = []
+        for action in actions[start:start + chunk_size]:
+            if op_type is not None:
+                action['_op_type'] = op_type
+            action_line, data = helpers.expand_action(action)
+            lines.append(dumps(action_line))
+            if data is not None:
+                lines.append(dumps(data))
+        response = await conn.bulk(
+            '\n'.join(lines) + '\n', refresh=refresh)
+        for item in response.get('items', []):
+            _, result = item.popitem()
+            if 200 <= result.get('status', 500) < 300:
+                executed_num += 1
+            else:
+                errors.append(str(result.get('error')))
+
+    if errors:
+        raise Exception('Errors happened when executing Elasticsearch '
+                        'actions: {}'.format('; '.join(errors)))
+    return executed_num
@@ -1,50 +1,523 @@
 import json
 import logging
-
+import os
+import random
+import re
+import threading
+import time
+import zlib
 
 import elasticsearch
 import six
 from nefertari.json_httpexceptions import exception_response
 
+from . import instrumentation
+
 
 log = logging.getLogger(__name__)
 
+# Matches successful bulk response start, e.g. '{"took":3,"errors":false'
+_BULK_NO_ERRORS = re.compile(
+    r'^\s*\{\s*"took"\s*:\s*\d+\s*,'
+    r'\s*"errors"\s*:\s*false')
+
+# Maps ES host URLs to PoolStats of their connection pools
+_pool_stats = {}
+
+# Maps ES host URLs to CompressionStats of their connections
+_compression_stats = {}
+
+# Maps ES host URLs to CircuitBreakers of their connections
+_breakers = {}
+
+# Last path parts of read-only APIs which are requested with POST
+_READ_APIS = frozenset(['_search', '_count', '_mget', '_msearch'])
+
+# Status codes of transport errors which are not HTTP errors
+_NO_STATUS = ('N/A', 'TIMEOUT')
+
+# wbits value which makes zlib produce and accept gzip format
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class PoolStats(object):
+    """ Connection checkout statistics of a single host pool. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def to_dict(self):
+        with self._lock:
+            avg = self.wait_total / self.checkouts if self.checkouts else 0.0
+            return dict(
+                checkouts=self.checkouts,
+                wait_total=self.wait_total,
+                wait_avg=avg,
+                wait_max=self.wait_max,
+            )
+
+
+def get_pool_stats():
+    """ Get connection checkout wait statistics of all host pools.
+
+    :returns: Dict of {host URL: stats dict}.
+    """
+    return {host: stats.to_dict() for host, stats in _pool_stats.items()}
+
+
+class CompressionStats(object):
+    """ Gzip compression statistics of a single host.
+
+    Request bodies are counted only when they are compressed, response
+    bodies only when they are received compressed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.request_bytes = 0
+        self.request_bytes_sent = 0
+        self.compress_time = 0.0
+        self.responses = 0
+        self.response_bytes = 0
+        self.response_bytes_received = 0
+        self.decompress_time = 0.0
+
+    def record_request(self, size, sent, duration):
+        with self._lock:
+            self.requests += 1
+            self.request_bytes += size
+            self.request_bytes_sent += sent
+            self.compress_time += duration
+
+    def record_response(self, size, received, duration):
+        with self._lock:
+            self.responses += 1
+            self.response_bytes += size
+            self.response_bytes_received += received
+            self.decompress_time += duration
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                requests=self.requests,
+                request_bytes=self.request_bytes,
+                request_bytes_sent=self.request_bytes_sent,
+                request_bytes_saved=(
+                    self.request_bytes - self.request_bytes_sent),
+                compress_time=self.compress_time,
+                responses=self.responses,
+                response_bytes=self.response_bytes,
+                response_bytes_received=self.response_bytes_received,
+                response_bytes_saved=(
+                    self.response_bytes - self.response_bytes_received),
+                decompress_time=self.decompress_time,
+            )
+
+
+def get_compression_stats():
+    """ Get gzip compression statistics of all hosts.
+
+    :returns: Dict of {host URL: stats dict}.
+    """
+    return {host: stats.to_dict()
+            for host, stats in _compression_stats.items()}
+
+
+class CircuitBreaker(object):
+    """ Circuit breaker of a single host.
+
+    Breaker opens after ``failure_threshold`` consecutive failed or
+    slow requests. While open, requests are rejected without being
+    sent. After ``reset_timeout`` seconds single trial request is let
+    through: breaker closes if it succeeds and opens again otherwise.
+
+    :param failure_threshold: Number of consecutive failures which
+        opens breaker.
+    :param latency_threshold: Requests which take longer than this
+        number of seconds count as failures. None to not count slow
+        requests.
+    :param reset_timeout: Number of seconds breaker stays open.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, latency_threshold=None,
+                 reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = None
+
+    def is_available(self):
+        """ Whether request would be allowed, without changing state. """
+        return self.state == self.CLOSED or (
+            self.state == self.OPEN and
+            time.time() - self._opened_at >= self.reset_timeout)
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.time() - self._opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, duration):
+        if (self.latency_threshold is not None and
+                duration > self.latency_threshold):
+            self.record_failure()
+            return
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                state=self.state,
+                failures=self.failures,
+                opened=self.opened,
+                rejected=self.rejected,
+            )
+
+
+def get_breaker_stats():
+    """ Get circuit breaker states of all hosts.
+
+    :returns: Dict of {host URL: stats dict}.
+    """
+    return {host: breaker.to_dict() for host, breaker in _breakers.items()}
+
+
+def gzip_compress(data, level=zlib.Z_DEFAULT_COMPRESSION):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    return zlib.decompress(data, _GZIP_WBITS)
+
 
 class ESHttpConnection(elasticsearch.Urllib3HttpConnection):
+    """ Connection that raises nefertari HTTP exceptions on errors.
+
+    Accepts all ``Urllib3HttpConnection`` arguments plus:
+
+    :param pool_block: When True, requests wait for a free pooled
+        connection instead of opening a throwaway one when all
+        ``maxsize`` connections are in use.
+    :param pool_timeout: Max number of seconds to wait for a free
+        pooled connection when ``pool_block`` is True.
+    :param keep_alive: Whether to keep connections open between
+        requests. Defaults to True.
+    :param http_compress: Whether to gzip request bodies and accept
+        gzipped responses. Defaults to False. Responses are only
+        compressed when ``http.compression`` is enabled on ES nodes.
+    :param http_compress_threshold: Min size in bytes of request body
+        to be compressed. Defaults to 1024.
+    :param http_compress_level: zlib compression level, 1-9.
+    :param breaker_failure_threshold: Number of consecutive failures
+        which opens host circuit breaker. Defaults to None, in which
+        case circuit breaker is not used.
+    :param breaker_latency_threshold: Requests which take longer than
+        this number of seconds count as breaker failures.
+    :param breaker_reset_timeout: Number of seconds breaker stays open
+        before trial request is let through. Defaults to 30.
+    :param read_retries: Number of times failed idempotent read
+        requests are retried. Defaults to 0.
+    :param retry_backoff: Base retry delay in seconds. Actual delay is
+        random, up to base delay doubled on each retry.
+    :param retry_backoff_max: Max retry delay in seconds.
+    :param retry_deadline: Max number of seconds since first attempt
+        after which request is not retried.
+    :param read_retry_on_status: Status codes on which reads are
+        retried, besides connection errors and timeouts. Unlike
+        ``retry_on_status`` of ``Transport``, reads are retried on the
+        same host.
+    :param latency_decay: Weight of latest request latency in
+        exponentially decayed latency average of host, from 0 to 1.
+        Defaults to 0.3.
+
+    Connection pool is reset in forked processes, so connections
+    created before fork are never shared between processes.
+    """
+    def __init__(self, *args, **kwargs):
+        pool_block = kwargs.pop('pool_block', False)
+        self.pool_timeout = kwargs.pop('pool_timeout', None)
+        keep_alive = kwargs.pop('keep_alive', True)
+        breaker_failure_threshold = kwargs.pop(
+            'breaker_failure_threshold', None)
+        breaker_latency_threshold = kwargs.pop(
+            'breaker_latency_threshold', None)
+        breaker_reset_timeout = kwargs.pop('breaker_reset_timeout', 30.0)
+        self.read_retries = kwargs.pop('read_retries', 0)
+        self.retry_backoff = kwargs.pop('retry_backoff', 0.05)
+        self.retry_backoff_max = kwargs.pop('retry_backoff_max', 1.0)
+        self.retry_deadline = kwargs.pop('retry_deadline', 10.0)
+        self.read_retry_on_status = kwargs.pop(
+            'read_retry_on_status', (502, 503, 504))
+        self.latency_decay = kwargs.pop('latency_decay', 0.3)
+        # Exponentially decayed average of request latency. Used by
+        # ``LatencyAwareSelector``
+        self.latency_ewma = None
+        http_compress = kwargs.pop('http_compress', False)
+        self.compress_threshold = kwargs.pop('http_compress_threshold', 1024)
+        self.compress_level = kwargs.pop(
+            'http_compress_level', zlib.Z_DEFAULT_COMPRESSION)
+        super(ESHttpConnection, self).__init__(*args, **kwargs)
+        if not keep_alive:
+            self.headers['connection'] = 'close'
+        self.pool.block = pool_block
+        self._pid = os.getpid()
+        self.pool_stats = _pool_stats.setdefault(self.host, PoolStats())
+        self._instrument_pool()
+        if http_compress:
+            self.headers['accept-encoding'] = 'gzip'
+            self.compression_stats = _compression_stats.setdefault(
+                self.host, CompressionStats())
+            self._compress_pool()
+        self.breaker = None
+        if breaker_failure_threshold is not None:
+            self.breaker = _breakers.setdefault(self.host, CircuitBreaker(
+                failure_threshold=breaker_failure_threshold,
+                latency_threshold=breaker_latency_threshold,
+                reset_timeout=breaker_reset_timeout))
+
+    def _instrument_pool(self):
+        """ Wrap pool connection checkout to record wait time. """
+        get_conn = self.pool._get_conn
+        stats = self.pool_stats
+
+        def _get_conn(timeout=None):
+            if timeout is None:
+                timeout = self.pool_timeout
+            start = time.time()
+            try:
+                return get_conn(timeout=timeout)
+            finally:
+                stats.record(time.time() - start)
+        self.pool._get_conn = _get_conn
+
+    def _compress_pool(self):
+        """ Wrap pool requests to gzip request bodies and to unzip
+        gzipped responses.
+
+        Bodies are (de)compressed at pool level, so request logging
+        of ``Urllib3HttpConnection`` still sees them uncompressed.
+        """
+        urlopen = self.pool.urlopen
+        stats = self.compression_stats
+
+        def _urlopen(method, url, body=None, headers=None, **kwargs):
+            if body and len(body) >= self.compress_threshold:
+                start = time.time()
+                compressed = gzip_compress(body, self.compress_level)
+                stats.record_request(
+                    len(body), len(compressed), time.time() - start)
+                body = compressed
+                headers = dict(headers or {}, **{'content-encoding': 'gzip'})
+            kwargs['preload_content'] = False
+            response = urlopen(method, url, body, headers=headers, **kwargs)
+            try:
+                if response.headers.get('content-encoding') == 'gzip':
+                    raw_data = response.read(decode_content=False)
+                    start = time.time()
+                    data = gzip_decompress(raw_data)
+                    stats.record_response(
+                        len(data), len(raw_data), time.time() - start)
+                    # Cache body so "response.data" returns it
+                    response._body = data
+                else:
+                    response.data
+            finally:
+                response.release_conn()
+            return response
+        self.pool.urlopen = _urlopen
+
+    def _check_fork(self):
+        """ Drop connections inherited from parent process. """
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+        self._pid = pid
+        pool = self.pool
+        maxsize = pool.pool.maxsize
+        pool.pool = pool.QueueCls(maxsize)
+        for _ in range(maxsize):
+            pool.pool.put(None)
+
+    @staticmethod
+    def _is_bulk_url(url):
+        return url.rstrip('/').endswith('/_bulk')
+
+    @staticmethod
+    def _is_read(method, url):
+        if method in ('GET', 'HEAD'):
+            return True
+        api = url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+        return method == 'POST' and api in _READ_APIS
+
+    @staticmethod
+    def _is_failure(status_code):
+        """ Whether error with :status_code: means host is unhealthy. """
+        return status_code in _NO_STATUS or status_code >= 500
+
+    def _retry_delay(self, status_code, attempt, deadline):
+        """ Get number of seconds to wait before retrying request.
+
+        :returns: Delay or None if request should not be retried.
+        """
+        if status_code not in _NO_STATUS and \
+                status_code not in self.read_retry_on_status:
+            return None
+        delay = random.uniform(0, min(
+            self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
+        if time.time() + delay >= deadline:
+            return None
+        if self.breaker is not None and not self.breaker.allow_request():
+            return None
+        return delay
+
     def _catch_index_error(self, response):
         """ Catch and raise index errors which are not critical and thus
         not raised by elasticsearch-py.
+
+        Should only be used with bulk API responses.
+
+        :returns: Parsed response body if it had to be parsed, None
+            otherwise.
         """
         code, headers, raw_data = response
         if not raw_data:
             return
+        # Successful bulk responses start with "errors":false, so there
+        # is no need to parse them
+        if _BULK_NO_ERRORS.match(raw_data[:64]):
+            return
         data = json.loads(raw_data)
         if not data or not data.get('errors'):
-            return
+            return data
         try:
             error_dict = data['items'][0]['index']
             message = error_dict['error']
         except (KeyError, IndexError):
-            return
+            return data
         raise exception_response(400, detail=message)
 
-    def perform_request(self, *args, **kw):
+    def _record_latency(self, duration):
+        if self.latency_ewma is None:
+            self.latency_ewma = duration
+        else:
+            self.latency_ewma += self.latency_decay * (
+                duration - self.latency_ewma)
+
+    def _send(self, method, url, args, kw):
+        """ Perform request, retrying idempotent reads on transient
+        errors and reporting results to circuit breaker.
+        """
+        breaker = self.breaker
+        retries = self.read_retries if self._is_read(method, url) else 0
+        deadline = time.time() + self.retry_deadline
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                resp = super(ESHttpConnection, self).perform_request(
+                    *args, **kw)
+            except Exception as e:
+                self._record_latency(time.time() - start)
+                status_code = getattr(e, 'status_code', 'N/A')
+                if breaker is not None and self._is_failure(status_code):
+                    breaker.record_failure()
+                delay = None
+                if attempt < retries:
+                    delay = self._retry_delay(status_code, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                log.warning('Retrying {} {} in {:.3f}s: {}'.format(
+                    method, url, delay, e))
+                time.sleep(delay)
+            else:
+                duration = time.time() - start
+                self._record_latency(duration)
+                if breaker is not None:
+                    breaker.record_success(duration)
+                return resp
+
+    def perform_request(self, method, url, *args, **kw):
+        self._check_fork()
+        if self.breaker is not None and not self.breaker.allow_request():
+            # Connection error makes transport mark host as dead and
+            # try another one
+            raise elasticsearch.exceptions.ConnectionError(
+                'N/A', 'Circuit breaker of {} is open'.format(self.host),
+                self.breaker.to_dict())
+        args = (method, url) + args
+        start = time.time()
         try:
             if log.level == logging.DEBUG:
                 msg = str(args)
                 if len(msg) > 512:
                     msg = msg[:300] + '...TRUNCATED...' + msg[-212:]
                 log.debug(msg)
-            resp = super(ESHttpConnection, self).perform_request(*args, **kw)
+            resp = self._send(method, url, args, kw)
         except Exception as e:
             log.error(e.error)
             status_code = e.status_code
             if status_code == 'N/A':
                 status_code = 400
+            if instrumentation.is_enabled():
+                instrumentation.record_request(
+                    method, url, _get_body(args, kw), status_code,
+                    time.time() - start)
             raise exception_response(
                 status_code,
                 explanation=six.b(e.error),
                 extra=dict(data=e))
         else:
-            self._catch_index_error(resp)
+            if instrumentation.is_enabled():
+                instrumentation.record_request(
+                    method, url, _get_body(args, kw), resp[0],
+                    time.time() - start, resp[2])
+            if self._is_bulk_url(url):
+                data = self._catch_index_error(resp)
+                if data is not None:
+                    # Pass parsed body on so it is not parsed again
+                    # by serializer
+                    resp = resp[:2] + (data,)
             return resp
+
+
+def _get_body(args, kwargs):
+    """ Get request body from ``perform_request`` arguments. """
+    if len(args) > 3:
+        return args[3]
+    return kwargs.get('body')
@@ -0,0 +1,189 @@
+import atexit
+import logging
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+
+log = logging.getLogger(__name__)
+
+# Process-wide write-behind queue. Created lazily by ``get_write_queue``
+_write_queue = None
+_write_queue_lock = threading.Lock()
+
+
+class WriteBehindQueue(object):
+    """ Bounded in-process queue of deferred ES write actions.
+
+    Actions are put on the queue by ``put`` and drained by a background
+    daemon thread, which sends them to ES with ``_bulk`` once
+    ``batch_size`` actions are collected or ``flush_interval`` seconds
+    have passed since the first queued action.
+
+    When the queue is full, queued actions and then the new action are
+    performed synchronously, so writes are never lost because of
+    backpressure and are sent in the order they were queued.
+
+    :param maxsize: Max number of actions queue can hold.
+    :param batch_size: Max number of actions sent in one bulk request.
+    :param flush_interval: Max number of seconds an action waits in
+        queue before being sent.
+    :param metrics_hook: Callable which is called after each flush with
+        a dict of flush statistics: ``flushed``, ``failed``,
+        ``duration``, ``pending`` and ``overflow``.
+    """
+    def __init__(self, maxsize=10000, batch_size=500, flush_interval=1.0,
+                 metrics_hook=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics_hook = metrics_hook
+        self._queue = Queue(maxsize)
+        # Held while actions taken from queue are sent, so actions are
+        # never sent out of order
+        self._flush_lock = threading.RLock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._overflow = 0
+
+    def put(self, action, client, op_type='index'):
+        """ Queue single bulk action to be performed on :client:. """
+        action['_op_type'] = op_type
+        if self._closed:
+            self._send([(client, action)])
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((client, action))
+        except Full:
+            self._overflow += 1
+            log.warning('Write-behind queue is full, performing '
+                        '{} action synchronously'.format(op_type))
+            with self._flush_lock:
+                self.flush()
+                self._send([(client, action)])
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """ Synchronously send all currently queued actions. """
+        while True:
+            items = self._collect(block=False)
+            if not items:
+                return
+            self._send(items)
+
+    def close(self):
+        """ Stop background thread and flush queued actions. """
+        self._closed = True
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(self.flush_interval * 2 + 1)
+        self.flush()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='nefertari-es-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            with self._flush_lock:
+                items = self._collect(block=True)
+                if items:
+                    self._send(items)
+
+    def _collect(self, block=True):
+        """ Collect up to ``batch_size`` queued items.
+
+        When :block: is True, waits up to ``flush_interval`` seconds
+        for the first item and for the batch to fill up.
+        """
+        items = []
+        deadline = time.time() + self.flush_interval
+        while len(items) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if block and timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except Empty:
+                break
+            items.append(item)
+        return items
+
+    def _send(self, items):
+        from .documents import _bulk
+        start = time.time()
+        flushed = failed = 0
+        with self._flush_lock:
+            # Group consecutive actions by client to keep actions order
+            groups = []
+            for client, action in items:
+                if groups and groups[-1][0] is client:
+                    groups[-1][1].append(action)
+                else:
+                    groups.append((client, [action]))
+            for client, actions in groups:
+                try:
+                    _bulk(actions, client, op_type=None)
+                except Exception as ex:
+                    failed += len(actions)
+                    log.error('Failed to perform deferred ES '
+                              'actions: {}'.format(ex))
+                else:
+                    flushed += len(actions)
+        self._report(dict(
+            flushed=flushed,
+            failed=failed,
+            duration=time.time() - start,
+            pending=self.pending(),
+            overflow=self._overflow,
+        ))
+
+    def _report(self, stats):
+        if self.metrics_hook is None:
+            return
+        try:
+            self.metrics_hook(stats)
+        except Exception as ex:
+            log.error('Write-behind metrics hook failed: {}'.format(ex))
+
+
+def get_write_queue():
+    """ Get process-wide write-behind queue.
+
+    Queue is created on first call using ``elasticsearch.deferred_*``
+    settings and is flushed on interpreter shutdown.
+    """
+    global _write_queue
+    if _write_queue is not None:
+        return _write_queue
+    with _write_queue_lock:
+        if _write_queue is None:
+            from nefertari_es import Settings
+            _write_queue = WriteBehindQueue(
+                maxsize=Settings.asint('deferred_queue_size', 10000),
+                batch_size=Settings.asint('deferred_batch_size', 500),
+                flush_interval=Settings.asfloat(
+                    'deferred_flush_interval', 1.0),
+            )
+            atexit.register(_write_queue.close)
+    return _write_queue
+
+
+def set_metrics_hook(hook):
+    """ Set callable to receive write-behind queue flush statistics. """
+    get_write_queue().metrics_hook = hook
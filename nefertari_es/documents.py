@@ -1,15 +1,21 @@
 from functools import partial
-import copy
+from uuid import uuid4
+import hashlib
+import json
+import logging
+import time
 
 from six import (
     with_metaclass,
 )
 from elasticsearch_dsl import DocType
+from elasticsearch_dsl.connections import connections
 from elasticsearch_dsl.utils import AttrList, AttrDict
 from elasticsearch_dsl.field import InnerObjectWrapper
 from elasticsearch import helpers
 from nefertari.json_httpexceptions import (
     JHTTPBadRequest,
+    JHTTPConflict,
     JHTTPNotFound,
 )
 from nefertari.utils import (
@@ -18,13 +24,51 @@ from nefertari.utils import (
     dictset,
     split_strip,
 )
-from .meta import DocTypeMeta
+from .meta import DocTypeMeta, ensure_index
+from .indices import partition_name, partition_names, partition_pattern
+from .deferred import get_write_queue
+from .slowlog import get_slow_query_log
 from .fields import (
     ReferenceField, IdField, DictField, ListField,
     IntegerField,
 )
 
 
+log = logging.getLogger(__name__)
+
+# Scripts used by ``update_iterables`` to change iterable fields in
+# place. Both bump "version" the same way ``VersionedMixin`` does.
+LIST_UPDATE_SCRIPT = (
+    'def items = ctx._source[field] ?: []; '
+    'if (unique) { '
+    'def existing = new HashSet(items); '
+    'for (v in add) { if (existing.add(v)) { items.add(v) } } '
+    '} else { items.addAll(add) }; '
+    'if (remove) { items.removeAll(new HashSet(remove)) }; '
+    'ctx._source[field] = items; '
+    'ctx._source.version = (ctx._source.version ?: 0) + 1'
+)
+DICT_UPDATE_SCRIPT = (
+    'def items = ctx._source[field] ?: [:]; '
+    'for (k in remove) { items.remove(k) }; '
+    'items.putAll(set_values); '
+    'ctx._source[field] = items; '
+    'ctx._source.version = (ctx._source.version ?: 0) + 1'
+)
+
+# Set when ES rejected update script because inline scripting is
+# disabled, so further iterable updates go straight to full save
+_scripting_disabled = False
+
+
+def _is_scripting_disabled_error(error):
+    explanation = error.explanation or ''
+    if isinstance(explanation, bytes):
+        explanation = explanation.decode('utf-8', 'replace')
+    explanation = explanation.lower()
+    return 'script' in explanation and 'disabled' in explanation
+
+
 class SyncRelatedMixin(object):
     _backref_hooks = ()
     _created = False
@@ -169,20 +213,177 @@ class VersionedMixin(object):
         return name
 
 
+class DeferredWriteMixin(object):
+    """ Mixin that allows to put writes on write-behind queue.
+
+    Writes are deferred when ``deferred=True`` is passed to ``save`` or
+    ``delete``, or when ``_deferred_writes`` class attribute is True and
+    ``deferred`` is not provided. Deferred writes do not block the caller
+    but are not visible in ES until write-behind queue is flushed.
+
+    Deferred writes accept ``version`` and ``version_type``, and saves
+    also accept ``op_type``; they are carried into queued bulk action.
+    Other write params can't be honoured by the queue and are rejected.
+    """
+    _deferred_writes = False
+
+    def _is_deferred(self, deferred):
+        if deferred is None:
+            return self._deferred_writes
+        return deferred
+
+    def _deferred_action(self, kwargs, allowed):
+        """ Build bulk action of deferred write from write :kwargs:.
+
+        :raises ValueError: If :kwargs: contain params not in :allowed:.
+            Falsy ``refresh`` is accepted, as queue never refreshes.
+        """
+        if not kwargs.get('refresh', True):
+            kwargs.pop('refresh')
+        unsupported = sorted(set(kwargs) - set(allowed))
+        if unsupported:
+            raise ValueError(
+                'Deferred writes do not support params: {}'.format(
+                    ', '.join(unsupported)))
+        action = self.to_dict(include_meta=True)
+        for name in ('version', 'version_type'):
+            if name in kwargs:
+                action['_' + name] = kwargs[name]
+        return action
+
+    def save(self, deferred=None, **kwargs):
+        if not self._is_deferred(deferred):
+            return super(DeferredWriteMixin, self).save(**kwargs)
+        self.full_clean()
+        # ID is generated locally so document may be referenced
+        # before it is written
+        if self._id is None:
+            self._id = uuid4().hex
+        action = self._deferred_action(
+            kwargs, ('op_type', 'version', 'version_type'))
+        get_write_queue().put(
+            action, self.connection, op_type=kwargs.get('op_type', 'index'))
+
+    def delete(self, deferred=None, **kwargs):
+        if not self._is_deferred(deferred):
+            return super(DeferredWriteMixin, self).delete(**kwargs)
+        action = self._deferred_action(kwargs, ('version', 'version_type'))
+        action.pop('_source')
+        get_write_queue().put(action, self.connection, op_type='delete')
+
+
 class BaseDocument(with_metaclass(
         DocTypeMeta,
-        VersionedMixin, SyncRelatedMixin, DocType)):
+        VersionedMixin, SyncRelatedMixin, DeferredWriteMixin, DocType)):
     _public_fields = None
     _auth_fields = None
     _hidden_fields = None
     _nested_relationships = ()
     _nesting_depth = 1
     _request = None
+    # Aliases of connections used to read and write documents of this
+    # class. Override "elasticsearch.read_using" setting and default
+    # connection respectively.
+    _read_using = None
+    _write_using = None
+    # Index this class is placed in, when it is not the default
+    # "elasticsearch.index_name" index. Set from ``Meta.index`` or
+    # ``__index__`` class attribute.
+    _explicit_index = None
+    _index_settings = None
+    # Name of field which value is used as routing key of documents,
+    # so writes and reads which know it only hit a single shard. When
+    # ``_routing_required`` is True, documents without routing value
+    # can't be written.
+    _routing_field = None
+    _routing_required = True
+    # Name of date field documents are partitioned by into indices
+    # "<index>-<date suffix>", and partition interval: "daily",
+    # "monthly" or "yearly". Searches span all partitions unless params
+    # narrow partition field values.
+    _partition_field = None
+    _partition_interval = 'monthly'
 
     def __init__(self, *args, **kwargs):
         super(BaseDocument, self).__init__(*args, **kwargs)
         self._sync_id_field()
 
+    @classmethod
+    def _read_alias(cls):
+        """ Get alias of connection used for searches, counts and gets. """
+        if cls._read_using is not None:
+            return cls._read_using
+        from nefertari_es import Settings
+        return Settings.get('read_using') or cls._doc_type.using
+
+    @classmethod
+    def _write_alias(cls):
+        """ Get alias of connection used for saves, deletes and bulk. """
+        if cls._write_using is not None:
+            return cls._write_using
+        return cls._doc_type.using
+
+    @classmethod
+    def _routing_value(cls, value):
+        """ Convert routing field :value: to routing key. """
+        if value is None or value == '':
+            return None
+        return str(value)
+
+    def _sync_routing(self):
+        """ Set routing of document from value of routing field.
+
+        :raises JHTTPBadRequest: If routing is required and routing field
+            has no value, or if routing field of already indexed document
+            was changed, which would create a copy of the document on
+            another shard.
+        """
+        field = self._routing_field
+        if field is None:
+            return
+        routing = self._routing_value(getattr(self, field, None))
+        if routing is None:
+            if self._routing_required:
+                raise JHTTPBadRequest(
+                    "'%s' requires value of routing field '%s'" % (
+                        self.__class__.__name__, field))
+            return
+        current = self.meta['routing'] if 'routing' in self.meta else None
+        if current is not None and current != routing:
+            raise JHTTPBadRequest(
+                "Routing field '%s' of '%s(%s)' can't be changed" % (
+                    field, self.__class__.__name__, self._id))
+        self.meta.routing = routing
+
+    def _get_index(self, index=None):
+        """ Get index of document. Documents of partitioned classes which
+        were not indexed yet go to partition of their partition field
+        value.
+        """
+        field = self._partition_field
+        if index is None and field is not None and 'index' not in self.meta:
+            value = getattr(self, field, None)
+            if value is None:
+                raise JHTTPBadRequest(
+                    "'%s' requires value of partition field '%s'" % (
+                        self.__class__.__name__, field))
+            return partition_name(
+                self._doc_type.index, value, self._partition_interval)
+        return super(BaseDocument, self)._get_index(index)
+
+    def _get_connection(self, using=None):
+        ensure_index()
+        return connections.get_connection(using or self._write_alias())
+    connection = property(_get_connection)
+
+    @classmethod
+    def search(cls, using=None, index=None):
+        ensure_index()
+        if index is None and cls._partition_field is not None:
+            index = partition_pattern(cls._doc_type.index)
+        return super(BaseDocument, cls).search(
+            using=using or cls._read_alias(), index=index)
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             pk_field = self.pk_field()
@@ -272,11 +473,49 @@ class BaseDocument(with_metaclass(
             if items:
                 self._d_[field_name] = items if field._multi else items[0]
 
-    def save(self, request=None, refresh=True, **kwargs):
-        super(BaseDocument, self).save(refresh=refresh, **kwargs)
+    def save(self, request=None, refresh=None, deferred=None, **kwargs):
+        """ Save document.
+
+        :param refresh: Whether to refresh index after save. Defaults to
+            ``elasticsearch.refresh_on_save`` setting, which defaults to
+            True. Setting is not applied to deferred writes. Refresh
+            is not needed to read saved documents by primary key because
+            ``get_item`` uses realtime GET, unless reads go to separate
+            cluster set with "elasticsearch.read_hosts". Documents are
+            not visible there until they are replicated, whether index
+            is refreshed or not.
+        :param deferred: Whether to put write on write-behind queue.
+        """
+        if refresh is not None:
+            kwargs['refresh'] = refresh
+        elif not self._is_deferred(deferred):
+            from nefertari_es import Settings
+            kwargs['refresh'] = Settings.asbool('refresh_on_save', True)
+        self._sync_routing()
+        self._set_pk_id()
+        super(BaseDocument, self).save(deferred=deferred, **kwargs)
         self._sync_id_field()
         return self
 
+    def _set_pk_id(self):
+        """ Use primary key as ID of not indexed document, so it can be
+        loaded with realtime GET.
+        """
+        if self._id is None and self.pk_field_type() is not IdField:
+            pk = getattr(self, self.pk_field(), None)
+            if pk is not None:
+                self._id = str(pk)
+
+    def asave(self, request=None, refresh=None, **kwargs):
+        """ Async counterpart of ``save``. Returns awaitable. """
+        from .aio import asave
+        return asave(self, refresh=refresh, **kwargs)
+
+    def adelete(self, request=None):
+        """ Async counterpart of ``delete``. Returns awaitable. """
+        from .aio import adelete
+        return adelete(self)
+
     def update(self, params, **kw):
         process_bools(params)
         _validate_fields(self.__class__, params.keys())
@@ -297,8 +536,9 @@ class BaseDocument(with_metaclass(
 
         return self.save(**kw)
 
-    def delete(self, request=None):
-        super(BaseDocument, self).delete()
+    def delete(self, request=None, deferred=None, **kwargs):
+        self._sync_routing()
+        super(BaseDocument, self).delete(deferred=deferred, **kwargs)
 
     def to_dict(self, include_meta=False, _keys=None, request=None,
                 _depth=None):
@@ -340,6 +580,8 @@ class BaseDocument(with_metaclass(
         data = super(BaseDocument, self).to_dict(include_meta=include_meta)
         data = {key: val for key, val in data.items()
                 if not key.startswith('__')}
+        if include_meta and self._partition_field is not None:
+            data['_index'] = self._get_index()
 
         if request is not None and '_type' not in data:
             data['_type'] = self.__class__.__name__
@@ -391,21 +633,193 @@ class BaseDocument(with_metaclass(
         :returns: Single collection item as an instance of ``cls``.
         """
         kw.setdefault('_raise_on_empty', True)
+        doc_id, routing = cls._realtime_target(kw)
+        if doc_id is not None:
+            item = cls._get_realtime(
+                doc_id, _fields=kw.get('_fields'),
+                _strict=kw.get('_strict', True), routing=routing)
+            found, item = cls._check_realtime_item(item, doc_id, kw)
+            if found:
+                return item
         result = cls.get_collection(_limit=1, _item_request=True, **kw)
         return result[0]
 
     @classmethod
-    def _update_many(cls, items, params, request=None):
+    def _realtime_target(cls, kw):
+        """ Get document ID and routing key to load document matching
+        ``get_item`` params :kw: with realtime GET.
+
+        :returns: Tuple of (document ID, routing). Document ID is None
+            when document can only be found by search.
+        """
+        doc_id = cls._pk_lookup_id(kw)
+        # Partition of document is not known from its ID
+        if doc_id is None or cls._partition_field is not None:
+            return None, None
+        routing = None
+        field = cls._routing_field
+        if field is not None:
+            routing = cls._pinned_routing(kw)
+            # Document can't be found by ID alone when routing is
+            # required, and GET accepts one routing key only
+            if routing is None and (cls._routing_required or field in kw):
+                return None, None
+            if routing is not None and len(cls._routing_values(kw)) > 1:
+                return None, None
+        return doc_id, routing
+
+    @classmethod
+    def _check_realtime_item(cls, item, doc_id, kw):
+        """ Check :item: loaded by realtime GET of :doc_id: for
+        ``get_item`` params :kw:.
+
+        :returns: Tuple of (found, item). When found is False, document
+            should be looked up with search.
+        :raises JHTTPNotFound: If document does not exist and
+            ``_raise_on_empty`` param is True.
+        """
+        id_pk = cls.pk_field_type() is IdField
+        pk_field = cls.pk_field()
+        if item is not None and not id_pk and pk_field in kw:
+            # Primary key of document could be changed after it was
+            # indexed with ID of previous value
+            value = getattr(item, pk_field, None)
+            if value is None or str(value) != doc_id:
+                return False, None
+        field = cls._routing_field
+        if item is not None and field is not None and field in kw:
+            # Document with the same ID may belong to another routing
+            # value, e.g. when it was routed by ID only
+            value = cls._routing_value(getattr(item, field, None))
+            if value not in (cls._routing_values(kw) or ()):
+                return False, None
+        # Documents with not IdField primary key which were indexed
+        # before their _id was set to primary key can only be found
+        # by search
+        if item is None and not id_pk:
+            return False, None
+        if item is None and kw['_raise_on_empty']:
+            msg = "'%s(%s)' resource not found" % (cls.__name__, doc_id)
+            raise JHTTPNotFound(msg)
+        return True, item
+
+    @classmethod
+    def _pk_lookup_id(cls, params):
+        """ Get document ID from :params: if they only look up a single
+        document by primary key or ``_id``. Returns None otherwise.
+        """
+        reserved = ('_raise_on_empty', '_fields', '_strict', '_item_request',
+                    cls._routing_field)
+        query = [key for key in params
+                 if key not in reserved and not key.startswith('__')]
+        if len(query) != 1 or query[0] not in (cls.pk_field(), '_id'):
+            return None
+        value = params[query[0]]
+        if isinstance(value, (list, tuple, AttrList)):
+            if len(value) != 1:
+                return None
+            value = value[0]
+        if value in (None, '', '_all'):
+            return None
+        return str(value)
+
+    @classmethod
+    def _routing_values(cls, params):
+        """ Get sorted routing keys from :params: if they pin routing
+        field to one or more values. Returns None otherwise.
+        """
+        value = params.get(cls._routing_field)
+        if not isinstance(value, (list, tuple, AttrList)):
+            value = [value]
+        routing = [cls._routing_value(val) for val in value]
+        if not routing or None in routing:
+            return None
+        return sorted(set(routing))
+
+    @classmethod
+    def _pinned_routing(cls, params):
+        """ Get comma-separated routing key from :params: if they pin
+        routing field to one or more values. Returns None otherwise.
+        """
+        routing = cls._routing_values(params)
+        if routing is None:
+            return None
+        return ','.join(routing)
+
+    @classmethod
+    def _get_realtime(cls, doc_id, _fields=None, _strict=True, using=None,
+                      routing=None, index=None):
+        """ Get document by ID with realtime GET API.
+
+        Unlike search, realtime GET sees documents right after they are
+        indexed, without waiting for index refresh. It only sees them on
+        the cluster they were written to, so documents written to
+        primary cluster are not seen on read cluster set with
+        "elasticsearch.read_hosts" until they are replicated.
+
+        :param _fields: Names of fields to include or exclude from
+            loaded document source. Fields to exclude should be prefixed
+            with "-".
+        :param using: Alias of connection to use. Defaults to read
+            connection.
+        :param routing: Routing key of document.
+        :param index: Index of document. Defaults to index of ``cls``.
+        :returns: Instance of ``cls`` or None if document is not found.
+        """
+        ensure_index()
+        es = connections.get_connection(using or cls._read_alias())
+        doc = es.get(
+            index=index or cls._doc_type.index,
+            doc_type=cls._doc_type.name,
+            id=doc_id,
+            ignore=404,
+            **cls._get_params(_fields, _strict, routing))
+        if not doc.get('found'):
+            return None
+        return cls.from_es(doc)
+
+    @classmethod
+    def _get_params(cls, _fields=None, _strict=True, routing=None):
+        """ Get params of GET API request for document with :routing:
+        which loads :_fields:.
+        """
+        params = {}
+        if routing is not None:
+            params['routing'] = routing
+        if _fields:
+            include, exclude = process_fields(_fields)
+            if _strict:
+                _validate_fields(cls, include + exclude)
+            if include:
+                params['_source_include'] = include
+            if exclude:
+                params['_source_exclude'] = exclude
+        return params
+
+    @classmethod
+    def aget_item(cls, **kw):
+        """ Async counterpart of ``get_item``. Returns awaitable. """
+        from .aio import aget_item
+        return aget_item(cls, **kw)
+
+    @classmethod
+    def _update_many(cls, items, params, request=None, deferred=None):
         params = cls._flatten_relationships(params)
         if not items:
             return
 
-        actions = [item.to_dict(include_meta=True) for item in items]
+        actions = []
+        for item in items:
+            item._sync_routing()
+            actions.append(item.to_dict(include_meta=True))
         actions_count = len(actions)
         for action in actions:
             action.pop('_source')
             action['doc'] = params
         client = items[0].connection
+        if items[0]._is_deferred(deferred):
+            _defer_actions(actions, client, op_type='update')
+            return actions_count
         operation = partial(
             _bulk,
             client=client, op_type='update', request=request)
@@ -413,13 +827,19 @@ class BaseDocument(with_metaclass(
         return actions_count
 
     @classmethod
-    def _delete_many(cls, items, request=None):
+    def _delete_many(cls, items, request=None, deferred=None):
         if not items:
             return
 
-        actions = [item.to_dict(include_meta=True) for item in items]
+        actions = []
+        for item in items:
+            item._sync_routing()
+            actions.append(item.to_dict(include_meta=True))
         actions_count = len(actions)
         client = items[0].connection
+        if items[0]._is_deferred(deferred):
+            _defer_actions(actions, client, op_type='delete')
+            return actions_count
         operation = partial(
             _bulk,
             client=client, op_type='delete', request=request)
@@ -505,7 +925,56 @@ class BaseDocument(with_metaclass(
             or ``sqlalchemy.exc.IntegrityError`` errors happen during DB
             query.
         """
-        search_obj = cls.search()
+        search_obj, _start, params = cls._build_search(
+            _strict=_strict, _fields=_fields, _limit=_limit, _page=_page,
+            _start=_start, _search_fields=_search_fields, q=q,
+            **params)
+
+        if _count:
+            return _count_search(search_obj)
+
+        if _explain:
+            return search_obj.to_dict()
+
+        search_obj = cls._sort_search(search_obj, _sort, _strict)
+        slow_log = get_slow_query_log()
+        if slow_log.enabled:
+            start = time.time()
+            response = search_obj.execute()
+            slow_log.check(cls, search_obj, response, time.time() - start)
+        else:
+            response = search_obj.execute()
+        hits = response.hits
+        return cls._process_hits(
+            hits, params, _start=_start, _fields=_fields,
+            _raise_on_empty=_raise_on_empty)
+
+    @classmethod
+    def aget_collection(cls, **params):
+        """ Async counterpart of ``get_collection``. Returns awaitable.
+
+        Requires Python 3.5+ and ``aiohttp``.
+        """
+        from .aio import aget_collection
+        return aget_collection(cls, **params)
+
+    @classmethod
+    def _build_search(cls, _strict=True, _fields=None, _limit=None,
+                      _page=None, _start=None, _search_fields=None,
+                      q=None, **params):
+        """ Build search object from ``get_collection`` params.
+
+        :returns: Tuple of (search object, results offset, cleaned
+            query params).
+        """
+        date_range = partitions = None
+        if cls._partition_field is not None:
+            date_range, partitions = cls._partition_search(params)
+        if partitions is None:
+            search_obj = cls.search()
+        else:
+            search_obj = cls.search(index=partitions).params(
+                ignore_unavailable=True)
 
         if _limit is not None:
             _start, limit = process_limit(_start, _page, _limit)
@@ -524,6 +993,16 @@ class BaseDocument(with_metaclass(
             params = _restructure_params(cls, params)
             if params:
                 search_obj = search_obj.filter('terms', **params)
+            # Only search shards documents with pinned routing values
+            # live on
+            if cls._routing_field in params:
+                routing = cls._pinned_routing(params)
+                if routing is not None:
+                    search_obj = search_obj.params(routing=routing)
+
+        if date_range:
+            search_obj = search_obj.filter(
+                'range', **{cls._partition_field: date_range})
 
         if q is not None:
             query_kw = {'query': q}
@@ -531,12 +1010,48 @@ class BaseDocument(with_metaclass(
                 query_kw['fields'] = _search_fields.split(',')
             search_obj = search_obj.query('query_string', **query_kw)
 
-        if _count:
-            return search_obj.count()
+        return search_obj, _start, params
 
-        if _explain:
-            return search_obj.to_dict()
+    @classmethod
+    def _partition_search(cls, params):
+        """ Pop range params of partition field from :params: and get
+        partitions search can be narrowed to.
+
+        Range params are "<field>__gte", "<field>__gt", "<field>__lte"
+        and "<field>__lt".
 
+        :returns: Tuple of (range filter dict, list of partition names
+            or None if all partitions should be searched).
+        """
+        field = cls._partition_field
+        base = cls._doc_type.index
+        interval = cls._partition_interval
+        date_range = {}
+        for op in ('gte', 'gt', 'lte', 'lt'):
+            key = '{}__{}'.format(field, op)
+            if key in params:
+                date_range[op] = params.pop(key)
+
+        values = params.get(field)
+        start = date_range.get('gte', date_range.get('gt'))
+        end = date_range.get('lte', date_range.get('lt'))
+        try:
+            if values is not None and values != '_all':
+                if not isinstance(values, (list, tuple, AttrList)):
+                    values = [values]
+                names = {partition_name(base, val, interval)
+                         for val in values}
+                return date_range, sorted(names)
+            if start is None or end is None:
+                return date_range, None
+            return date_range, partition_names(base, start, end, interval)
+        except (ValueError, OverflowError, AttributeError):
+            # Values ES understands but partitions can't be computed
+            # from, e.g. date math like "now-7d"
+            return date_range, None
+
+    @classmethod
+    def _sort_search(cls, search_obj, _sort=None, _strict=True):
         if _sort:
             sort_fields = split_strip(_sort)
             if _strict:
@@ -544,8 +1059,12 @@ class BaseDocument(with_metaclass(
                     cls,
                     [f[1:] if f.startswith('-') else f for f in sort_fields])
             search_obj = search_obj.sort(*sort_fields)
+        return search_obj
 
-        hits = search_obj.execute().hits
+    @classmethod
+    def _process_hits(cls, hits, params, _start=None, _fields=None,
+                      _raise_on_empty=False):
+        """ Check and annotate hits returned by executed search. """
         if not hits and _raise_on_empty:
             msg = "'%s(%s)' resource not found" % (cls.__name__, params)
             raise JHTTPNotFound(msg)
@@ -583,8 +1102,39 @@ class BaseDocument(with_metaclass(
         return field in cls._doc_type.mapping
 
     @classmethod
-    def get_or_create(cls, **params):
+    def get_or_create(cls, _atomic=False, **params):
+        """ Get document matching :params: or create a new one.
+
+        :param bool _atomic: When True, document is looked up and
+            created in a single round trip which is safe against
+            concurrent callers. Document ID is derived from :params:
+            (see ``_lookup_id``) and document is indexed synchronously
+            with ``op_type=create``, even if writes of the class are
+            deferred. When such document already exists, it is
+            loaded with realtime GET. Documents created in this mode can
+            only be found by the same mode, unless primary key is an
+            IdField and it is present in :params:.
+        :returns: Tuple of (document, created flag).
+        """
         defaults = params.pop('defaults', {})
+        if _atomic:
+            obj = cls._new_lookup_doc(params, defaults)
+            try:
+                # Write-behind queue can't report conflicts
+                obj.save(op_type='create', deferred=False)
+            except JHTTPConflict:
+                # Read from write connection which has just seen the
+                # conflicting document
+                index = routing = None
+                if cls._partition_field is not None:
+                    index = obj._get_index()
+                if 'routing' in obj.meta:
+                    routing = obj.meta['routing']
+                return cls._get_realtime(
+                    obj._id, using=cls._write_alias(), index=index,
+                    routing=routing), False
+            return obj, True
+
         items = cls.get_collection(_raise_on_empty=False, **params)
         if not items:
             defaults.update(params)
@@ -594,6 +1144,90 @@ class BaseDocument(with_metaclass(
         else:
             return items[0], False
 
+    @classmethod
+    def get_or_create_many(cls, params_list, request=None):
+        """ Batch version of ``get_or_create(_atomic=True, ...)``.
+
+        Missing documents are created with a bulk request and existing
+        documents are loaded with a single multi-get request.
+
+        :param params_list: Sequence of lookup params dicts. Each dict
+            may contain "defaults" key.
+        :returns: List of (document, created flag) tuples in the order
+            of :params_list:.
+        """
+        docs = []
+        for params in params_list:
+            params = params.copy()
+            defaults = params.pop('defaults', {})
+            docs.append(cls._new_lookup_doc(params, defaults))
+        if not docs:
+            return []
+
+        actions = []
+        for obj in docs:
+            obj.full_clean()
+            obj._sync_routing()
+            actions.append(obj.to_dict(include_meta=True))
+        client = docs[0].connection
+        results = _bulk_create(actions, client, request=request)
+
+        existing_docs = [
+            obj for obj, created in zip(docs, results) if not created]
+        existing = {}
+        if existing_docs:
+            if cls._routing_field is None and cls._partition_field is None:
+                body = {'ids': [obj._id for obj in existing_docs]}
+            else:
+                body = {'docs': [
+                    obj._mget_doc() for obj in existing_docs]}
+            response = client.mget(
+                index=docs[0]._get_index(),
+                doc_type=cls._doc_type.name,
+                body=body)
+            existing = {
+                doc['_id']: cls.from_es(doc)
+                for doc in response['docs'] if doc.get('found')}
+
+        result = []
+        for obj, created in zip(docs, results):
+            if created:
+                obj._sync_id_field()
+                result.append((obj, True))
+            else:
+                result.append((existing.get(obj._id), False))
+        return result
+
+    def _mget_doc(self):
+        """ Get multi-get API doc spec which locates this document. """
+        doc = {'_id': self._id, '_index': self._get_index()}
+        if 'routing' in self.meta:
+            doc['_routing'] = self.meta['routing']
+        return doc
+
+    @classmethod
+    def _lookup_id(cls, params):
+        """ Get deterministic document ID for lookup :params:.
+
+        Primary key value is used when present in :params:. Otherwise ID
+        is a hash of the class name and sorted :params:.
+        """
+        pk_field = cls.pk_field()
+        if params.get(pk_field) is not None:
+            return str(params[pk_field])
+        key = json.dumps(
+            [cls.__name__, sorted(params.items())], default=str)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _new_lookup_doc(cls, params, defaults):
+        doc_id = cls._lookup_id(params)
+        values = dict(defaults)
+        values.update(params)
+        if cls.pk_field_type() is IdField:
+            values.pop(cls.pk_field(), None)
+        return cls(_id=doc_id, **values)
+
     @classmethod
     def get_null_values(cls):
         """ Get null values of :cls: fields. """
@@ -653,12 +1287,14 @@ class BaseDocument(with_metaclass(
 
             setattr(self, attr, final_value)
             if save:
-                self.save(request)
+                self._save_iterable(
+                    attr, DICT_UPDATE_SCRIPT, request=request,
+                    set_values={str(key): update_params[key]
+                                for key in positive},
+                    remove=negative)
 
         def update_list(update_params):
-            final_value = getattr(self, attr, []) or []
-            final_value = list(final_value)
-            final_value = copy.deepcopy(final_value)
+            final_value = list(getattr(self, attr, []) or [])
             if update_params in (None, '', []):
                 if not final_value:
                     return
@@ -675,15 +1311,25 @@ class BaseDocument(with_metaclass(
 
             if positive:
                 if unique:
-                    positive = [v for v in positive if v not in final_value]
+                    existing = set(final_value)
+                    unique_positive = []
+                    for val in positive:
+                        if val not in existing:
+                            existing.add(val)
+                            unique_positive.append(val)
+                    positive = unique_positive
                 final_value += positive
 
             if negative:
-                final_value = list(set(final_value) - set(negative))
+                negative_set = set(negative)
+                final_value = [
+                    val for val in final_value if val not in negative_set]
 
             setattr(self, attr, final_value)
             if save:
-                self.save(request)
+                self._save_iterable(
+                    attr, LIST_UPDATE_SCRIPT, request=request,
+                    add=positive, remove=negative, unique=unique)
 
         if is_dict:
             update_dict(params)
@@ -691,6 +1337,57 @@ class BaseDocument(with_metaclass(
         elif is_list:
             update_list(params)
 
+    def _save_iterable(self, attr, script, request=None,
+                       retry_on_conflict=3, **script_params):
+        """ Save changes made to iterable field :attr:.
+
+        Not yet indexed documents are saved as a whole. Indexed
+        documents are changed with a scripted partial update, so
+        concurrent changes to the same field are not overwritten. Local
+        field value is then set to the value stored in ES.
+
+        Documents are saved as a whole when "elasticsearch.scripted_updates"
+        setting is false or ES has inline scripting disabled.
+        """
+        global _scripting_disabled
+        from nefertari_es import Settings
+        scripted = Settings.asbool('scripted_updates', True)
+        if self._id is None or not scripted or _scripting_disabled:
+            return self.save(request)
+
+        self._sync_routing()
+        version = self.version
+        self._bump_version()
+        script_params['field'] = attr
+        doc_meta = dict(
+            (key, self.meta[key]) for key in ('parent', 'routing')
+            if key in self.meta)
+        try:
+            response = self.connection.update(
+                index=self._get_index(),
+                doc_type=self._doc_type.name,
+                id=self._id,
+                body={'script': script, 'params': script_params},
+                retry_on_conflict=retry_on_conflict,
+                refresh=Settings.asbool('refresh_on_save', True),
+                fields='_source',
+                **doc_meta)
+        except JHTTPBadRequest as ex:
+            if not _is_scripting_disabled_error(ex):
+                raise
+            log.warning('Inline scripting is disabled in ES, saving '
+                        'iterable fields with full document saves')
+            _scripting_disabled = True
+            self.version = version
+            return self.save(request)
+        if '_version' in response:
+            self.meta.version = response['_version']
+        source = response.get('get', {}).get('_source', {})
+        for name in (attr, 'version'):
+            if name in source:
+                self._d_[name] = source[name]
+        return self
+
     def _is_modified(self):
         """ Determine if instance is modified.
 
@@ -702,6 +1399,23 @@ class BaseDocument(with_metaclass(
         return self._created
 
 
+def _count_search(search_obj):
+    """ Count hits of :search_obj: passing its routing and index
+    options to count API.
+    """
+    params = {key: search_obj._params[key]
+              for key in ('routing', 'ignore_unavailable')
+              if key in search_obj._params}
+    if not params:
+        return search_obj.count()
+    es = connections.get_connection(search_obj._using)
+    return es.count(
+        index=search_obj._index,
+        doc_type=search_obj._doc_type,
+        body=search_obj.to_dict(count=True),
+        **params)['count']
+
+
 def _cleaned_query_params(cls, params, strict):
     params = {
         key: val for key, val in params.items()
@@ -766,10 +1480,57 @@ def _perform_in_chunks(actions, operation, chunk_size=None):
         count -= chunk_size
 
 
-def _bulk(actions, client, op_type='index', request=None):
+def _bulk_create(actions, client, request=None):
+    """ Perform bulk "create" :actions: using :client:.
+
+    Unlike ``_bulk``, version conflicts are not treated as errors.
+
+    :returns: List of flags indicating whether document of each action
+        was created.
+    """
     from nefertari_es import Settings
     for action in actions:
-        action['_op_type'] = op_type
+        action['_op_type'] = 'create'
+
+    kwargs = {}
+    if request is not None:
+        query_params = dictset(request.params.mixed())
+        refresh_enabled = Settings.asbool('enable_refresh_query', False)
+        if '_refresh_index' in query_params and refresh_enabled:
+            kwargs['refresh'] = query_params.asbool('_refresh_index')
+
+    results = []
+    errors = []
+    for ok, item in helpers.streaming_bulk(
+            client, actions, raise_on_error=False,
+            chunk_size=Settings.asint('chunk_size', 500), **kwargs):
+        info = item['create']
+        if not ok and info.get('status') != 409:
+            errors.append(str(info.get('error')))
+        results.append(ok)
+
+    if errors:
+        raise Exception('Errors happened when executing Elasticsearch '
+                        'actions: {}'.format('; '.join(errors)))
+    return results
+
+
+def _defer_actions(actions, client, op_type):
+    write_queue = get_write_queue()
+    for action in actions:
+        write_queue.put(action, client, op_type=op_type)
+
+
+def _bulk(actions, client, op_type='index', request=None):
+    """ Perform bulk :actions: using :client:.
+
+    :param op_type: Operation type set on each action. When None,
+        ``_op_type`` already set on actions is used.
+    """
+    from nefertari_es import Settings
+    if op_type is not None:
+        for action in actions:
+            action['_op_type'] = op_type
 
     kwargs = {
         'client': client,
@@ -1,33 +1,115 @@
 import datetime
-from dateutil import parser
+import re
+from dateutil import parser, tz
+from numbers import Number
 
+import six
 from elasticsearch_dsl import field
 from elasticsearch_dsl.exceptions import ValidationException
 from elasticsearch_dsl.utils import AttrList, AttrDict
 
 
+def _is_bool(value):
+    return isinstance(value, bool)
+
+
+def _is_string(value):
+    return isinstance(value, six.string_types)
+
+
+def _is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def _is_int(value):
+    return isinstance(value, six.integer_types) and not _is_bool(value)
+
+
+def _is_strings(value):
+    return _is_string(value) or (
+        isinstance(value, (list, tuple)) and all(map(_is_string, value)))
+
+
+def _is_subfields(value):
+    return isinstance(value, dict) and all(map(_is_string, value))
+
+
+# Mapping options fields accept, mapped to validators of their values.
+# "index" accepts booleans of ES 5+ and strings of older versions
+MAPPING_OPTIONS = {
+    'index': lambda val: (
+        _is_bool(val) or val in ('no', 'not_analyzed', 'analyzed')),
+    'doc_values': _is_bool,
+    'store': _is_bool,
+    'include_in_all': _is_bool,
+    'boost': _is_number,
+    'null_value': lambda val: True,
+    'copy_to': _is_strings,
+    'fields': _is_subfields,
+}
+
+STRING_MAPPING_OPTIONS = dict(
+    MAPPING_OPTIONS,
+    norms=lambda val: _is_bool(val) or isinstance(val, dict),
+    eager_global_ordinals=_is_bool,
+    analyzer=_is_string,
+    search_analyzer=_is_string,
+    ignore_above=_is_int,
+    index_options=lambda val: val in (
+        'docs', 'freqs', 'positions', 'offsets'),
+)
+
+DATE_MAPPING_OPTIONS = dict(
+    MAPPING_OPTIONS,
+    format=_is_string,
+    ignore_malformed=_is_bool,
+)
+
+OBJECT_MAPPING_OPTIONS = {
+    'enabled': _is_bool,
+    'dynamic': lambda val: _is_bool(val) or val == 'strict',
+    'include_in_all': _is_bool,
+}
+
+ALL_MAPPING_OPTIONS = frozenset().union(
+    STRING_MAPPING_OPTIONS, DATE_MAPPING_OPTIONS, OBJECT_MAPPING_OPTIONS)
+
+
 class CustomMappingMixin(object):
     """ Mixin that allows to define custom ES field mapping.
 
     Set mapping to "_custom_mapping" attribute. Defaults to None, in
     which case default field mapping is used. Custom mapping extends
-    default mapping.
+    default mapping. Mapping options passed to field override custom
+    mapping.
     """
     _custom_mapping = None
 
     def to_dict(self, *args, **kwargs):
         data = super(CustomMappingMixin, self).to_dict(*args, **kwargs)
         if self._custom_mapping is not None:
-            data.update(self._custom_mapping)
+            options = getattr(self, '_mapping_kwargs', {})
+            data.update({key: val for key, val in self._custom_mapping.items()
+                         if key not in options})
         return data
 
 
 class BaseFieldMixin(object):
+    """ Mixin that drops kwargs ES fields don't accept.
+
+    Mapping options, e.g. ``index=False``, ``doc_values=False``,
+    ``norms=False`` or ``fields={'raw': KeywordField()}``, are passed
+    to generated mapping. Options accepted by field are set in
+    ``_mapping_options``, which defaults to options of field type.
+    """
     _valid_kwargs = ('primary_key', 'required', 'multi')
+    _mapping_options = None
 
     def __init__(self, *args, **kwargs):
         self._init_kwargs = kwargs.copy()
+        self._mapping_kwargs = self.validate_mapping_kwargs(kwargs)
         kwargs = self.drop_invalid_kwargs(kwargs)
+        kwargs.update(self._mapping_kwargs)
         self._primary_key = kwargs.pop('primary_key', False)
         if self._primary_key:
             kwargs['required'] = True
@@ -37,6 +119,38 @@ class BaseFieldMixin(object):
         return {key: val for key, val in kwargs.items()
                 if key in self._valid_kwargs}
 
+    def get_mapping_options(self):
+        if self._mapping_options is not None:
+            return self._mapping_options
+        if isinstance(self, field.String):
+            return STRING_MAPPING_OPTIONS
+        if isinstance(self, field.Object):
+            return OBJECT_MAPPING_OPTIONS
+        return MAPPING_OPTIONS
+
+    def validate_mapping_kwargs(self, kwargs):
+        """ Get mapping options from :kwargs:.
+
+        :raises ValueError: If mapping option is not supported by field
+            or its value is invalid.
+        """
+        options = self.get_mapping_options()
+        mapping_kwargs = {}
+        for key, val in kwargs.items():
+            if key not in ALL_MAPPING_OPTIONS:
+                continue
+            name = self.__class__.__name__
+            if key not in options:
+                raise ValueError(
+                    'Mapping option {!r} is not supported by {}'.format(
+                        key, name))
+            if not options[key](val):
+                raise ValueError(
+                    'Invalid value of {} mapping option {!r}: {!r}'.format(
+                        name, key, val))
+            mapping_kwargs[key] = val
+        return mapping_kwargs
+
 
 class IdField(CustomMappingMixin, BaseFieldMixin, field.String):
     """ Field that stores ID generated by ES. """
@@ -80,10 +194,50 @@ class DictField(CustomMappingMixin, BaseFieldMixin, field.Object):
         self._doc_class = CustomInnerObjectWrapper
 
 
+# Formats values are written in by ``JSONSerializer``
+_ISO_DATETIME = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(Z?)$')
+_ISO_TIME = re.compile(r'^(\d{2}):(\d{2}):(\d{2})$')
+_UTC = tz.tzutc()
+
+
+def _parse_datetime(data):
+    """ Parse datetime from string :data:.
+
+    Values in "%Y-%m-%dT%H:%M:%SZ" format are parsed directly, other
+    values are parsed with ``dateutil``.
+    """
+    match = _ISO_DATETIME.match(data) if _is_string(data) else None
+    if match is not None:
+        parts = match.groups()
+        try:
+            return datetime.datetime(
+                *map(int, parts[:6]), tzinfo=_UTC if parts[6] else None)
+        except ValueError:
+            pass
+    return parser.parse(data)
+
+
+def _parse_time(data):
+    """ Parse time from string :data:.
+
+    Values in "%H:%M:%S" format are parsed directly, other values are
+    parsed with ``dateutil``.
+    """
+    match = _ISO_TIME.match(data) if _is_string(data) else None
+    if match is not None:
+        try:
+            return datetime.time(*map(int, match.groups()))
+        except ValueError:
+            pass
+    return parser.parse(data).time()
+
+
 class DateTimeField(CustomMappingMixin, BaseFieldMixin, field.Field):
     name = 'datetime'
     _coerce = True
     _custom_mapping = {'type': 'date', 'format': 'dateOptionalTime'}
+    _mapping_options = DATE_MAPPING_OPTIONS
 
     def _to_python(self, data):
         if not data:
@@ -91,7 +245,7 @@ class DateTimeField(CustomMappingMixin, BaseFieldMixin, field.Field):
         if isinstance(data, datetime.datetime):
             return data
         try:
-            return parser.parse(data)
+            return _parse_datetime(data)
         except Exception as e:
             raise ValidationException(
                 'Could not parse datetime from the value (%r)' % data, e)
@@ -99,12 +253,14 @@ class DateTimeField(CustomMappingMixin, BaseFieldMixin, field.Field):
 
 class DateField(CustomMappingMixin, BaseFieldMixin, field.Date):
     _custom_mapping = {'type': 'date', 'format': 'dateOptionalTime'}
+    _mapping_options = DATE_MAPPING_OPTIONS
 
 
 class TimeField(CustomMappingMixin, BaseFieldMixin, field.Field):
     name = 'time'
     _coerce = True
     _custom_mapping = {'type': 'date', 'format': 'HH:mm:ss'}
+    _mapping_options = DATE_MAPPING_OPTIONS
 
     def _to_python(self, data):
         if not data:
@@ -114,7 +270,7 @@ class TimeField(CustomMappingMixin, BaseFieldMixin, field.Field):
         if isinstance(data, datetime.datetime):
             return data.time()
         try:
-            return parser.parse(data).time()
+            return _parse_time(data)
         except Exception as e:
             raise ValidationException(
                 'Could not parse time from the value (%r)' % data, e)
@@ -144,6 +300,16 @@ class UnicodeTextField(BaseFieldMixin, field.String):
     pass
 
 
+class KeywordField(CustomMappingMixin, BaseFieldMixin, field.String):
+    """ Not analyzed string field. Mostly used as subfield of analyzed
+    string fields, e.g. ``StringField(fields={'raw': KeywordField()})``.
+
+    Mapped as "string" with ``index='not_analyzed'``, which ES 1.x and
+    2.x support, rather than "keyword" type of ES 5+.
+    """
+    _custom_mapping = {'index': 'not_analyzed'}
+
+
 class BigIntegerField(BaseFieldMixin, field.Long):
     pass
 
@@ -0,0 +1,707 @@
+""" Alias-based index management.
+
+Document classes are bound to an alias, which points to a versioned
+physical index named "<alias>_v<version>". Mapping changes are rolled
+out by reindexing documents into next index version and atomically
+moving alias to it.
+
+Also contains helpers to keep index settings and mappings up to date,
+to put index into bulk load mode and to manage time-partitioned
+indices.
+"""
+import datetime
+import errno
+import json
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import six
+from dateutil import parser, tz
+from elasticsearch import helpers
+from elasticsearch_dsl.connections import connections
+from nefertari.json_httpexceptions import JHTTPNotFound
+
+from .meta import create_index, get_index_classes, get_index_settings
+
+
+log = logging.getLogger(__name__)
+
+# Index settings which can only be set when index is created. Names
+# are relative to "index." and match nested settings too
+STATIC_SETTINGS = (
+    'number_of_shards', 'codec', 'analysis', 'routing_partition_size',
+    'shard.check_on_startup',
+)
+
+# Settings set by ES which can't be set by user
+_INTERNAL_SETTINGS = ('creation_date', 'uuid', 'version', 'provided_name')
+
+# Settings changed by ``bulk_load_mode``, mapped to values ES uses when
+# they are not set
+BULK_LOAD_SETTINGS = {
+    'refresh_interval': '1s',
+    'number_of_replicas': '1',
+}
+
+
+def versioned_name(alias, version):
+    return '{}_v{}'.format(alias, version)
+
+
+def get_alias_indices(alias, using='default'):
+    """ Get names of indices :alias: points to. """
+    conn = connections.get_connection(using)
+    try:
+        return sorted(conn.indices.get_alias(name=alias))
+    except JHTTPNotFound:
+        return []
+
+
+def next_index_name(alias, using='default'):
+    """ Get name of next version of physical index behind :alias:. """
+    conn = connections.get_connection(using)
+    pattern = re.compile(r'^{}_v(\d+)$'.format(re.escape(alias)))
+    versions = [0]
+    for name in conn.indices.get_settings(index=alias + '_v*'):
+        match = pattern.match(name)
+        if match is not None:
+            versions.append(int(match.group(1)))
+    return versioned_name(alias, max(versions) + 1)
+
+
+def create_versioned_index(alias, doc_classes=None, using='default',
+                           add_alias=True):
+    """ Create next version of index behind :alias:.
+
+    :param doc_classes: Document classes to add to created index.
+        Defaults to None, in which case document classes placed in
+        :alias: are added.
+    :param add_alias: Whether to point :alias: to created index. Should
+        only be True when :alias: does not exist yet.
+    :returns: Name of created index.
+    """
+    if doc_classes is None:
+        from nefertari_es import Settings
+        doc_classes = get_index_classes(alias, Settings.get('index_name'))
+    index_name = next_index_name(alias, using)
+    create_index(
+        index_name, doc_classes, aliases=[alias] if add_alias else None)
+    for doc_cls in doc_classes:
+        doc_cls._doc_type.index = alias
+    return index_name
+
+
+def flatten_settings(index_settings, prefix=''):
+    """ Flatten nested :index_settings: into dict with dotted keys
+    relative to "index.". Values are converted to strings the way ES
+    returns them.
+    """
+    flat = {}
+    for name, value in index_settings.items():
+        name = prefix + name
+        if not prefix and name.startswith('index.'):
+            name = name[len('index.'):]
+        if name == 'index' and isinstance(value, dict):
+            flat.update(flatten_settings(value))
+        elif isinstance(value, dict):
+            flat.update(flatten_settings(value, name + '.'))
+        elif isinstance(value, (list, tuple)):
+            flat[name] = [_setting_str(val) for val in value]
+        else:
+            flat[name] = _setting_str(value)
+    return flat
+
+
+def _setting_str(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _is_static(name):
+    return any(name == static or name.startswith(static + '.')
+               for static in STATIC_SETTINGS)
+
+
+def diff_index_settings(current, desired):
+    """ Compare :current: index settings with :desired: ones.
+
+    :returns: Tuple of (dict of changed dynamic settings, sorted list of
+        names of changed static settings).
+    """
+    current = flatten_settings(current)
+    dynamic = {}
+    static = []
+    for name, value in flatten_settings(desired).items():
+        if name.split('.', 1)[0] in _INTERNAL_SETTINGS:
+            continue
+        if current.get(name) == value:
+            continue
+        if _is_static(name):
+            static.append(name)
+        else:
+            dynamic[name] = value
+    return dynamic, sorted(static)
+
+
+def update_index_settings(index_name, index_settings, using='default'):
+    """ Update settings of existing index or alias :index_name: to
+    match :index_settings:.
+
+    Dynamic settings are updated in place. Static settings can't be
+    changed on existing index, so their changes are only logged and
+    are applied by ``reindex``.
+
+    :returns: Dict of {physical index name: dict of updated settings}.
+    """
+    conn = connections.get_connection(using)
+    response = conn.indices.get_settings(index=index_name)
+    updated = {}
+    for name, data in sorted(response.items()):
+        dynamic, static = diff_index_settings(
+            data.get('settings', {}), index_settings)
+        if static:
+            log.warning(
+                'Settings {} of index {} can only be changed by '
+                'reindexing'.format(', '.join(static), name))
+        if dynamic:
+            log.info('Updating settings of index {}: {}'.format(
+                name, dynamic))
+            conn.indices.put_settings(index=name, body={'index': dynamic})
+            updated[name] = dynamic
+    return updated
+
+
+def _field_type(field):
+    if 'type' in field:
+        return field['type']
+    return 'object' if 'properties' in field else None
+
+
+def diff_mapping(live, desired, path=''):
+    """ Compare :live: mapping properties with :desired: ones.
+
+    :returns: Tuple of (properties which can be added to live mapping,
+        list of descriptions of changes which require reindexing).
+    """
+    additions = {}
+    conflicts = []
+    for name, field in desired.items():
+        field_path = path + name
+        current = live.get(name)
+        if current is None:
+            additions[name] = field
+            continue
+        field_type = _field_type(field)
+        if field_type != _field_type(current):
+            conflicts.append('{}: type {} -> {}'.format(
+                field_path, _field_type(current), field_type))
+            continue
+
+        addition = {}
+        for key in ('properties', 'fields'):
+            if key not in field:
+                continue
+            sub_additions, sub_conflicts = diff_mapping(
+                current.get(key, {}), field[key], field_path + '.')
+            conflicts.extend(sub_conflicts)
+            if sub_additions:
+                addition[key] = sub_additions
+        # Multi-fields are added along with type of their field
+        if 'fields' in addition:
+            addition['type'] = field_type
+        for key, value in sorted(field.items()):
+            if key in ('type', 'properties', 'fields'):
+                continue
+            if current.get(key) != value:
+                conflicts.append('{}: {} {!r} -> {!r}'.format(
+                    field_path, key, current.get(key), value))
+        if addition:
+            additions[name] = addition
+    return additions, conflicts
+
+
+def update_mappings(index_name, doc_classes, using='default'):
+    """ Add fields of :doc_classes: missing in mappings of existing
+    index or alias :index_name:.
+
+    Changes of existing fields can't be applied to existing index, so
+    they are only logged and are applied by ``reindex``.
+
+    :returns: Dict of {physical index name: {doc type: dict with
+        "added" list of added field names and "conflicts" list of
+        changes which require reindexing}}. Only includes doc types
+        which differ from live mappings.
+    """
+    conn = connections.get_connection(using)
+    response = conn.indices.get_mapping(index=index_name)
+    report = {}
+    for name, data in sorted(response.items()):
+        live_mappings = data.get('mappings', {})
+        for doc_cls in doc_classes:
+            doc_type = doc_cls._doc_type.name
+            desired = doc_cls._doc_type.mapping.to_dict()[doc_type]
+            live = live_mappings.get(doc_type)
+            if live is None:
+                body = desired
+                additions = desired.get('properties', {})
+                conflicts = []
+            else:
+                additions, conflicts = diff_mapping(
+                    live.get('properties', {}),
+                    desired.get('properties', {}))
+                body = {'properties': additions}
+            if conflicts:
+                log.warning(
+                    'Mapping of {} in index {} can only be changed by '
+                    'reindexing: {}'.format(
+                        doc_type, name, '; '.join(conflicts)))
+            if additions or live is None:
+                log.info('Adding fields to mapping of {} in index {}: '
+                         '{}'.format(doc_type, name,
+                                     ', '.join(sorted(additions))))
+                conn.indices.put_mapping(
+                    index=name, doc_type=doc_type, body={doc_type: body})
+            if additions or conflicts or live is None:
+                report.setdefault(name, {})[doc_type] = {
+                    'added': sorted(additions),
+                    'conflicts': conflicts,
+                }
+    return report
+
+
+def swap_alias(alias, index_name, using='default'):
+    """ Atomically point :alias: to :index_name: only.
+
+    :returns: Names of indices alias pointed to before.
+    """
+    conn = connections.get_connection(using)
+    old_indices = [name for name in get_alias_indices(alias, using)
+                   if name != index_name]
+    actions = [{'remove': {'index': name, 'alias': alias}}
+               for name in old_indices]
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    conn.indices.update_aliases(body={'actions': actions})
+    return old_indices
+
+
+def _copy_slice(conn, source, target, slice_id, slices, chunk_size,
+                counter):
+    """ Copy documents of one scroll slice from :source: to :target:. """
+    query = None
+    if slices > 1:
+        query = {'slice': {'id': slice_id, 'max': slices}}
+    hits = helpers.scan(
+        conn, query=query, index=source, size=chunk_size,
+        fields=['_source', '_routing', '_parent'])
+    actions = (_copy_action(hit, target) for hit in hits)
+    for ok, item in helpers.streaming_bulk(
+            conn, actions, chunk_size=chunk_size):
+        counter.add(1)
+
+
+def _copy_action(hit, target):
+    action = {
+        '_index': target,
+        '_type': hit['_type'],
+        '_id': hit['_id'],
+        '_source': hit['_source'],
+    }
+    # Depending on ES version, metadata is returned as hit keys or
+    # in hit fields
+    fields = hit.get('fields', {})
+    for key in ('_parent', '_routing'):
+        value = hit.get(key, fields.get(key))
+        if value is not None:
+            action[key] = value
+    return action
+
+
+class _Counter(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def add(self, num):
+        with self._lock:
+            self.value += num
+
+
+def reindex(alias, doc_classes=None, slices=1, chunk_size=500,
+            using='default', report_interval=5.0, progress=None,
+            delete_old=False):
+    """ Reindex documents behind :alias: into new index version and
+    move alias to it.
+
+    Documents are copied by :slices: threads in parallel, each reading
+    its own slice of sliced scroll (requires ES 5.0+ when :slices: is
+    greater than 1). Documents written through alias while copy is in
+    progress are not copied, so writes should be paused.
+
+    :param alias: Alias to reindex.
+    :param doc_classes: Document classes whose mappings new index gets.
+        Defaults to all document classes.
+    :param slices: Number of parallel copy workers.
+    :param chunk_size: Number of documents read and written per request.
+    :param report_interval: Number of seconds between progress reports.
+    :param progress: Callable called with number of copied documents
+        and number of seconds passed on each progress report.
+    :param delete_old: Whether to delete indices alias pointed to
+        before.
+    :returns: Name of new index.
+    :raises ValueError: If :alias: is not an alias. Concrete index
+        can't be replaced by alias after copy.
+    """
+    conn = connections.get_connection(using)
+    if not get_alias_indices(alias, using):
+        raise ValueError('{} is not an alias'.format(alias))
+    target = create_versioned_index(
+        alias, doc_classes, using, add_alias=False)
+    log.info('Reindexing {} into {} with {} slices'.format(
+        alias, target, slices))
+
+    counter = _Counter()
+    errors = []
+
+    def worker(slice_id):
+        try:
+            _copy_slice(conn, alias, target, slice_id, slices,
+                        chunk_size, counter)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=worker, args=(slice_id,))
+               for slice_id in range(slices)]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(report_interval)
+            _report(counter.value, time.time() - start, progress)
+    if errors:
+        raise errors[0]
+
+    conn.indices.refresh(index=target)
+    old_indices = swap_alias(alias, target, using)
+    _report(counter.value, time.time() - start, progress)
+    log.info('Alias {} moved from {} to {}'.format(
+        alias, ', '.join(old_indices) or 'nothing', target))
+    if delete_old and old_indices:
+        conn.indices.delete(index=','.join(old_indices))
+    return target
+
+
+def _bulk_load_marker(index_name):
+    """ Get path of file which stores settings of index :index_name:
+    while it is in bulk load mode.
+
+    Files are stored in "elasticsearch.bulk_load_marker_dir" directory,
+    which defaults to system temp directory.
+    """
+    from nefertari_es import Settings
+    marker_dir = Settings.get('bulk_load_marker_dir') or tempfile.gettempdir()
+    return os.path.join(
+        marker_dir, 'nefertari_es_bulk_load_{}.json'.format(index_name))
+
+
+def _restore_settings(conn, saved):
+    for name, index_settings in sorted(saved.items()):
+        log.info('Restoring settings of index {}: {}'.format(
+            name, index_settings))
+        conn.indices.put_settings(index=name, body={'index': index_settings})
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+
+def _is_alive(owner):
+    """ Whether process :owner: of bulk load marker is running.
+
+    Processes on other hosts are considered running, as there is no way
+    to check them.
+    """
+    if owner.get('host') != socket.gethostname():
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+def _read_marker(marker):
+    """ Read bulk load :marker: file.
+
+    :returns: Tuple of (owner dict or None, saved settings) or None if
+        marker does not exist.
+    """
+    try:
+        with open(marker) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if 'owner' not in data:
+        # Written by older version, which did not record owner
+        return None, data
+    return data['owner'], data['settings']
+
+
+def recover_bulk_load(index_name, using='default', force=False):
+    """ Restore settings of index :index_name: left in bulk load mode
+    by process which crashed.
+
+    Marker of process which is still running, or runs on another host,
+    is left alone unless :force: is True.
+
+    :returns: True if settings were restored, False if index was not
+        in bulk load mode or its bulk load is still running.
+    """
+    marker = _bulk_load_marker(index_name)
+    data = _read_marker(marker)
+    if data is None:
+        return False
+    owner, saved = data
+    if owner is not None and not force and _is_alive(owner):
+        return False
+    log.warning('Index {} was left in bulk load mode, restoring '
+                'its settings'.format(index_name))
+    _restore_settings(connections.get_connection(using), saved)
+    _remove_file(marker)
+    return True
+
+
+def _create_marker(marker, index_name, using):
+    """ Exclusively create bulk load :marker: of this process, recovering
+    marker of crashed process.
+
+    :raises RuntimeError: If index is in bulk load mode of running
+        process.
+    """
+    owner = {'host': socket.gethostname(), 'pid': os.getpid()}
+    for _ in range(2):
+        try:
+            fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+            if not recover_bulk_load(index_name, using):
+                break
+            continue
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': owner, 'settings': {}}, f)
+        return owner
+    data = _read_marker(marker)
+    raise RuntimeError(
+        'Index {} is already in bulk load mode of {}'.format(
+            index_name, data and data[0]))
+
+
+@contextmanager
+def bulk_load_mode(index_name, using='default', force_merge=False,
+                   wait_for_status='green', timeout=600):
+    """ Context manager which speeds up bulk loads into index or
+    alias :index_name: by disabling refresh and replicas.
+
+    Settings of index are saved to marker file before they are changed
+    and restored on exit, even when loading fails. If process crashes,
+    settings are restored on next ``bulk_load_mode`` or
+    ``recover_bulk_load`` call for the same index. Marker file is
+    created exclusively and records host and pid of loading process, so
+    concurrent loaders of the same index don't interfere. Set
+    "elasticsearch.bulk_load_marker_dir" to a shared directory when
+    loaders run on different hosts.
+
+    :param force_merge: Whether to merge index segments after load.
+    :param wait_for_status: Cluster health status of index to wait for
+        after settings are restored. None to not wait.
+    :param timeout: Max number of seconds to wait for force merge and
+        for health status.
+    :raises RuntimeError: If index is already in bulk load mode of
+        another running process.
+    """
+    conn = connections.get_connection(using)
+    marker = _bulk_load_marker(index_name)
+    owner = _create_marker(marker, index_name, using)
+    try:
+        response = conn.indices.get_settings(index=index_name)
+        saved = {}
+        for name, data in response.items():
+            current = flatten_settings(data.get('settings', {}))
+            saved[name] = {key: current.get(key, default)
+                           for key, default in BULK_LOAD_SETTINGS.items()}
+        with open(marker, 'w') as f:
+            json.dump({'owner': owner, 'settings': saved}, f)
+    except Exception:
+        _remove_file(marker)
+        raise
+    log.info('Index {} is in bulk load mode'.format(index_name))
+    try:
+        for name in sorted(saved):
+            conn.indices.put_settings(index=name, body={'index': {
+                'refresh_interval': '-1', 'number_of_replicas': '0'}})
+        yield
+    finally:
+        _restore_settings(conn, saved)
+        _remove_file(marker)
+        conn.indices.refresh(index=index_name)
+        if force_merge:
+            conn.indices.optimize(
+                index=index_name, max_num_segments=1,
+                request_timeout=timeout)
+        if wait_for_status is not None:
+            conn.cluster.health(
+                index=index_name, wait_for_status=wait_for_status,
+                timeout='{}s'.format(timeout), request_timeout=timeout)
+
+
+# Suffix formats of time-partitioned indices names
+PARTITION_FORMATS = {
+    'daily': '%Y.%m.%d',
+    'monthly': '%Y.%m',
+    'yearly': '%Y',
+}
+
+# Max number of partitions search is narrowed to. Searches which span
+# more partitions use indices pattern
+MAX_SEARCH_PARTITIONS = 60
+
+
+def _partition_format(interval):
+    try:
+        return PARTITION_FORMATS[interval]
+    except KeyError:
+        raise ValueError('Unknown partition interval: {}'.format(interval))
+
+
+def as_naive_utc(value):
+    """ Convert date, datetime or date string :value: to naive UTC
+    datetime partitions are computed from.
+    """
+    if isinstance(value, six.string_types):
+        value = parser.parse(value)
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return value
+
+
+def partition_start(value, interval):
+    """ Get start of partition :value: date falls into. """
+    value = as_naive_utc(value)
+    if interval == 'daily':
+        return datetime.datetime(value.year, value.month, value.day)
+    if interval == 'monthly':
+        return datetime.datetime(value.year, value.month, 1)
+    _partition_format(interval)
+    return datetime.datetime(value.year, 1, 1)
+
+
+def next_partition_start(start, interval):
+    """ Get start of partition which follows one starting at :start:. """
+    if interval == 'daily':
+        return start + datetime.timedelta(days=1)
+    if interval == 'monthly':
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start.replace(year=start.year + 1)
+
+
+def partition_name(base, value, interval):
+    """ Get name of partition of :base: index :value: date falls into,
+    e.g. "events-2016.01" for monthly partitions.
+    """
+    value = as_naive_utc(value)
+    return '{}-{}'.format(base, value.strftime(_partition_format(interval)))
+
+
+def partition_pattern(base):
+    return '{}-*'.format(base)
+
+
+def partition_names(base, start, end, interval):
+    """ Get names of partitions of :base: index which overlap dates
+    from :start: to :end: inclusive.
+
+    :returns: List of names or None if there are more than
+        ``MAX_SEARCH_PARTITIONS`` of them.
+    """
+    names = []
+    current = partition_start(start, interval)
+    end = as_naive_utc(end)
+    while current <= end:
+        if len(names) == MAX_SEARCH_PARTITIONS:
+            return None
+        names.append(partition_name(base, current, interval))
+        current = next_partition_start(current, interval)
+    return names
+
+
+def put_partition_template(base, doc_classes, using='default'):
+    """ Put index template which applies mappings and settings of
+    :doc_classes: to partitions of :base: index created on first write.
+    """
+    conn = connections.get_connection(using)
+    mappings = {}
+    for doc_cls in doc_classes:
+        mappings.update(doc_cls._doc_type.mapping.to_dict())
+    conn.indices.put_template(
+        name='{}-partitions'.format(base),
+        body={
+            'template': partition_pattern(base),
+            'settings': get_index_settings(doc_classes),
+            'mappings': mappings,
+        })
+
+
+def drop_partitions(base, interval, before, using='default'):
+    """ Delete partitions of :base: index which only contain dates
+    earlier than :before:.
+
+    Partitions are deleted as whole indices, which is much cheaper than
+    deleting documents.
+
+    :returns: Sorted list of deleted index names.
+    """
+    conn = connections.get_connection(using)
+    fmt = _partition_format(interval)
+    prefix = base + '-'
+    try:
+        existing = conn.indices.get_settings(index=partition_pattern(base))
+    except JHTTPNotFound:
+        return []
+    dropped = []
+    for name in existing:
+        try:
+            start = datetime.datetime.strptime(name[len(prefix):], fmt)
+        except ValueError:
+            continue
+        if next_partition_start(start, interval) <= before:
+            dropped.append(name)
+    dropped.sort()
+    if dropped:
+        log.info('Dropping partitions {}'.format(', '.join(dropped)))
+        conn.indices.delete(index=','.join(dropped))
+    return dropped
+
+
+def _report(copied, elapsed, progress=None):
+    rate = copied / elapsed if elapsed else 0.0
+    log.info('Copied {} documents in {:.1f}s ({:.0f} docs/s)'.format(
+        copied, elapsed, rate))
+    if progress is not None:
+        progress(copied, elapsed)
@@ -0,0 +1,214 @@
+""" Per-request instrumentation of ES HTTP requests.
+
+Each request performed by ``ESHttpConnection`` is described by a dict
+with the following keys and passed to all registered sinks:
+
+    * ``method``: HTTP method.
+    * ``url``: Request path, without query string.
+    * ``endpoint``: Method and path template, e.g.
+      "POST /{index}/{type}/_search".
+    * ``operation``: ES API name, e.g. "search", "count", "bulk", "get".
+    * ``doc_type``: Document type (document class name) from path or
+      None.
+    * ``status``: Response HTTP status code.
+    * ``duration``: Request latency in seconds.
+    * ``request_bytes``: Size of request body.
+    * ``response_bytes``: Size of response body.
+    * ``took``: ES "took" value in milliseconds or None.
+    * ``body``: Request body as sent.
+
+Nothing is collected while no sinks are registered.
+"""
+import logging
+import re
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Matches "took" at the start of search, count and bulk responses
+_TOOK = re.compile(r'^\s*\{\s*"took"\s*:\s*(\d+)')
+
+# Upper bounds of histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = (
+    1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+    float('inf'))
+
+# Registered sinks. Replaced, not mutated, so it can be iterated
+# without locking
+_sinks = ()
+_sinks_lock = threading.Lock()
+
+
+def add_sink(sink):
+    """ Register callable :sink: to receive request info dicts. """
+    global _sinks
+    with _sinks_lock:
+        if sink not in _sinks:
+            _sinks = _sinks + (sink,)
+
+
+def remove_sink(sink):
+    global _sinks
+    with _sinks_lock:
+        _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+def is_enabled():
+    return bool(_sinks)
+
+
+def parse_url(method, url):
+    """ Get endpoint, operation and document type of request.
+
+    :param method: HTTP method.
+    :param url: Request path.
+    :returns: Tuple of (endpoint, operation, doc_type).
+    """
+    parts = [part for part in url.split('?', 1)[0].split('/') if part]
+    template = []
+    operation = doc_type = None
+    for idx, part in enumerate(parts):
+        if part.startswith('_'):
+            template.append(part)
+            if operation is None:
+                operation = part[1:]
+            continue
+        if operation is None and idx == 1:
+            doc_type = part
+        template.append(('{index}', '{type}', '{id}')[min(idx, 2)])
+    if operation is None:
+        operation = {
+            'GET': 'get', 'HEAD': 'exists', 'DELETE': 'delete',
+        }.get(method, 'index')
+    endpoint = '{} /{}'.format(method, '/'.join(template))
+    return endpoint, operation, doc_type
+
+
+def get_took(raw_data):
+    if not raw_data:
+        return None
+    match = _TOOK.match(raw_data[:32])
+    if match is not None:
+        return int(match.group(1))
+
+
+def record_request(method, url, body, status, duration, raw_data=None):
+    """ Build request info dict and pass it to all registered sinks. """
+    sinks = _sinks
+    if not sinks:
+        return
+    endpoint, operation, doc_type = parse_url(method, url)
+    info = dict(
+        method=method,
+        url=url,
+        endpoint=endpoint,
+        operation=operation,
+        doc_type=doc_type,
+        status=status,
+        duration=duration,
+        request_bytes=len(body) if body else 0,
+        response_bytes=len(raw_data) if raw_data else 0,
+        took=get_took(raw_data),
+        body=body,
+    )
+    for sink in sinks:
+        try:
+            sink(info)
+        except Exception as ex:
+            log.error('Instrumentation sink failed: {}'.format(ex))
+
+
+class Histogram(object):
+    """ Fixed-bucket histogram of millisecond values. """
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                return
+
+    def percentile(self, pct):
+        """ Get upper bound of bucket :pct: percentile falls into. """
+        if not self.count:
+            return 0.0
+        threshold = self.count * pct / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= threshold:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return dict(
+            count=self.count,
+            total=self.total,
+            avg=self.total / self.count if self.count else 0.0,
+            max=self.max,
+            p50=self.percentile(50),
+            p95=self.percentile(95),
+            p99=self.percentile(99),
+            buckets=list(zip(self.buckets, self.counts)),
+        )
+
+
+class RequestStats(object):
+    """ Sink which keeps in-process counters and histograms of requests
+    grouped by (operation, doc_type).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __call__(self, info):
+        key = (info['operation'], info['doc_type'])
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = dict(
+                    requests=0, errors=0, request_bytes=0,
+                    response_bytes=0, latency=Histogram(), took=Histogram())
+            stats['requests'] += 1
+            status = info['status']
+            if not isinstance(status, int) or not 200 <= status < 300:
+                stats['errors'] += 1
+            stats['request_bytes'] += info['request_bytes']
+            stats['response_bytes'] += info['response_bytes']
+            stats['latency'].observe(info['duration'] * 1000)
+            if info['took'] is not None:
+                stats['took'].observe(info['took'])
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def to_dict(self):
+        """ Get stats as dict of {(operation, doc_type): stats dict}. """
+        with self._lock:
+            result = {}
+            for key, stats in self._stats.items():
+                stats = dict(stats)
+                stats['latency'] = stats['latency'].to_dict()
+                stats['took'] = stats['took'].to_dict()
+                result[key] = stats
+            return result
+
+
+# Built-in stats sink. Registered by ``setup_database`` when
+# "elasticsearch.instrument" setting is true
+request_stats = RequestStats()
+
+
+def get_request_stats():
+    """ Get counters and histograms collected by built-in sink. """
+    return request_stats.to_dict()
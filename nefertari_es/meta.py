@@ -1,35 +1,143 @@
-import inspect
+import json
+import threading
 
 from elasticsearch_dsl import Index
 from elasticsearch_dsl.document import DocTypeMeta as ESDocTypeMeta
 from elasticsearch_dsl.field import Field
+from nefertari.utils import dictset
 
 # BaseDocument subclasses registry
 # maps class names to classes
 _document_registry = {}
 
+# Backrefs waiting for their target document class to be defined.
+# Maps target class names to lists of (document class, relationship
+# field name) tuples
+_pending_backrefs = {}
 
-def create_index(index_name, doc_classes=None):
+# Index setup deferred until first use of documents. Set by
+# ``defer_index_setup``
+_deferred_index_setup = None
+_deferred_index_setup_lock = threading.Lock()
+
+
+def create_index(index_name, doc_classes=None, aliases=None):
     """ Create index and add document classes to it.
 
     Does NOT check whether index already exists.
 
     :param index_name: Name of index to be created.
     :param doc_classes: Sequence of document classes which should be
-        added to created index. Defaults to None, in which case all
-        document classes from document registry are added to new index.
+        added to created index. Defaults to None, in which case
+        document classes from document registry which are not placed
+        in other indices are added to new index.
+    :param aliases: Sequence of aliases to be pointed to created index.
     """
     index = Index(index_name)
+    if aliases:
+        index.aliases(**{alias: {} for alias in aliases})
 
     if doc_classes is None:
-        doc_classes = get_document_classes().values()
+        doc_classes = get_index_classes(index_name)
 
     for doc_cls in doc_classes:
         index.doc_type(doc_cls)
+    index_settings = get_index_settings(doc_classes)
+    if index_settings:
+        index.settings(**index_settings)
 
     index.create()
 
 
+def _parse_setting(value):
+    """ Parse JSON list or object config :value:. Other values are
+    passed to ES as is.
+    """
+    if value.startswith(('[', '{')):
+        return json.loads(value)
+    return value
+
+
+def get_index_settings(doc_classes):
+    """ Get settings of index which contains :doc_classes:.
+
+    Settings from "elasticsearch.index.*" config, e.g.
+    "elasticsearch.index.refresh_interval = 30s", are overridden by
+    ``Meta.index_settings`` of document classes.
+
+    :returns: Dict of {setting name: value}.
+    """
+    from nefertari_es import Settings
+    index_settings = {
+        name: _parse_setting(value)
+        for name, value in dictset(Settings).mget('index').items()}
+    for doc_cls in doc_classes:
+        index_settings.update(getattr(doc_cls, '_index_settings', None) or {})
+    return index_settings
+
+
+def get_index_classes(index_name, default_index=None):
+    """ Get document classes placed in index :index_name:.
+
+    :param default_index: Name of index document classes without
+        explicit index are placed in. Defaults to None, in which case
+        they are considered to be placed in :index_name: unless some
+        class is explicitly placed there.
+    """
+    doc_classes = get_document_classes().values()
+    explicit = [getattr(doc_cls, '_explicit_index', None)
+                for doc_cls in doc_classes]
+    if default_index is None:
+        default_index = None if index_name in explicit else index_name
+    return [doc_cls for doc_cls, index in zip(doc_classes, explicit)
+            if (index or default_index) == index_name]
+
+
+def get_index_groups(default_index, doc_classes=None):
+    """ Group document classes by indices they are placed in.
+
+    :param default_index: Name of index document classes without
+        explicit index are placed in.
+    :param doc_classes: Dict of {name: document class} to group.
+        Defaults to None, in which case document registry is used.
+    :returns: Dict of {index name: list of document classes}. Always
+        includes :default_index:.
+    """
+    if doc_classes is None:
+        doc_classes = get_document_classes()
+    groups = {default_index: []}
+    for name, doc_cls in sorted(doc_classes.items()):
+        index_name = getattr(doc_cls, '_explicit_index', None)
+        groups.setdefault(index_name or default_index, []).append(doc_cls)
+    return groups
+
+
+def defer_index_setup(setup):
+    """ Defer index setup until documents are first used.
+
+    :param setup: Callable which performs index setup. It is called
+        once, by first ``ensure_index`` call.
+    """
+    global _deferred_index_setup
+    _deferred_index_setup = setup
+
+
+def index_setup_pending():
+    """ Check whether deferred index setup wasn't performed yet. """
+    return _deferred_index_setup is not None
+
+
+def ensure_index():
+    """ Perform deferred index setup if there is one. """
+    global _deferred_index_setup
+    if _deferred_index_setup is None:
+        return
+    with _deferred_index_setup_lock:
+        if _deferred_index_setup is not None:
+            _deferred_index_setup()
+            _deferred_index_setup = None
+
+
 def get_document_cls(name):
     """ Get BaseDocument subclass from document registry.
 
@@ -56,6 +164,48 @@ class RegisteredDocMixin(type):
         return new_class
 
 
+class IndexPlacementMixin(type):
+    """ Metaclass mixin that records index document class is placed in.
+
+    Index is set with ``Meta.index`` or ``__index__`` class attribute.
+    Settings of that index may be set with ``Meta.index_settings``.
+    Both are inherited by subclasses.
+    """
+    def __new__(cls, name, bases, attrs):
+        meta = attrs.get('Meta')
+        index = attrs.get('__index__') or getattr(meta, 'index', None)
+        if index is not None and meta is not None:
+            meta.index = index
+        new_class = super(IndexPlacementMixin, cls).__new__(
+            cls, name, bases, attrs)
+        if index is not None:
+            new_class._explicit_index = index
+        index_settings = getattr(meta, 'index_settings', None)
+        if index_settings is not None:
+            new_class._index_settings = index_settings
+        return new_class
+
+
+class RoutingMixin(type):
+    """ Metaclass mixin that marks routing as required in mapping of
+    document classes which set ``_routing_field`` and
+    ``_routing_required`` class attributes.
+    """
+    def __new__(cls, name, bases, attrs):
+        new_class = super(RoutingMixin, cls).__new__(
+            cls, name, bases, attrs)
+        if (getattr(new_class, '_routing_field', None) and
+                getattr(new_class, '_routing_required', False)):
+            new_class._doc_type.mapping.meta('_routing', required=True)
+        return new_class
+
+
+class AttributeErrorDescriptor(object):
+    """ Hides class attribute which was moved to mapping. """
+    def __get__(self, *args, **kwargs):
+        raise AttributeError
+
+
 class NonDocumentInheritanceMixin(type):
     """ Metaclass mixin that adds class attribute fields to mapping
     of they are not there yet.
@@ -68,40 +218,84 @@ class NonDocumentInheritanceMixin(type):
             cls, name, bases, attrs)
         mapping = new_cls._doc_type.mapping
 
-        class AttributeErrorDescriptor(object):
-            def __get__(self, *args, **kwargs):
-                raise AttributeError
-        for name, member in inspect.getmembers(new_cls):
-            if name.startswith('__') or name in mapping:
+        # Walk class dicts instead of getattr-ing all members, so
+        # descriptors are not evaluated. First definition in MRO wins
+        seen = set()
+        for klass in new_cls.__mro__:
+            # Fields of document classes are already in their mappings
+            if '_doc_type' in vars(klass):
+                seen.update(vars(klass))
                 continue
-            if isinstance(member, Field):
-                mapping.field(name, member)
-                setattr(new_cls, name, AttributeErrorDescriptor())
+            for name, member in vars(klass).items():
+                if name in seen or name.startswith('__'):
+                    continue
+                seen.add(name)
+                if isinstance(member, Field) and name not in mapping:
+                    mapping.field(name, member)
+                    setattr(new_cls, name, AttributeErrorDescriptor())
 
         return new_cls
 
 
+def _add_backref(doc_cls, field_name, target_cls):
+    """ Add backref of relationship :field_name: of :doc_cls: to
+    mapping of :target_cls:.
+    """
+    from .fields import Relationship
+    field = doc_cls._doc_type.mapping[field_name]
+    backref_kwargs = field._backref_kwargs.copy()
+    backref_name = backref_kwargs.pop('name')
+    backref_kwargs.setdefault('uselist', False)
+    backref_field = Relationship(doc_cls.__name__, **backref_kwargs)
+    backref_field._back_populates = field_name
+    target_cls._doc_type.mapping.field(backref_name, backref_field)
+    field._back_populates = backref_name
+
+
+def get_unresolved_backrefs():
+    """ Get backrefs whose target document class is not defined.
+
+    :returns: Dict of {target class name: list of (document class,
+        relationship field name)}.
+    """
+    return {name: list(backrefs)
+            for name, backrefs in _pending_backrefs.items()}
+
+
 class BackrefGeneratingDocMixin(type):
-    """ Metaclass mixin that generates relationship backrefs. """
+    """ Metaclass mixin that generates relationship backrefs.
+
+    Backrefs are added to target document class when it is defined,
+    so relationships may reference classes which are defined later.
+    """
     def __new__(cls, name, bases, attrs):
-        from .fields import Relationship
+        from .fields import ReferenceField
         new_class = super(BackrefGeneratingDocMixin, cls).__new__(
             cls, name, bases, attrs)
 
-        relationships = new_class._relationships()
-        for name in relationships:
-            field = new_class._doc_type.mapping[name]
-            if not field._backref_kwargs:
+        mapping = new_class._doc_type.mapping
+        targets = {new_class.__name__}
+        for field_name in mapping:
+            field = mapping[field_name]
+            if isinstance(field, ReferenceField) and field._backref_kwargs:
+                targets.add(field._doc_class_name)
+                _pending_backrefs.setdefault(
+                    field._doc_class_name, []).append(
+                    (new_class, field_name))
+
+        # Class is registered after this mixin, so it is resolved as
+        # target explicitly
+        for target_name in targets:
+            if target_name not in _pending_backrefs:
+                continue
+            if target_name == new_class.__name__:
+                target_cls = new_class
+            elif target_name in _document_registry:
+                target_cls = _document_registry[target_name]
+            else:
                 continue
-            target_cls = field._doc_class
-            backref_kwargs = field._backref_kwargs.copy()
-            field_name = backref_kwargs.pop('name')
-            backref_kwargs.setdefault('uselist', False)
-            backref_field = Relationship(
-                new_class.__name__, **backref_kwargs)
-            backref_field._back_populates = name
-            target_cls._doc_type.mapping.field(field_name, backref_field)
-            field._back_populates = field_name
+            for doc_cls, field_name in _pending_backrefs.pop(target_name):
+                _add_backref(doc_cls, field_name, target_cls)
 
         return new_class
 
@@ -121,6 +315,8 @@ class GenerateMetaMixin(type):
 
 class DocTypeMeta(
         GenerateMetaMixin,
+        IndexPlacementMixin,
+        RoutingMixin,
         NonDocumentInheritanceMixin,
         RegisteredDocMixin,
         BackrefGeneratingDocMixin,
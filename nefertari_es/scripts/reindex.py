@@ -0,0 +1,67 @@
+""" Reindex documents into new index version with current mappings
+and move index alias to it.
+"""
+from argparse import ArgumentParser
+import sys
+import logging
+
+from pyramid.paster import bootstrap
+
+
+def main(argv=sys.argv, quiet=False):
+    log = logging.getLogger()
+    log.setLevel(logging.WARNING)
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+    ch.setFormatter(formatter)
+    log.addHandler(ch)
+
+    command = ReindexCommand(argv, log)
+    return command.run()
+
+
+class ReindexCommand(object):
+
+    bootstrap = (bootstrap,)
+
+    def __init__(self, argv, log):
+        parser = ArgumentParser(description=__doc__)
+        parser.add_argument(
+            '-c', '--config', help='config.ini (required)',
+            required=True)
+        parser.add_argument(
+            '--quiet', help='Quiet mode', action='store_true',
+            default=False)
+        parser.add_argument(
+            '--alias',
+            help=('Alias to reindex. Defaults to '
+                  '`elasticsearch.index_name` setting'))
+        parser.add_argument(
+            '--slices', help='Number of parallel copy workers',
+            type=int, default=1)
+        parser.add_argument(
+            '--chunk',
+            help=('Reindex chunk size. If chunk size not provided '
+                  '`elasticsearch.chunk_size` setting is used'),
+            type=int)
+        parser.add_argument(
+            '--delete-old', help='Delete old index versions',
+            action='store_true', default=False)
+
+        self.options = parser.parse_args(argv[1:])
+        self.bootstrap[0](self.options.config)
+        self.log = log
+        if not self.options.quiet:
+            self.log.setLevel(logging.INFO)
+
+    def run(self):
+        from nefertari_es import Settings
+        from nefertari_es.indices import reindex
+        alias = self.options.alias or Settings['index_name']
+        chunk_size = self.options.chunk or Settings.asint('chunk_size', 500)
+        reindex(
+            alias,
+            slices=self.options.slices,
+            chunk_size=chunk_size,
+            delete_old=self.options.delete_old)
+        return 0
@@ -1,17 +1,137 @@
 import datetime
 import decimal
+import json
 
+import six
+from elasticsearch.exceptions import SerializationError
 from elasticsearch_dsl.serializer import AttrJSONSerializer
 
 
+class JSONCodec(object):
+    """ JSON codec which uses stdlib ``json`` module.
+
+    Codecs encode and decode JSON for ``JSONSerializer``. ``dumps`` gets
+    a ``default`` callable which must be called for objects codec can't
+    encode natively.
+    """
+    name = 'json'
+
+    def dumps(self, data, default):
+        return json.dumps(data, default=default)
+
+    def loads(self, s):
+        return json.loads(s)
+
+
+class OrjsonCodec(JSONCodec):
+    """ JSON codec which uses ``orjson`` library.
+
+    Date and time objects are passed to ``default`` so their output
+    is the same as with ``JSONCodec``. Data ``orjson`` can't encode,
+    e.g. integers over 64 bits, is encoded with stdlib ``json``.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._options = (
+            orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+
+    def dumps(self, data, default):
+        try:
+            return self._orjson.dumps(
+                data, default=default, option=self._options).decode('utf-8')
+        except TypeError:
+            return super(OrjsonCodec, self).dumps(data, default)
+
+    def loads(self, s):
+        return self._orjson.loads(s)
+
+
+# Available codecs in order of preference
+CODECS = (OrjsonCodec, JSONCodec)
+
+
+def get_codec(name=None):
+    """ Get JSON codec instance.
+
+    :param name: Name of codec to get. Defaults to None, in which case
+        the fastest installed codec is returned.
+    :raises ValueError: If codec :name: is unknown.
+    :raises ImportError: If library of codec :name: is not installed.
+    """
+    for codec_cls in CODECS:
+        if name is None:
+            try:
+                return codec_cls()
+            except ImportError:
+                continue
+        elif codec_cls.name == name:
+            return codec_cls()
+    raise ValueError('Unknown JSON codec: {}'.format(name))
+
+
+def _format_datetime(obj):
+    return obj.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _format_time(obj):
+    return obj.strftime('%H:%M:%S')
+
+
+def _format_timedelta(obj):
+    return obj.seconds
+
+
+# Maps exact types to their formatters to avoid isinstance checks chain
+_FORMATTERS = {
+    datetime.datetime: _format_datetime,
+    datetime.date: _format_datetime,
+    datetime.time: _format_time,
+    datetime.timedelta: _format_timedelta,
+    decimal.Decimal: float,
+}
+
+
 class JSONSerializer(AttrJSONSerializer):
+    """ Serializer with pluggable JSON codec.
+
+    :param codec: Codec instance or name. Defaults to None, in which
+        case the fastest installed codec is used.
+    """
+    def __init__(self, codec=None):
+        if codec is None or isinstance(codec, six.string_types):
+            codec = get_codec(codec)
+        self.codec = codec
+
+    def loads(self, s):
+        # Response body may already be parsed by ESHttpConnection
+        if isinstance(s, (dict, list)):
+            return s
+        try:
+            return self.codec.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if isinstance(data, six.string_types):
+            return data
+        try:
+            return self.codec.dumps(data, self.default)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
     def default(self, obj):
+        formatter = _FORMATTERS.get(type(obj))
+        if formatter is not None:
+            return formatter(obj)
         if isinstance(obj, (datetime.datetime, datetime.date)):
-            return obj.strftime("%Y-%m-%dT%H:%M:%SZ")
+            return _format_datetime(obj)
         if isinstance(obj, datetime.time):
-            return obj.strftime('%H:%M:%S')
+            return _format_time(obj)
         if isinstance(obj, datetime.timedelta):
-            return obj.seconds
+            return _format_timedelta(obj)
         if isinstance(obj, decimal.Decimal):
             return float(obj)
         return super(JSONSerializer, self).default(obj)
@@ -0,0 +1,99 @@
+import json
+import logging
+import random
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Process-wide slow query log. Created lazily by ``get_slow_query_log``
+_slow_query_log = None
+_slow_query_log_lock = threading.Lock()
+
+
+def _current_view():
+    """ Describe view of current pyramid request, if there is one. """
+    try:
+        from pyramid.threadlocal import get_current_request
+    except ImportError:
+        return None
+    request = get_current_request()
+    if request is None:
+        return None
+    view = '{} {}'.format(request.method, request.path_qs)
+    route = getattr(request, 'matched_route', None)
+    if route is not None:
+        view += ' (route {})'.format(route.name)
+    return view
+
+
+class SlowQueryLog(object):
+    """ Logs searches which exceed latency or "took" threshold.
+
+    Query body is only compiled for slow queries which are sampled, so
+    overhead for fast queries is a couple of comparisons.
+
+    :param threshold: Min request latency in seconds for query to be
+        logged. None to not check latency.
+    :param took_threshold: Min ES "took" value in milliseconds for
+        query to be logged. None to not check "took".
+    :param sample_rate: Part of slow queries to log, from 0 to 1.
+    """
+    def __init__(self, threshold=None, took_threshold=None, sample_rate=1.0):
+        self.threshold = threshold
+        self.took_threshold = took_threshold
+        self.sample_rate = sample_rate
+
+    @property
+    def enabled(self):
+        return not (self.threshold is None and self.took_threshold is None)
+
+    def is_slow(self, duration, took):
+        if self.threshold is not None and duration >= self.threshold:
+            return True
+        return (self.took_threshold is not None and took is not None and
+                took >= self.took_threshold)
+
+    def check(self, document_cls, search_obj, response, duration):
+        """ Log search if it was slow.
+
+        :param document_cls: Document class which was queried.
+        :param search_obj: Executed ``Search`` object.
+        :param response: ``Response`` of executed search.
+        :param duration: Search latency in seconds.
+        """
+        took = getattr(response, 'took', None)
+        if not self.is_slow(duration, took):
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        body = json.dumps(search_obj.to_dict(), default=str, sort_keys=True)
+        log.warning(
+            'Slow query on {}: latency {:.3f}s, took {}ms, {} hits, '
+            'view {}: {}'.format(
+                document_cls.__name__, duration, took,
+                response.hits.total, _current_view(), body))
+
+
+def get_slow_query_log():
+    """ Get process-wide slow query log.
+
+    It is created on first call using ``elasticsearch.slow_query_*``
+    settings and is disabled unless ``slow_query_threshold`` or
+    ``slow_query_took_threshold`` is set.
+    """
+    global _slow_query_log
+    if _slow_query_log is not None:
+        return _slow_query_log
+    with _slow_query_log_lock:
+        if _slow_query_log is None:
+            from nefertari_es import Settings
+            threshold = Settings.get('slow_query_threshold')
+            took_threshold = Settings.get('slow_query_took_threshold')
+            _slow_query_log = SlowQueryLog(
+                threshold=None if threshold is None else float(threshold),
+                took_threshold=(
+                    None if took_threshold is None else int(took_threshold)),
+                sample_rate=Settings.asfloat('slow_query_sample_rate', 1.0),
+            )
+    return _slow_query_log
@@ -0,0 +1,276 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import six
+from elasticsearch import Transport
+from elasticsearch.connection_pool import ConnectionSelector
+from elasticsearch.exceptions import ConnectionError
+from nefertari.json_httpexceptions import exception_response
+from six.moves.queue import Queue, Empty
+
+from .connections import ESHttpConnection
+
+
+log = logging.getLogger(__name__)
+
+
+def _is_available(connection):
+    breaker = getattr(connection, 'breaker', None)
+    return breaker is None or breaker.is_available()
+
+
+class LatencyAwareSelector(ConnectionSelector):
+    """ Selects connections randomly with probability inversely
+    proportional to their decayed latency average.
+
+    Connections which were not used yet are weighted as the fastest
+    known connection, so new nodes get traffic. Connections with open
+    circuit breaker are skipped unless all of them are open.
+    """
+    # Latency floor in seconds, so one very fast sample doesn't take
+    # all traffic
+    min_latency = 0.001
+
+    def select(self, connections):
+        if len(connections) == 1:
+            return connections[0]
+        candidates = [c for c in connections if _is_available(c)]
+        if not candidates:
+            candidates = connections
+        latencies = [getattr(c, 'latency_ewma', None) for c in candidates]
+        known = [lat for lat in latencies if lat is not None]
+        if not known:
+            return random.choice(candidates)
+        default = min(known)
+        weights = [
+            1.0 / max(default if lat is None else lat, self.min_latency)
+            for lat in latencies]
+        point = random.uniform(0, sum(weights))
+        for connection, weight in zip(candidates, weights):
+            point -= weight
+            if point <= 0:
+                return connection
+        return candidates[-1]
+
+
+class ESTransport(Transport):
+    """ Transport which raises nefertari HTTP exceptions only.
+
+    ``ESHttpConnection`` converts ES errors to nefertari exceptions
+    itself, but raises ``ConnectionError`` when its circuit breaker is
+    open, so transport tries another host. When all attempts fail this
+    way, error is converted to 503 response.
+    """
+    def perform_request(self, method, url, params=None, body=None):
+        try:
+            return super(ESTransport, self).perform_request(
+                method, url, params=params, body=body)
+        except ConnectionError as ex:
+            raise exception_response(
+                503, explanation=six.b(str(ex)), extra=dict(data=ex))
+
+
+class HedgingTransport(ESTransport):
+    """ Transport which hedges read requests.
+
+    When read request takes longer than recent ``hedge_percentile``
+    of read latencies, duplicate request is sent to another node and
+    the first successful response is used. When request fails with
+    connection error before hedge delay, it is sent to another node
+    right away. Requests are not hedged until ``hedge_min_samples``
+    latencies are collected.
+
+    Hedged requests are performed by a pool of reused worker threads.
+    When all ``hedge_max_workers`` are busy, request is performed
+    without hedging.
+
+    Accepts all ``Transport`` arguments plus:
+
+    :param hedge_percentile: Percentile of recent read latencies used
+        as hedge delay. Defaults to 95.
+    :param hedge_min_delay: Min hedge delay in seconds.
+    :param hedge_window: Number of recent read latencies to keep.
+    :param hedge_min_samples: Number of latencies which should be
+        collected before requests are hedged.
+    :param hedge_max_workers: Max number of worker threads.
+    """
+    def __init__(self, *args, **kwargs):
+        self.hedge_percentile = kwargs.pop('hedge_percentile', 95)
+        self.hedge_min_delay = kwargs.pop('hedge_min_delay', 0.01)
+        window = kwargs.pop('hedge_window', 1000)
+        self.hedge_min_samples = kwargs.pop('hedge_min_samples', 50)
+        self.hedge_max_workers = kwargs.pop('hedge_max_workers', 32)
+        super(HedgingTransport, self).__init__(*args, **kwargs)
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._hedge_delay = None
+        self._samples = 0
+        self.hedge_stats = dict(requests=0, hedged=0, hedge_wins=0)
+        self._tasks = Queue()
+        self._workers_lock = threading.Lock()
+        self._workers = 0
+        self._idle_workers = 0
+
+    def _record_latency(self, duration):
+        with self._lock:
+            self._latencies.append(duration)
+            self._samples += 1
+            # Sorting window on every request is wasteful, recompute
+            # delay once in a while
+            if self._samples % 20 and self._hedge_delay is not None:
+                return
+            if len(self._latencies) < self.hedge_min_samples:
+                return
+            latencies = sorted(self._latencies)
+            idx = int(len(latencies) * self.hedge_percentile / 100.0)
+            self._hedge_delay = max(
+                latencies[min(idx, len(latencies) - 1)],
+                self.hedge_min_delay)
+
+    def _should_hedge(self, method, url):
+        return (ESHttpConnection._is_read(method, url) and
+                self.send_get_body_as == 'GET' and
+                len(self.connection_pool.connections) > 1)
+
+    def _work(self):
+        while True:
+            connection, results, args = self._tasks.get()
+            result = self._attempt(connection, *args)
+            # Worker is marked idle before result is returned, so the
+            # next request of the caller reuses it
+            with self._workers_lock:
+                self._idle_workers += 1
+            results.put(result)
+
+    def _submit(self, connection, results, *args):
+        """ Perform request on :connection: on idle worker or on a new
+        one and put result on :results: queue.
+
+        Returns False when all ``hedge_max_workers`` are busy.
+        """
+        with self._workers_lock:
+            if self._idle_workers:
+                self._idle_workers -= 1
+            elif self._workers < self.hedge_max_workers:
+                self._workers += 1
+                thread = threading.Thread(
+                    target=self._work, name='nefertari-es-hedge')
+                thread.daemon = True
+                thread.start()
+            else:
+                return False
+        self._tasks.put((connection, results, args))
+        return True
+
+    def _attempt(self, connection, method, url, params, body, ignore,
+                 timeout):
+        """ Perform request on :connection:.
+
+        Returns (connection, error, (status, data)) tuple.
+        """
+        start = time.time()
+        try:
+            status, headers, data = connection.perform_request(
+                method, url, params, body, ignore=ignore, timeout=timeout)
+            self._record_latency(time.time() - start)
+            if data:
+                data = self.deserializer.loads(
+                    data, headers.get('content-type'))
+        except Exception as ex:
+            return connection, ex, None
+        return connection, None, (status, data)
+
+    def _count(self, name):
+        with self._lock:
+            self.hedge_stats[name] += 1
+
+    def perform_request(self, method, url, params=None, body=None):
+        if not self._should_hedge(method, url):
+            return super(HedgingTransport, self).perform_request(
+                method, url, params=params, body=body)
+        delay = self._hedge_delay
+        if delay is None:
+            # Not enough latency samples yet
+            start = time.time()
+            result = super(HedgingTransport, self).perform_request(
+                method, url, params=params, body=body)
+            self._record_latency(time.time() - start)
+            return result
+
+        # Kept for fallback to regular transport, which serializes
+        # body and pops params itself
+        orig_params = dict(params) if params else params
+        orig_body = body
+        if body is not None:
+            body = self.serializer.dumps(body)
+            try:
+                body = body.encode('utf-8')
+            except (UnicodeDecodeError, AttributeError):
+                pass
+        ignore = ()
+        timeout = None
+        if params:
+            params = dict(params)
+            timeout = params.pop('request_timeout', None)
+            ignore = params.pop('ignore', ())
+            if isinstance(ignore, int):
+                ignore = (ignore, )
+
+        results = Queue()
+
+        def start(connection):
+            return self._submit(
+                connection, results, method, url, params, body,
+                ignore, timeout)
+
+        primary = self.get_connection()
+        if not start(primary):
+            return super(HedgingTransport, self).perform_request(
+                method, url, params=orig_params, body=orig_body)
+        self._count('requests')
+        tried = [primary]
+        pending = 1
+        try:
+            result = results.get(timeout=delay)
+        except Empty:
+            result = None
+            log.debug('Hedging {} {} after {:.3f}s'.format(
+                method, url, delay))
+
+        error = None
+        while True:
+            if result is not None:
+                pending -= 1
+                connection, ex, value = result
+                if ex is None:
+                    self.connection_pool.mark_live(connection)
+                    if connection is not primary:
+                        self._count('hedge_wins')
+                    return value
+                if not isinstance(ex, ConnectionError):
+                    # ES responded with an error, other node would
+                    # respond with the same one
+                    raise ex
+                self.mark_dead(connection)
+                error = error or ex
+            if len(tried) == 1:
+                others = [c for c in self.connection_pool.connections
+                          if c not in tried]
+                if others:
+                    hedge = self.connection_pool.selector.select(others)
+                    tried.append(hedge)
+                    if start(hedge):
+                        pending += 1
+                        self._count('hedged')
+            if not pending:
+                break
+            result = results.get()
+
+        # Both nodes failed to respond, let regular transport retry
+        # the rest of the pool
+        log.debug('Hedged {} {} failed: {}'.format(method, url, error))
+        return super(HedgingTransport, self).perform_request(
+            method, url, params=orig_params, body=orig_body)
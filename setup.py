@@ -10,6 +10,12 @@ install_requires = [
     'nefertari',
     ]
 
+# Async API (nefertari_es.aio) requires Python 3.5+
+extras_require = {
+    'async': ['aiohttp'],
+    'speedups': ['orjson'],
+    }
+
 
 setup(
     name='nefertari_es',
@@ -21,6 +27,7 @@ setup(
         "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3.5",
         "Framework :: Pyramid",
         "Topic :: Internet :: WWW/HTTP",
         "Topic :: Internet :: WWW/HTTP :: WSGI :: Application",
@@ -35,4 +42,9 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require=extras_require,
+    entry_points="""\
+    [console_scripts]
+        nefertari-es.reindex = nefertari_es.scripts.reindex:main
+    """,
 )
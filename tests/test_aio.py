@@ -0,0 +1,194 @@
+import sys
+
+import pytest
+
+# nefertari_es.aio uses async/await syntax, so this module can't even
+# be imported on older interpreters
+if sys.version_info < (3, 5):
+    pytest.skip('asyncio API requires Python 3.5+', allow_module_level=True)
+
+import asyncio  # noqa: E402
+
+from mock import patch, Mock  # noqa: E402
+try:
+    from mock import AsyncMock
+except ImportError:
+    pytest.skip('asyncio API tests require mock 4+', allow_module_level=True)
+from nefertari.json_httpexceptions import JHTTPNotFound  # noqa: E402
+
+from .fixtures import simple_model, id_model  # noqa: E402
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+def search_response(*sources):
+    return {
+        'hits': {
+            'total': len(sources),
+            'hits': [{'_type': 'Item', '_id': str(i), '_source': src}
+                     for i, src in enumerate(sources)],
+        }
+    }
+
+
+@pytest.fixture
+def async_conn():
+    from nefertari_es import aio
+    conn = Mock(serializer=Mock(dumps=lambda x: str(x)))
+    conn.search = AsyncMock()
+    conn.count = AsyncMock()
+    conn.get = AsyncMock()
+    conn.index = AsyncMock()
+    conn.delete = AsyncMock()
+    conn.bulk = AsyncMock()
+    aio._async_connections['default'] = conn
+    yield conn
+    aio._async_connections.pop('default', None)
+
+
+class TestAsyncHelpers(object):
+    def test_make_path(self):
+        from nefertari_es import aio
+        assert aio._make_path('foo', None, '_search') == '/foo/_search'
+        assert aio._make_path(['a', 'b'], 'Item', 1) == '/a,b/Item/1'
+
+    def test_get_async_connection_by_alias(self):
+        from nefertari_es import aio
+        settings = {'hosts': 'localhost:9200', 'read_hosts': 'replica:9200'}
+        with patch('nefertari_es.Settings', settings):
+            try:
+                conn = aio.get_async_connection('read')
+                assert conn.hosts == ['http://replica:9200']
+                with pytest.raises(KeyError):
+                    aio.get_async_connection('foo')
+            finally:
+                aio._async_connections.pop('read', None)
+
+    def test_query_params(self):
+        from nefertari_es import aio
+        assert aio._query_params(
+            {'refresh': True, 'size': 1, 'foo': None}) == {
+            'refresh': 'true', 'size': '1'}
+
+
+class TestAsyncDocumentAPI(object):
+
+    def test_aget_collection(self, async_conn, simple_model):
+        simple_model._doc_type.index = 'foo'
+        async_conn.search.return_value = search_response(
+            {'name': 'a', 'price': 1})
+        hits = run(simple_model.aget_collection(name='a', _limit=1))
+        assert len(hits) == 1
+        assert isinstance(hits[0], simple_model)
+        assert hits[0].name == 'a'
+        assert hits._nefertari_meta == {
+            'total': 1, 'start': 0, 'fields': None}
+        kwargs = async_conn.search.call_args[1]
+        assert kwargs['index'] == ['foo']
+        assert kwargs['body'] == simple_model._build_search(
+            name='a', _limit=1)[0].to_dict()
+
+    def test_aget_collection_count(self, async_conn, simple_model):
+        async_conn.count.return_value = {'count': 3}
+        assert run(simple_model.aget_collection(_count=True)) == 3
+        assert not async_conn.search.called
+
+    def test_aget_item_not_found(self, async_conn, simple_model):
+        async_conn.get.return_value = {'found': False}
+        async_conn.search.return_value = search_response()
+        with pytest.raises(JHTTPNotFound):
+            run(simple_model.aget_item(name='a'))
+        assert async_conn.search.called
+
+    def test_aget_item_realtime(self, async_conn, simple_model):
+        simple_model._doc_type.index = 'foo'
+        async_conn.get.return_value = {
+            'found': True, '_type': 'Item', '_id': 'a',
+            '_source': {'name': 'a', 'price': 1}}
+        item = run(simple_model.aget_item(name='a', _fields=['price']))
+        assert item.price == 1
+        async_conn.get.assert_called_once_with(
+            index='foo', doc_type='Item', id='a',
+            _source_include=['price'])
+        assert not async_conn.search.called
+
+    def test_aget_item_realtime_pk_changed(self, async_conn, simple_model):
+        async_conn.get.return_value = {
+            'found': True, '_type': 'Item', '_id': 'a',
+            '_source': {'name': 'b'}}
+        async_conn.search.return_value = search_response()
+        with pytest.raises(JHTTPNotFound):
+            run(simple_model.aget_item(name='a'))
+        assert async_conn.search.called
+
+    def test_asave(self, async_conn, simple_model):
+        simple_model._doc_type.index = 'foo'
+        async_conn.index.return_value = {'_id': 'abc', '_version': 1}
+        item = simple_model(name='a', price=1)
+        hook = Mock()
+        item._backref_hooks = (hook,)
+        result = run(item.asave())
+        assert result is item
+        assert item._id == 'abc'
+        hook.assert_called_once_with()
+        assert item._backref_hooks == ()
+        async_conn.index.assert_called_once_with(
+            index='foo', doc_type='Item', refresh=True, id='a',
+            body={'name': 'a', 'price': 1})
+
+    @patch.dict('nefertari_es.Settings', {'refresh_on_save': 'false'})
+    def test_asave_refresh_setting(self, async_conn, id_model):
+        id_model._doc_type.index = 'foo'
+        async_conn.index.return_value = {'_id': 'abc', '_version': 1}
+        run(id_model(name='a').asave())
+        async_conn.index.assert_called_once_with(
+            index='foo', doc_type='Doc', refresh=False,
+            body={'name': 'a'})
+
+    def test_abulk(self, async_conn):
+        from nefertari_es import aio
+        async_conn.bulk.return_value = {'items': [
+            {'index': {'status': 201}}, {'index': {'status': 200}}]}
+        result = run(aio.abulk(
+            [{'_id': 1, '_source': {'a': 1}}, {'_id': 2, '_source': {}}],
+            chunk_size=5))
+        assert result == 2
+        assert async_conn.bulk.call_count == 1
+
+    def test_abulk_deferred_index_setup(self, async_conn):
+        import threading
+        from nefertari_es import aio, meta
+        threads = []
+        meta.defer_index_setup(
+            lambda: threads.append(threading.current_thread()))
+        async_conn.bulk.return_value = {'items': []}
+        try:
+            run(aio.abulk([{'_id': 1}], op_type='delete', chunk_size=5))
+        finally:
+            meta._deferred_index_setup = None
+        assert len(threads) == 1
+        assert threads[0] is not threading.current_thread()
+        assert not meta.index_setup_pending()
+
+    def test_aget_collection_deferred_index_setup(
+            self, async_conn, simple_model):
+        from nefertari_es import aio, meta
+        setup = Mock()
+        meta.defer_index_setup(setup)
+        simple_model._doc_type.index = 'foo'
+        async_conn.search.return_value = search_response()
+        try:
+            run(aio.aget_collection(simple_model, _count=False))
+        finally:
+            meta._deferred_index_setup = None
+        setup.assert_called_once_with()
+
+    def test_abulk_errors(self, async_conn):
+        from nefertari_es import aio
+        async_conn.bulk.return_value = {'items': [
+            {'delete': {'status': 404, 'error': 'missing'}}]}
+        with pytest.raises(Exception) as ex:
+            run(aio.abulk([{'_id': 1}], op_type='delete', chunk_size=5))
+        assert 'missing' in str(ex.value)
@@ -1,12 +1,21 @@
 import logging
 
+import io
+
 import pytest
 import six
+import urllib3
 from mock import patch, Mock
-from elasticsearch.exceptions import TransportError
-from nefertari.json_httpexceptions import JHTTPBadRequest
+from elasticsearch import Transport
+from elasticsearch.exceptions import ConnectionError, TransportError
+from nefertari.json_httpexceptions import (
+    JHTTPBadRequest, JHTTPInternalServerError)
+from nefertari.utils import dictset
 
-from nefertari_es.connections import ESHttpConnection
+from nefertari_es import transport_params
+from nefertari_es.connections import (
+    ESHttpConnection, CircuitBreaker, get_pool_stats, get_breaker_stats,
+    get_compression_stats, gzip_compress, gzip_decompress)
 
 
 class TestESHttpConnection(object):
@@ -22,7 +31,8 @@ class TestESHttpConnection(object):
         conn.perform_request('POST', 'http://localhost:9200')
         mock_log.debug.assert_called_once_with(
             "('POST', 'http://localhost:9200')")
-        conn.perform_request('POST', 'http://localhost:9200'*200)
+        assert not mock_catch.called
+        conn.perform_request('POST', 'http://localhost:9200'*200 + '/_bulk')
         assert mock_catch.called
         assert mock_log.debug.call_count == 2
 
@@ -63,9 +73,312 @@ class TestESHttpConnection(object):
                 1, 2,
                 '{"errors":true, "items": [{"index": {"error": "FOO"}}]}'))
 
+    @patch('nefertari_es.connections.json')
+    def test_catch_index_error_fast_path(self, mock_json):
+        conn = ESHttpConnection()
+        result = conn._catch_index_error((
+            1, 2, '{"took":12,"errors":false,"items":[{"index":{}}]}'))
+        assert result is None
+        assert not mock_json.loads.called
+
+    def test_catch_index_error_returns_data(self):
+        conn = ESHttpConnection()
+        result = conn._catch_index_error((
+            1, 2, '{"errors":true, "items": [{"create": {}}]}'))
+        assert result == {'errors': True, 'items': [{'create': {}}]}
+
+    def test_perform_request_bulk_parsed_once(self):
+        conn = ESHttpConnection()
+        conn.pool = Mock()
+        conn.pool.urlopen.return_value = Mock(
+            data=six.b('{"errors":true,"items":[]}'), status=200)
+        status, headers, data = conn.perform_request('POST', '/_bulk')
+        assert data == {'errors': True, 'items': []}
+        conn.pool.urlopen.return_value = Mock(
+            data=six.b('{"took":1,"errors":false}'), status=200)
+        status, headers, data = conn.perform_request('POST', '/_bulk')
+        assert data == '{"took":1,"errors":false}'
+
+    @patch('nefertari_es.connections.ESHttpConnection._catch_index_error')
+    def test_perform_request_not_bulk(self, mock_catch):
+        conn = ESHttpConnection()
+        conn.pool = Mock()
+        conn.pool.urlopen.return_value = Mock(
+            data=six.b('{"errors":true}'), status=200)
+        conn.perform_request('POST', '/foo/_search')
+        assert not mock_catch.called
+
     def test_perform_request_exception(self):
         conn = ESHttpConnection()
         conn.pool = Mock()
         conn.pool.urlopen.side_effect = TransportError('N/A', '')
         with pytest.raises(JHTTPBadRequest):
             conn.perform_request('POST', 'http://localhost:9200')
+
+    def test_pool_settings(self):
+        conn = ESHttpConnection(
+            maxsize=3, pool_block=True, pool_timeout=2, keep_alive=False)
+        assert conn.pool.block
+        assert conn.pool.pool.maxsize == 3
+        assert conn.pool_timeout == 2
+        assert conn.headers['connection'] == 'close'
+
+    def test_pool_checkout_stats(self):
+        conn = ESHttpConnection(host='statshost', pool_block=True)
+        stats = conn.pool_stats.to_dict()
+        http_conn = conn.pool._get_conn()
+        conn.pool._put_conn(http_conn)
+        new_stats = conn.pool_stats.to_dict()
+        assert new_stats['checkouts'] == stats['checkouts'] + 1
+        assert new_stats['wait_max'] >= new_stats['wait_avg'] >= 0
+        assert 'http://statshost:9200' in get_pool_stats()
+
+    @patch('nefertari_es.connections.os')
+    def test_check_fork(self, mock_os):
+        mock_os.getpid.return_value = 1
+        conn = ESHttpConnection(maxsize=2)
+        queue = conn.pool.pool
+        conn._check_fork()
+        assert conn.pool.pool is queue
+        mock_os.getpid.return_value = 2
+        conn._check_fork()
+        assert conn.pool.pool is not queue
+        assert conn.pool.pool.qsize() == 2
+
+
+    def test_compression_disabled(self):
+        conn = ESHttpConnection()
+        assert 'accept-encoding' not in conn.headers
+        assert not hasattr(conn, 'compression_stats')
+
+    @patch.object(urllib3.HTTPConnectionPool, 'urlopen')
+    def test_compression(self, mock_urlopen):
+        response_body = six.b('{"hits": {"total": 0}}')
+        mock_urlopen.return_value = urllib3.HTTPResponse(
+            body=io.BytesIO(gzip_compress(response_body)),
+            headers={'content-encoding': 'gzip'}, status=200,
+            preload_content=False)
+        conn = ESHttpConnection(
+            host='gziphost', http_compress=True, http_compress_threshold=10)
+        assert conn.headers['accept-encoding'] == 'gzip'
+        body = six.b('{"query": {"match_all": {}}}') * 10
+        status, headers, data = conn.perform_request(
+            'POST', '/foo/_search', body=body)
+        assert data == response_body.decode('utf-8')
+        sent_body, = mock_urlopen.call_args[0][2:]
+        sent_headers = mock_urlopen.call_args[1]['headers']
+        assert sent_headers['content-encoding'] == 'gzip'
+        assert 'content-encoding' not in conn.headers
+        assert gzip_decompress(sent_body) == body
+        stats = get_compression_stats()['http://gziphost:9200']
+        assert stats['requests'] == 1
+        assert stats['request_bytes'] == len(body)
+        assert stats['request_bytes_saved'] == len(body) - len(sent_body)
+        assert stats['responses'] == 1
+        assert stats['response_bytes'] == len(response_body)
+
+    @patch.object(urllib3.HTTPConnectionPool, 'urlopen')
+    def test_compression_small_body(self, mock_urlopen):
+        mock_urlopen.return_value = urllib3.HTTPResponse(
+            body=io.BytesIO(six.b('{}')), status=200,
+            preload_content=False)
+        conn = ESHttpConnection(host='gziphost2', http_compress=True)
+        status, headers, data = conn.perform_request(
+            'POST', '/foo/_search', body=six.b('{}'))
+        assert data == '{}'
+        assert mock_urlopen.call_args[0][2] == six.b('{}')
+        stats = conn.compression_stats.to_dict()
+        assert stats['requests'] == 0
+        assert stats['responses'] == 0
+
+
+    @patch('nefertari_es.connections.instrumentation')
+    def test_perform_request_instrumentation(self, mock_instr):
+        conn = ESHttpConnection()
+        conn.pool = Mock()
+        conn.pool.urlopen.return_value = Mock(
+            data=six.b('{"took":3}'), status=200)
+        conn.perform_request('POST', '/foo/Item/_search', None, six.b('{}'))
+        args = mock_instr.record_request.call_args[0]
+        assert args[:4] == ('POST', '/foo/Item/_search', six.b('{}'), 200)
+        assert args[5] == '{"took":3}'
+
+    @patch('nefertari_es.connections.instrumentation')
+    def test_perform_request_instrumentation_error(self, mock_instr):
+        conn = ESHttpConnection()
+        conn.pool = Mock()
+        conn.pool.urlopen.side_effect = TransportError('N/A', '')
+        with pytest.raises(JHTTPBadRequest):
+            conn.perform_request('GET', '/foo/Item/1')
+        args = mock_instr.record_request.call_args[0]
+        assert args[:4] == ('GET', '/foo/Item/1', None, 400)
+
+    @patch('nefertari_es.connections.instrumentation')
+    def test_perform_request_instrumentation_disabled(self, mock_instr):
+        mock_instr.is_enabled.return_value = False
+        conn = ESHttpConnection()
+        conn.pool = Mock()
+        conn.pool.urlopen.return_value = Mock(data=six.b('{}'), status=200)
+        conn.perform_request('GET', '/foo/Item/1')
+        assert not mock_instr.record_request.called
+
+
+    def test_is_read(self):
+        assert ESHttpConnection._is_read('GET', '/foo/Item/1')
+        assert ESHttpConnection._is_read('POST', '/foo/Item/_search?size=1')
+        assert not ESHttpConnection._is_read('POST', '/_bulk')
+        assert not ESHttpConnection._is_read('PUT', '/foo/Item/1')
+
+    @patch('nefertari_es.connections.time.sleep')
+    def test_read_retries(self, mock_sleep):
+        conn = ESHttpConnection(read_retries=2, retry_backoff=0.01)
+        conn.pool = Mock()
+        conn.pool.urlopen.side_effect = [
+            urllib3.exceptions.HTTPError('down'),
+            Mock(data=six.b('{}'), status=503),
+            Mock(data=six.b('{}'), status=200),
+        ]
+        status, headers, data = conn.perform_request('GET', '/foo/Item/1')
+        assert status == 200
+        assert conn.pool.urlopen.call_count == 3
+        assert mock_sleep.call_count == 2
+        assert all(0 <= c[0][0] <= 0.02 for c in mock_sleep.call_args_list)
+
+    @patch('nefertari_es.connections.time.sleep')
+    def test_no_retries_for_writes(self, mock_sleep):
+        conn = ESHttpConnection(read_retries=2)
+        conn.pool = Mock()
+        conn.pool.urlopen.side_effect = urllib3.exceptions.HTTPError('down')
+        with pytest.raises(JHTTPBadRequest):
+            conn.perform_request('PUT', '/foo/Item/1')
+        assert conn.pool.urlopen.call_count == 1
+        assert not mock_sleep.called
+
+    @patch('nefertari_es.connections.time.sleep')
+    def test_no_retries_on_client_errors(self, mock_sleep):
+        conn = ESHttpConnection(read_retries=2)
+        conn.pool = Mock()
+        conn.pool.urlopen.return_value = Mock(data=six.b('{}'), status=404)
+        with pytest.raises(Exception):
+            conn.perform_request('GET', '/foo/Item/1')
+        assert conn.pool.urlopen.call_count == 1
+
+    @patch('nefertari_es.connections.time.sleep')
+    def test_retry_deadline(self, mock_sleep):
+        conn = ESHttpConnection(read_retries=5, retry_deadline=0)
+        conn.pool = Mock()
+        conn.pool.urlopen.side_effect = urllib3.exceptions.HTTPError('down')
+        with pytest.raises(JHTTPBadRequest):
+            conn.perform_request('GET', '/foo/Item/1')
+        assert conn.pool.urlopen.call_count == 1
+
+    def test_circuit_breaker(self):
+        conn = ESHttpConnection(
+            host='breakerhost', breaker_failure_threshold=2)
+        conn.pool = Mock()
+        conn.pool.urlopen.side_effect = urllib3.exceptions.HTTPError('down')
+        for _ in range(2):
+            with pytest.raises(JHTTPBadRequest):
+                conn.perform_request('GET', '/foo/Item/1')
+        with pytest.raises(ConnectionError) as ex:
+            conn.perform_request('GET', '/foo/Item/1')
+        assert 'Circuit breaker of http://breakerhost:9200' in str(ex.value)
+        assert conn.pool.urlopen.call_count == 2
+        stats = get_breaker_stats()['http://breakerhost:9200']
+        assert stats == dict(state='open', failures=2, opened=1, rejected=1)
+
+    def test_circuit_breaker_failover(self):
+        transport = Transport(
+            [{'host': 'openhost'}, {'host': 'closedhost'}],
+            connection_class=ESHttpConnection, breaker_failure_threshold=1,
+            randomize_hosts=False)
+        open_conn, closed_conn = transport.connection_pool.connections
+        open_conn.breaker.record_failure()
+        closed_conn.pool = Mock()
+        closed_conn.pool.urlopen.return_value = Mock(
+            data=six.b('{}'), status=200, **{'getheaders.return_value': {}})
+        assert transport.perform_request('GET', '/foo/Item/1') == (200, {})
+        assert closed_conn.pool.urlopen.call_count == 1
+
+    @patch('nefertari_es.connections.time.sleep')
+    def test_read_retry_on_status(self, mock_sleep):
+        conn = ESHttpConnection(read_retries=1, read_retry_on_status=(500,))
+        assert conn.read_retry_on_status == (500,)
+        conn.pool = Mock()
+        conn.pool.urlopen.return_value = Mock(data=six.b('{}'), status=500)
+        with pytest.raises(JHTTPInternalServerError):
+            conn.perform_request('GET', '/foo/Item/1')
+        assert conn.pool.urlopen.call_count == 2
+
+
+    def test_latency_ewma(self):
+        conn = ESHttpConnection(latency_decay=0.5)
+        assert conn.latency_ewma is None
+        conn._record_latency(1.0)
+        assert conn.latency_ewma == 1.0
+        conn._record_latency(3.0)
+        assert conn.latency_ewma == 2.0
+
+
+class TestCircuitBreaker(object):
+
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        assert breaker.allow_request()
+        breaker.record_success(0.1)
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow_request()
+
+    def test_slow_requests(self):
+        breaker = CircuitBreaker(failure_threshold=1, latency_threshold=1)
+        breaker.record_success(0.5)
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.record_success(2)
+        assert breaker.state == CircuitBreaker.OPEN
+
+    @patch('nefertari_es.connections.time')
+    def test_half_open(self, mock_time):
+        mock_time.time.return_value = 100
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+        mock_time.time.return_value = 111
+        assert breaker.allow_request()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow_request()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        mock_time.time.return_value = 122
+        assert breaker.allow_request()
+        breaker.record_success(0.1)
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.to_dict() == dict(
+            state='closed', failures=0, opened=2, rejected=1)
+
+
+class TestTransportParams(object):
+
+    def test_transport_params(self):
+        settings = dictset({
+            'maxsize': '25',
+            'timeout': '2.5',
+            'retry_on_timeout': 'true',
+            'retry_on_status': '502, 503',
+            'read_retry_on_status': '500',
+            'http_auth': 'user:pass',
+            'index_name': 'foo',
+        })
+        assert transport_params(settings) == {
+            'maxsize': 25,
+            'timeout': 2.5,
+            'retry_on_timeout': True,
+            'retry_on_status': (502, 503),
+            'read_retry_on_status': (500,),
+            'http_auth': 'user:pass',
+        }
+
+    def test_transport_params_empty(self):
+        assert transport_params(dictset()) == {}
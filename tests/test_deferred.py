@@ -0,0 +1,146 @@
+from mock import patch, Mock, call
+import pytest
+
+from nefertari_es import deferred
+from .fixtures import simple_model
+
+
+class TestWriteBehindQueue(object):
+
+    @patch('nefertari_es.documents._bulk')
+    def test_flush(self, mock_bulk):
+        queue = deferred.WriteBehindQueue()
+        queue._ensure_started = Mock()
+        queue.put({'_id': 1}, 'client1')
+        queue.put({'_id': 2}, 'client1', op_type='delete')
+        queue.put({'_id': 3}, 'client2')
+        assert queue.pending() == 3
+        queue.flush()
+        assert queue.pending() == 0
+        assert mock_bulk.call_count == 2
+        mock_bulk.assert_any_call(
+            [{'_id': 1, '_op_type': 'index'},
+             {'_id': 2, '_op_type': 'delete'}],
+            'client1', op_type=None)
+        mock_bulk.assert_any_call(
+            [{'_id': 3, '_op_type': 'index'}], 'client2', op_type=None)
+
+    @patch('nefertari_es.documents._bulk')
+    def test_flush_batch_size(self, mock_bulk):
+        queue = deferred.WriteBehindQueue(batch_size=2)
+        queue._ensure_started = Mock()
+        for idx in range(5):
+            queue.put({'_id': idx}, 'client1')
+        queue.flush()
+        assert mock_bulk.call_count == 3
+
+    @patch('nefertari_es.documents._bulk')
+    def test_put_queue_full(self, mock_bulk):
+        queue = deferred.WriteBehindQueue(maxsize=1)
+        queue._ensure_started = Mock()
+        queue.put({'_id': 1}, 'client1')
+        assert not mock_bulk.called
+        queue.put({'_id': 2}, 'client1', op_type='delete')
+        # Queued action is sent first to keep actions order
+        assert mock_bulk.call_args_list == [
+            call([{'_id': 1, '_op_type': 'index'}], 'client1', op_type=None),
+            call([{'_id': 2, '_op_type': 'delete'}], 'client1',
+                 op_type=None),
+        ]
+        assert queue.pending() == 0
+
+    @patch('nefertari_es.documents._bulk')
+    def test_metrics_hook(self, mock_bulk):
+        mock_bulk.side_effect = [1, Exception('foo')]
+        hook = Mock()
+        queue = deferred.WriteBehindQueue(metrics_hook=hook)
+        queue._ensure_started = Mock()
+        queue.put({'_id': 1}, 'client1')
+        queue.put({'_id': 2}, 'client2')
+        queue.flush()
+        stats = hook.call_args[0][0]
+        assert stats['flushed'] == 1
+        assert stats['failed'] == 1
+        assert stats['pending'] == 0
+        assert stats['overflow'] == 0
+
+    @patch('nefertari_es.documents._bulk')
+    def test_background_thread_flushes(self, mock_bulk):
+        queue = deferred.WriteBehindQueue(flush_interval=0.01)
+        queue.put({'_id': 1}, 'client1')
+        queue.close()
+        mock_bulk.assert_called_once_with(
+            [{'_id': 1, '_op_type': 'index'}], 'client1', op_type=None)
+        assert not queue._thread.is_alive()
+
+
+class TestDeferredWrites(object):
+
+    @patch('nefertari_es.documents.get_write_queue')
+    @patch('nefertari_es.documents.DocType.save')
+    def test_save_deferred(self, mock_save, mock_queue, simple_model):
+        item = simple_model(name='foo', price=1)
+        item.save(deferred=True)
+        assert not mock_save.called
+        assert item._id is not None
+        action, client = mock_queue().put.call_args[0]
+        assert action['_id'] == item._id
+        assert action['_source'] == {'name': 'foo', 'price': 1}
+        assert client is item.connection
+        assert mock_queue().put.call_args[1] == {'op_type': 'index'}
+
+    @patch('nefertari_es.documents.get_write_queue')
+    @patch('nefertari_es.documents.DocType.save')
+    def test_save_deferred_class_setting(
+            self, mock_save, mock_queue, simple_model):
+        simple_model._deferred_writes = True
+        item = simple_model(name='foo', price=1)
+        item.save()
+        assert not mock_save.called
+        assert mock_queue().put.called
+        item.save(deferred=False)
+        assert mock_save.called
+
+    @patch('nefertari_es.documents.get_write_queue')
+    @patch('nefertari_es.documents.DocType.delete')
+    def test_delete_deferred(self, mock_delete, mock_queue, simple_model):
+        item = simple_model(name='foo', price=1, _id='1')
+        item.delete(deferred=True)
+        assert not mock_delete.called
+        mock_queue().put.assert_called_once_with(
+            {'_id': '1', '_type': 'Item'}, item.connection,
+            op_type='delete')
+
+    @patch('nefertari_es.documents.get_write_queue')
+    @patch('nefertari_es.documents.DocType.save')
+    def test_save_deferred_params(self, mock_save, mock_queue, simple_model):
+        item = simple_model(name='foo', price=1)
+        item.save(deferred=True, op_type='create', version=3,
+                  version_type='external', refresh=False)
+        action, client = mock_queue().put.call_args[0]
+        assert action['_version'] == 3
+        assert action['_version_type'] == 'external'
+        assert mock_queue().put.call_args[1] == {'op_type': 'create'}
+
+    @patch('nefertari_es.documents.get_write_queue')
+    @patch('nefertari_es.documents.DocType.save')
+    def test_save_deferred_unsupported_params(
+            self, mock_save, mock_queue, simple_model):
+        item = simple_model(name='foo', price=1)
+        with pytest.raises(ValueError) as ex:
+            item.save(deferred=True, refresh=True, index='foo')
+        assert 'index, refresh' in str(ex.value)
+        assert not mock_queue().put.called
+        assert not mock_save.called
+
+    @patch('nefertari_es.documents.get_write_queue')
+    @patch('nefertari_es.documents.DocType.delete')
+    def test_delete_deferred_params(
+            self, mock_delete, mock_queue, simple_model):
+        item = simple_model(name='foo', price=1, _id='1')
+        item.delete(deferred=True, version=2)
+        mock_queue().put.assert_called_once_with(
+            {'_id': '1', '_type': 'Item', '_version': 2}, item.connection,
+            op_type='delete')
+        with pytest.raises(ValueError):
+            item.delete(deferred=True, op_type='create')
@@ -1,8 +1,11 @@
 import pytest
-from mock import patch, Mock, call
+import six
+from mock import patch, Mock, call, ANY
 from nefertari.json_httpexceptions import (
     JHTTPBadRequest,
+    JHTTPConflict,
     JHTTPNotFound,
+    exception_response,
 )
 
 from .fixtures import (
@@ -289,6 +292,248 @@ class TestBaseDocument(object):
             _raise_on_empty=True, _limit=1, _item_request=True, foo=1)
         assert item == 'one'
 
+    def test_get_item_pk_realtime(self, id_model):
+        id_model._get_realtime = Mock(return_value='one')
+        id_model.get_collection = Mock()
+        item = id_model.get_item(id='1', _fields=['name'])
+        id_model._get_realtime.assert_called_once_with(
+            '1', _fields=['name'], _strict=True, routing=None)
+        assert not id_model.get_collection.called
+        assert item == 'one'
+
+    def test_get_item_pk_realtime_not_found(self, id_model):
+        id_model._get_realtime = Mock(return_value=None)
+        with pytest.raises(JHTTPNotFound) as ex:
+            id_model.get_item(id='1')
+        assert 'resource not found' in str(ex.value)
+        assert id_model.get_item(id='1', _raise_on_empty=False) is None
+
+    def test_get_item_pk_realtime_fallback(self, simple_model):
+        simple_model._get_realtime = Mock(return_value=None)
+        simple_model.get_collection = Mock(return_value=['one'])
+        item = simple_model.get_item(name='foo')
+        simple_model._get_realtime.assert_called_once_with(
+            'foo', _fields=None, _strict=True, routing=None)
+        simple_model.get_collection.assert_called_once_with(
+            _raise_on_empty=True, _limit=1, _item_request=True, name='foo')
+        assert item == 'one'
+
+    def test_get_item_pk_realtime_pk_changed(self, simple_model):
+        # Document was indexed with ID "foo" and its primary key was
+        # changed later
+        simple_model._get_realtime = Mock(
+            return_value=simple_model(name='bar'))
+        simple_model.get_collection = Mock(return_value=['one'])
+        assert simple_model.get_item(name='foo') == 'one'
+        simple_model.get_collection.assert_called_once_with(
+            _raise_on_empty=True, _limit=1, _item_request=True, name='foo')
+
+    def test_get_item_pk_realtime_pk_matches(self, simple_model):
+        item = simple_model(name='foo')
+        simple_model._get_realtime = Mock(return_value=item)
+        simple_model.get_collection = Mock()
+        assert simple_model.get_item(name=['foo']) is item
+        assert not simple_model.get_collection.called
+
+    def test_pk_lookup_id(self, simple_model):
+        assert simple_model._pk_lookup_id({'name': 'foo'}) == 'foo'
+        assert simple_model._pk_lookup_id({'name': ['foo']}) == 'foo'
+        assert simple_model._pk_lookup_id({'_id': 1, '__x': 2}) == '1'
+        assert simple_model._pk_lookup_id(
+            {'name': 'foo', '_raise_on_empty': True,
+             '_fields': ['name']}) == 'foo'
+        assert simple_model._pk_lookup_id({'name': 'a', 'price': 1}) is None
+        assert simple_model._pk_lookup_id({'name': ['a', 'b']}) is None
+        assert simple_model._pk_lookup_id({'name': '_all'}) is None
+        assert simple_model._pk_lookup_id({'price': 1}) is None
+
+    @patch('nefertari_es.documents.connections')
+    def test_get_realtime(self, mock_conn, simple_model):
+        simple_model._doc_type.index = 'foo'
+        es = mock_conn.get_connection()
+        es.get.return_value = {
+            'found': True, '_id': 'a', '_type': 'Item',
+            '_source': {'name': 'a'}}
+        item = simple_model._get_realtime('a', _fields=['name', '-price'])
+        es.get.assert_called_once_with(
+            index='foo', doc_type='Item', id='a', ignore=404,
+            _source_include=['name'], _source_exclude=['price'])
+        assert isinstance(item, simple_model)
+        assert item.name == 'a'
+        es.get.return_value = {'found': False}
+        assert simple_model._get_realtime('a') is None
+
+    @patch('nefertari_es.Settings', {})
+    def test_connection_aliases(self, simple_model):
+        assert simple_model._read_alias() == 'default'
+        assert simple_model._write_alias() == 'default'
+        with patch('nefertari_es.Settings', {'read_using': 'read'}):
+            assert simple_model._read_alias() == 'read'
+            assert simple_model._write_alias() == 'default'
+            simple_model._read_using = 'analytics'
+            simple_model._write_using = 'primary'
+            assert simple_model._read_alias() == 'analytics'
+            assert simple_model._write_alias() == 'primary'
+
+    @patch('nefertari_es.documents.connections')
+    def test_read_write_routing(self, mock_conn, simple_model):
+        simple_model._read_using = 'read'
+        simple_model._write_using = 'write'
+        assert simple_model.search()._using == 'read'
+        simple_model._get_realtime('a')
+        mock_conn.get_connection.assert_called_with('read')
+        item = simple_model(name='a')
+        assert item._get_connection() is (
+            mock_conn.get_connection.return_value)
+        mock_conn.get_connection.assert_called_with('write')
+
+    def test_sync_routing(self, simple_model):
+        simple_model._routing_field = 'price'
+        item = simple_model(name='a', price=5)
+        item._sync_routing()
+        assert item.meta.routing == '5'
+        item.price = 6
+        with pytest.raises(JHTTPBadRequest) as ex:
+            item._sync_routing()
+        assert "can't be changed" in str(ex.value)
+        with pytest.raises(JHTTPBadRequest) as ex:
+            simple_model(name='b')._sync_routing()
+        assert "requires value of routing field 'price'" in str(ex.value)
+        simple_model._routing_required = False
+        item = simple_model(name='b')
+        item._sync_routing()
+        assert 'routing' not in item.meta
+
+    @patch('nefertari_es.documents.DocType.save')
+    def test_save_routing(self, mock_save, simple_model):
+        simple_model._routing_field = 'price'
+        item = simple_model(name='foo', price=3)
+        item.save()
+        assert item.meta.routing == '3'
+        with pytest.raises(JHTTPBadRequest):
+            simple_model(name='bar').save()
+        assert mock_save.call_count == 1
+
+    def test_get_item_routing(self, simple_model):
+        simple_model._routing_field = 'price'
+        one = simple_model(name='a', price=5)
+        simple_model._get_realtime = Mock(return_value=one)
+        simple_model.get_collection = Mock(return_value=['two'])
+        assert simple_model.get_item(name='a', price=5) is one
+        simple_model._get_realtime.assert_called_once_with(
+            'a', _fields=None, _strict=True, routing='5')
+        # Routing is required, so document can only be searched for
+        assert simple_model.get_item(name='a') == 'two'
+        assert simple_model._get_realtime.call_count == 1
+
+    def test_get_item_multiple_routing_values(self, simple_model):
+        simple_model._routing_field = 'price'
+        simple_model._get_realtime = Mock()
+        simple_model.get_collection = Mock(return_value=['two'])
+        assert simple_model.get_item(name='a', price=[5, 6]) == 'two'
+        assert not simple_model._get_realtime.called
+        simple_model.get_collection.assert_called_once_with(
+            _limit=1, _item_request=True, name='a', price=[5, 6],
+            _raise_on_empty=True)
+
+    def test_get_item_routing_mismatch(self, simple_model):
+        simple_model._routing_field = 'price'
+        other = simple_model(name='a', price=6)
+        simple_model._get_realtime = Mock(return_value=other)
+        simple_model.get_collection = Mock(return_value=['two'])
+        assert simple_model.get_item(name='a', price=5) == 'two'
+        simple_model._get_realtime.assert_called_once_with(
+            'a', _fields=None, _strict=True, routing='5')
+
+    def test_pinned_routing(self, simple_model):
+        simple_model._routing_field = 'price'
+        assert simple_model._pinned_routing({'price': 1}) == '1'
+        assert simple_model._pinned_routing({'price': [2, 1, 2]}) == '1,2'
+        assert simple_model._pinned_routing({'name': 'a'}) is None
+        assert simple_model._pinned_routing({'price': [1, None]}) is None
+        assert simple_model._routing_values({'price': [2, 1, 2]}) == [
+            '1', '2']
+
+    @patch('nefertari_es.documents.connections')
+    def test_get_realtime_routing(self, mock_conn, simple_model):
+        simple_model._doc_type.index = 'foo'
+        es = mock_conn.get_connection()
+        es.get.return_value = {'found': False}
+        simple_model._get_realtime('a', routing='5')
+        es.get.assert_called_once_with(
+            index='foo', doc_type='Item', id='a', ignore=404, routing='5')
+
+    @patch('nefertari_es.documents._perform_in_chunks')
+    def test_update_many_routing(self, mock_chunks, simple_model):
+        simple_model._routing_field = 'price'
+        item = simple_model(name='a', price=5, _id='a')
+        simple_model._update_many([item], {'name': 'b'})
+        actions = mock_chunks.call_args[0][0]
+        assert actions[0]['_routing'] == '5'
+
+    def test_partition_index(self, simple_model):
+        simple_model._partition_field = 'price'
+        simple_model._doc_type.index = 'foo'
+        with patch('nefertari_es.documents.partition_name') as mock_name:
+            item = simple_model(name='a', price=5)
+            assert item._get_index() == mock_name.return_value
+            mock_name.assert_called_once_with('foo', 5, 'monthly')
+            assert item.to_dict(include_meta=True)['_index'] == (
+                mock_name.return_value)
+        item.meta.index = 'foo-2016.01'
+        assert item._get_index() == 'foo-2016.01'
+        with pytest.raises(JHTTPBadRequest) as ex:
+            simple_model(name='b')._get_index()
+        assert "requires value of partition field 'price'" in str(ex.value)
+
+    def test_partition_search(self, simple_model):
+        simple_model._partition_field = 'price'
+        simple_model._doc_type.index = 'foo'
+        assert simple_model.search()._index == ['foo-*']
+        params = {'price__gte': '2016-01-20', 'price__lt': '2016-03-01',
+                  'name': 'a'}
+        date_range, partitions = simple_model._partition_search(params)
+        assert params == {'name': 'a'}
+        assert date_range == {'gte': '2016-01-20', 'lt': '2016-03-01'}
+        assert partitions == ['foo-2016.01', 'foo-2016.02', 'foo-2016.03']
+        assert simple_model._partition_search({'price__gt': '2016-01-20'}) == (
+            {'gt': '2016-01-20'}, None)
+        assert simple_model._partition_search(
+            {'price': ['2016-02-01', '2016-01-05', '2016-01-06']}) == (
+            {}, ['foo-2016.01', 'foo-2016.02'])
+        assert simple_model._partition_search({}) == ({}, None)
+        # Date math is left to ES
+        assert simple_model._partition_search(
+            {'price__gte': 'now-7d', 'price__lt': 'now'}) == (
+            {'gte': 'now-7d', 'lt': 'now'}, None)
+        assert simple_model._partition_search({'price': 'now'}) == (
+            {}, None)
+
+    def test_partition_build_search(self, simple_model):
+        simple_model._partition_field = 'price'
+        simple_model._doc_type.index = 'foo'
+        search_obj, _, _ = simple_model._build_search(
+            price__gte='2016-01-20', price__lte='2016-02-01')
+        assert search_obj._index == ['foo-2016.01', 'foo-2016.02']
+        assert search_obj._params == {'ignore_unavailable': True}
+        assert search_obj.to_dict()['query']['filtered']['filter'] == {
+            'range': {'price': {'gte': '2016-01-20', 'lte': '2016-02-01'}}}
+
+    @patch('nefertari_es.documents.DocType.save')
+    def test_save_sets_id_from_pk(self, mock_save, simple_model):
+        item = simple_model(name='foo')
+        item.save()
+        assert item._id == 'foo'
+        mock_save.assert_called_once_with(refresh=True)
+
+    @patch.dict('nefertari_es.Settings', {'refresh_on_save': 'false'})
+    @patch('nefertari_es.documents.DocType.save')
+    def test_save_refresh_setting(self, mock_save, id_model):
+        item = id_model(name='foo')
+        item.save()
+        assert item._id is None
+        mock_save.assert_called_once_with(refresh=False)
+
     @patch('nefertari_es.documents._bulk')
     def test_update_many(self, mock_bulk, simple_model):
         item = simple_model(name='first', price=2)
@@ -378,6 +623,86 @@ class TestBaseDocument(object):
         assert obj.name == 'foo'
         assert obj.price == 123
 
+    @patch('nefertari_es.documents.DocType.save')
+    def test_get_or_create_atomic_created(self, mock_save, simple_model):
+        obj, created = simple_model.get_or_create(
+            _atomic=True, name='foo', defaults={'price': 123})
+        assert created
+        assert obj._id == 'foo'
+        assert obj.price == 123
+        mock_save.assert_called_once_with(refresh=True, op_type='create')
+
+    @patch('nefertari_es.documents.get_write_queue')
+    @patch('nefertari_es.documents.BaseDocument._get_realtime')
+    @patch('nefertari_es.documents.DocType.save')
+    def test_get_or_create_atomic_deferred_class(
+            self, mock_save, mock_get, mock_queue, simple_model):
+        simple_model._deferred_writes = True
+        mock_save.side_effect = JHTTPConflict()
+        obj, created = simple_model.get_or_create(
+            _atomic=True, name='foo', defaults={'price': 123})
+        assert not created
+        assert obj is mock_get.return_value
+        mock_save.assert_called_once_with(refresh=True, op_type='create')
+        assert not mock_queue().put.called
+
+    @patch('nefertari_es.documents.BaseDocument._get_realtime')
+    @patch('nefertari_es.documents.DocType.save')
+    def test_get_or_create_atomic_exists(
+            self, mock_save, mock_get, simple_model):
+        mock_save.side_effect = JHTTPConflict()
+        obj, created = simple_model.get_or_create(
+            _atomic=True, price=1, defaults={'name': 'foo'})
+        assert not created
+        assert obj is mock_get.return_value
+        mock_get.assert_called_once_with(
+            simple_model._lookup_id({'price': 1}), using='default',
+            index=None, routing=None)
+
+    @patch('nefertari_es.documents.BaseDocument._get_realtime')
+    @patch('nefertari_es.documents.DocType.save')
+    def test_get_or_create_atomic_exists_routing(
+            self, mock_save, mock_get, simple_model):
+        simple_model._routing_field = 'price'
+        mock_save.side_effect = JHTTPConflict()
+        obj, created = simple_model.get_or_create(
+            _atomic=True, name='a', defaults={'price': 7})
+        assert not created
+        mock_get.assert_called_once_with(
+            'a', using='default', index=None, routing='7')
+
+    def test_lookup_id(self, simple_model, id_model):
+        assert simple_model._lookup_id({'name': 'foo', 'price': 1}) == 'foo'
+        assert id_model._lookup_id({'id': 5}) == '5'
+        first = simple_model._lookup_id({'price': 1, 'foo': 'bar'})
+        second = simple_model._lookup_id({'foo': 'bar', 'price': 1})
+        assert first == second
+        assert first != simple_model._lookup_id({'price': 2, 'foo': 'bar'})
+
+    @patch('nefertari_es.documents._bulk_create')
+    def test_get_or_create_many(self, mock_create, simple_model):
+        simple_model._doc_type.index = 'foo'
+        mock_create.return_value = [True, False]
+        conn = Mock()
+        conn.mget.return_value = {'docs': [
+            {'_id': 'b', '_type': 'Item', 'found': True,
+             '_source': {'name': 'b', 'price': 5}}]}
+        with patch.object(simple_model, 'connection', conn):
+            result = simple_model.get_or_create_many([
+                {'name': 'a', 'defaults': {'price': 1}},
+                {'name': 'b', 'defaults': {'price': 2}},
+            ])
+        (first, first_created), (second, second_created) = result
+        assert first_created
+        assert first.name == 'a'
+        assert first.price == 1
+        assert not second_created
+        assert second.price == 5
+        actions = mock_create.call_args[0][0]
+        assert [a['_id'] for a in actions] == ['a', 'b']
+        conn.mget.assert_called_once_with(
+            index='foo', doc_type='Item', body={'ids': ['b']})
+
     def test_get_null_values(
             self, simple_model, story_model, person_model):
         assert simple_model.get_null_values() == {
@@ -456,6 +781,122 @@ class TestBaseDocument(object):
         myobj.update_iterables("", attr='settings', unique=False)
         assert myobj.settings == []
 
+    def test_update_iterables_list_scripted(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IdField(primary_key=True)
+            settings = fields.ListField()
+        myobj = MyModel(_id='1', settings=['a', 'b', 'c'])
+        myobj._created = False
+        myobj._doc_type.index = 'foo'
+        conn = Mock()
+        conn.update.return_value = {
+            '_version': 3,
+            'get': {'_source': {'settings': ['a', 'c', 'd', 'x']}}}
+        with patch.object(MyModel, 'connection', conn):
+            myobj.update_iterables(
+                ['-b', 'd', 'a', 'd'], attr='settings', unique=True)
+        conn.update.assert_called_once_with(
+            index='foo', doc_type='MyModel', id='1',
+            body={'script': docs.LIST_UPDATE_SCRIPT, 'params': {
+                'field': 'settings', 'add': ['d'], 'remove': ['b'],
+                'unique': True}},
+            retry_on_conflict=3, refresh=True, fields='_source')
+        assert myobj.settings == ['a', 'c', 'd', 'x']
+        assert myobj.meta.version == 3
+        assert myobj.version == 1
+
+    @patch.dict('nefertari_es.Settings', {'refresh_on_save': 'false'})
+    def test_update_iterables_scripted_version(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IdField(primary_key=True)
+            settings = fields.ListField()
+        myobj = MyModel(_id='1', settings=['a'], version=1)
+        myobj._created = False
+        myobj._doc_type.index = 'foo'
+        conn = Mock()
+        conn.update.return_value = {
+            'get': {'_source': {'settings': ['a', 'b'], 'version': 5}}}
+        with patch.object(MyModel, 'connection', conn):
+            myobj.update_iterables(['b'], attr='settings')
+        assert conn.update.call_args[1]['refresh'] is False
+        assert myobj.version == 5
+
+    @patch.object(docs, '_scripting_disabled', False)
+    def test_update_iterables_scripting_disabled(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IdField(primary_key=True)
+            settings = fields.ListField()
+        myobj = MyModel(_id='1', settings=['a'], version=1)
+        myobj._created = False
+        myobj._doc_type.index = 'foo'
+        conn = Mock()
+        conn.update.side_effect = exception_response(
+            400, explanation=six.b(
+                'scripts of type [inline], operation [update] and lang '
+                '[groovy] are disabled'))
+        with patch.object(MyModel, 'connection', conn):
+            with patch.object(MyModel, 'save') as mock_save:
+                myobj.update_iterables(['b'], attr='settings')
+                mock_save.assert_called_once_with(None)
+                assert myobj.settings == ['a', 'b']
+                assert myobj.version == 1
+                assert docs._scripting_disabled
+                myobj.update_iterables(['c'], attr='settings')
+                assert mock_save.call_count == 2
+        assert conn.update.call_count == 1
+
+    def test_update_iterables_other_bad_request(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IdField(primary_key=True)
+            settings = fields.ListField()
+        myobj = MyModel(_id='1', settings=['a'])
+        myobj._doc_type.index = 'foo'
+        conn = Mock()
+        conn.update.side_effect = exception_response(
+            400, explanation=six.b('failed to parse'))
+        with patch.object(MyModel, 'connection', conn):
+            with pytest.raises(JHTTPBadRequest):
+                myobj.update_iterables(['b'], attr='settings')
+        assert not docs._scripting_disabled
+
+    @patch.dict('nefertari_es.Settings', {'scripted_updates': 'false'})
+    def test_update_iterables_scripted_updates_off(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IdField(primary_key=True)
+            settings = fields.ListField()
+        myobj = MyModel(_id='1', settings=['a'])
+        conn = Mock()
+        with patch.object(MyModel, 'connection', conn):
+            with patch.object(MyModel, 'save') as mock_save:
+                myobj.update_iterables(['b'], attr='settings')
+        mock_save.assert_called_once_with(None)
+        assert not conn.update.called
+
+    def test_update_iterables_list_keeps_order(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IdField(primary_key=True)
+            settings = fields.ListField()
+        myobj = MyModel(settings=['c', 'a', 'b', 'a'])
+        myobj.update_iterables(
+            ['-a', 'd'], attr='settings', save=False)
+        assert myobj.settings == ['c', 'b', 'd']
+
+    def test_update_iterables_dict_scripted(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IdField(primary_key=True)
+            settings = fields.DictField()
+        myobj = MyModel(_id='1', settings={'a': 1, 'b': 2})
+        myobj._doc_type.index = 'foo'
+        conn = Mock()
+        conn.update.return_value = {}
+        with patch.object(MyModel, 'connection', conn):
+            myobj.update_iterables(
+                {'-a': None, 'c': 3}, attr='settings')
+        body = conn.update.call_args[1]['body']
+        assert body == {'script': docs.DICT_UPDATE_SCRIPT, 'params': {
+            'field': 'settings', 'set_values': {'c': 3}, 'remove': ['a']}}
+        assert myobj.settings == {'b': 2, 'c': 3}
+
     def test_is_created(self, simple_model):
         item = simple_model()
         assert item._created
@@ -526,6 +967,36 @@ class TestHelpers(object):
             actions=[{'id': 1, '_op_type': 'delete'}])
         assert result == 5
 
+    @patch('nefertari_es.documents.helpers')
+    def test_bulk_no_op_type(self, mock_helpers):
+        mock_helpers.bulk.return_value = (1, None)
+        docs._bulk([{'id': 1, '_op_type': 'update'}], 'foo', None)
+        mock_helpers.bulk.assert_called_once_with(
+            client='foo',
+            actions=[{'id': 1, '_op_type': 'update'}])
+
+    @patch('nefertari_es.documents.helpers')
+    def test_bulk_create(self, mock_helpers):
+        mock_helpers.streaming_bulk.return_value = [
+            (True, {'create': {'status': 201}}),
+            (False, {'create': {'status': 409, 'error': 'exists'}}),
+        ]
+        result = docs._bulk_create([{'_id': 1}, {'_id': 2}], 'foo')
+        assert result == [True, False]
+        mock_helpers.streaming_bulk.assert_called_once_with(
+            'foo', [{'_id': 1, '_op_type': 'create'},
+                    {'_id': 2, '_op_type': 'create'}],
+            raise_on_error=False, chunk_size=500)
+
+    @patch('nefertari_es.documents.helpers')
+    def test_bulk_create_error(self, mock_helpers):
+        mock_helpers.streaming_bulk.return_value = [
+            (False, {'create': {'status': 400, 'error': 'bad doc'}}),
+        ]
+        with pytest.raises(Exception) as ex:
+            docs._bulk_create([{'_id': 1}], 'foo')
+        assert 'bad doc' in str(ex.value)
+
     @patch('nefertari_es.Settings')
     @patch('nefertari_es.documents.helpers')
     def test_bulk_with_refresh(self, mock_helpers, mock_settings):
@@ -540,6 +1011,18 @@ class TestHelpers(object):
             refresh=True)
         assert result == 5
 
+    @patch('nefertari_es.documents.connections')
+    def test_count_search_routing(self, mock_conn):
+        es = mock_conn.get_connection()
+        es.count.return_value = {'count': 4}
+        search_obj = Mock(_params={'routing': '5'})
+        assert docs._count_search(search_obj) == 4
+        es.count.assert_called_once_with(
+            index=search_obj._index, doc_type=search_obj._doc_type,
+            body=search_obj.to_dict(), routing='5')
+        search_obj = Mock(_params={})
+        assert docs._count_search(search_obj) == search_obj.count()
+
 
 @patch('nefertari_es.documents.BaseDocument.search')
 class TestGetCollection(object):
@@ -600,6 +1083,13 @@ class TestGetCollection(object):
             'terms', foo=[1])
         assert result == mock_search().filter().execute().hits
 
+    def test_routing_param(self, mock_search, simple_model):
+        simple_model._routing_field = 'price'
+        simple_model.get_collection(price=[5, 3])
+        mock_search().filter.assert_called_once_with('terms', price=[5, 3])
+        mock_search().filter().params.assert_called_once_with(
+            routing='3,5')
+
     def test_count_param(self, mock_search, simple_model):
         result = simple_model.get_collection(_count=True)
         mock_search.assert_called_once_with()
@@ -634,6 +1124,21 @@ class TestGetCollection(object):
         except JHTTPNotFound:
             raise Exception('Unexpected error')
 
+    @patch('nefertari_es.documents.get_slow_query_log')
+    def test_slow_query_log(self, mock_slow_log, mock_search, simple_model):
+        result = simple_model.get_collection(q='foo')
+        search_obj = mock_search().query()
+        mock_slow_log().check.assert_called_once_with(
+            simple_model, search_obj, search_obj.execute(), ANY)
+        assert result == search_obj.execute().hits
+
+    @patch('nefertari_es.documents.get_slow_query_log')
+    def test_slow_query_log_disabled(
+            self, mock_slow_log, mock_search, simple_model):
+        mock_slow_log().enabled = False
+        simple_model.get_collection(q='foo')
+        assert not mock_slow_log().check.called
+
 class TestSyncRelatedMixin(object):
     def test_mixin_included_in_doc(self):
         assert docs.SyncRelatedMixin in docs.BaseDocument.__mro__
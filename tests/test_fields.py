@@ -1,4 +1,5 @@
 import datetime
+from dateutil import tz
 from mock import Mock, patch
 
 import pytest
@@ -69,6 +70,58 @@ class TestFields(object):
         assert val.total_seconds() == 600
 
 
+class TestMappingOptions(object):
+
+    def test_string_options(self):
+        field = fields.StringField(
+            index='not_analyzed', doc_values=False, norms=False,
+            eager_global_ordinals=True, required=True, foo=1,
+            fields={'raw': fields.KeywordField(ignore_above=256)})
+        assert field.to_dict() == {
+            'type': 'string',
+            'index': 'not_analyzed',
+            'doc_values': False,
+            'norms': False,
+            'eager_global_ordinals': True,
+            'fields': {'raw': {
+                'type': 'string', 'index': 'not_analyzed',
+                'ignore_above': 256}},
+        }
+        assert field._required
+
+    def test_keyword_field(self):
+        assert fields.KeywordField().to_dict() == {
+            'type': 'string', 'index': 'not_analyzed'}
+        with pytest.raises(ValueError):
+            fields.KeywordField(ignore_above='256')
+
+    def test_custom_mapping_overridden(self):
+        field = fields.DictField(enabled=True, dynamic='strict')
+        assert field.to_dict() == {
+            'type': 'object', 'enabled': True, 'dynamic': 'strict'}
+        field = fields.DateTimeField(format='date', doc_values=False)
+        assert field.to_dict() == {
+            'type': 'date', 'format': 'date', 'doc_values': False}
+
+    def test_unsupported_option(self):
+        with pytest.raises(ValueError) as ex:
+            fields.IntegerField(norms=False)
+        assert "'norms' is not supported by IntegerField" in str(ex.value)
+        with pytest.raises(ValueError):
+            fields.DictField(doc_values=False)
+
+    def test_invalid_value(self):
+        with pytest.raises(ValueError) as ex:
+            fields.StringField(doc_values='no')
+        assert "StringField mapping option 'doc_values'" in str(ex.value)
+        with pytest.raises(ValueError):
+            fields.IntegerField(index='yes')
+        with pytest.raises(ValueError):
+            fields.StringField(fields=['raw'])
+        assert fields.IntegerField(index=False).to_dict() == {
+            'type': 'integer', 'index': False}
+
+
 class TestDateTimeField(object):
 
     def test_to_python_no_data(self):
@@ -88,6 +141,29 @@ class TestDateTimeField(object):
         expected = datetime.datetime(year=2000, month=11, day=12)
         assert obj._to_python('2000-11-12') == expected
 
+    def test_to_python_canonical(self):
+        obj = fields.DateTimeField()
+        value = obj._to_python('2015-06-01T12:30:15Z')
+        assert value == datetime.datetime(
+            2015, 6, 1, 12, 30, 15, tzinfo=tz.tzutc())
+        assert value.utcoffset() == datetime.timedelta(0)
+        assert obj._to_python('2015-06-01T12:30:15') == datetime.datetime(
+            2015, 6, 1, 12, 30, 15)
+
+    @patch('nefertari_es.fields.parser')
+    def test_to_python_canonical_skips_dateutil(self, mock_parser):
+        obj = fields.DateTimeField()
+        obj._to_python('2015-06-01T12:30:15Z')
+        assert not mock_parser.parse.called
+
+    def test_to_python_fallback(self):
+        obj = fields.DateTimeField()
+        assert obj._to_python('2015-06-01T12:30:15.500Z') == (
+            datetime.datetime(
+                2015, 6, 1, 12, 30, 15, 500000, tzinfo=tz.tzutc()))
+        with pytest.raises(ValidationException):
+            obj._to_python('2015-13-01T12:30:15Z')
+
     def test_to_python_parse_failed(self):
         obj = fields.DateTimeField()
         with pytest.raises(ValidationException) as ex:
@@ -120,6 +196,12 @@ class TestTimeField(object):
         expected = datetime.time(17, 40)
         assert obj._to_python('2000-11-12 17:40') == expected
 
+    def test_to_python_canonical(self):
+        obj = fields.TimeField()
+        assert obj._to_python('17:40:05') == datetime.time(17, 40, 5)
+        with pytest.raises(ValidationException):
+            obj._to_python('25:40:05')
+
     def test_to_python_parse_failed(self):
         obj = fields.TimeField()
         with pytest.raises(ValidationException) as ex:
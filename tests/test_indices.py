@@ -0,0 +1,386 @@
+import datetime
+import errno
+import json
+import os
+import socket
+
+import pytest
+from mock import patch, Mock, call
+from nefertari.json_httpexceptions import JHTTPNotFound
+
+from nefertari_es import indices
+
+
+@pytest.fixture
+def conn():
+    with patch('nefertari_es.indices.connections') as mock_conns:
+        yield mock_conns.get_connection.return_value
+
+
+class TestAliases(object):
+
+    def test_get_alias_indices(self, conn):
+        conn.indices.get_alias.return_value = {'foo_v2': {}, 'foo_v1': {}}
+        assert indices.get_alias_indices('foo') == ['foo_v1', 'foo_v2']
+        conn.indices.get_alias.side_effect = JHTTPNotFound()
+        assert indices.get_alias_indices('foo') == []
+
+    def test_next_index_name(self, conn):
+        conn.indices.get_settings.return_value = {}
+        assert indices.next_index_name('foo') == 'foo_v1'
+        conn.indices.get_settings.return_value = {
+            'foo_v1': {}, 'foo_v10': {}, 'foo_vx': {}}
+        assert indices.next_index_name('foo') == 'foo_v11'
+        conn.indices.get_settings.assert_called_with(index='foo_v*')
+
+    @patch('nefertari_es.indices.create_index')
+    def test_create_versioned_index(self, mock_create, conn):
+        conn.indices.get_settings.return_value = {'foo_v1': {}}
+        doc_cls = Mock()
+        name = indices.create_versioned_index('foo', [doc_cls])
+        assert name == 'foo_v2'
+        mock_create.assert_called_once_with(
+            'foo_v2', [doc_cls], aliases=['foo'])
+        assert doc_cls._doc_type.index == 'foo'
+
+    def test_swap_alias(self, conn):
+        conn.indices.get_alias.return_value = {'foo_v1': {}}
+        assert indices.swap_alias('foo', 'foo_v2') == ['foo_v1']
+        conn.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': 'foo_v1', 'alias': 'foo'}},
+                {'add': {'index': 'foo_v2', 'alias': 'foo'}},
+            ]})
+
+
+class TestIndexSettings(object):
+
+    def test_flatten_settings(self):
+        assert indices.flatten_settings({
+            'index': {'number_of_replicas': 1, 'blocks': {'write': False}},
+            'index.refresh_interval': '30s',
+            'analysis': {'filter': ['a', 'b']},
+        }) == {
+            'number_of_replicas': '1',
+            'blocks.write': 'false',
+            'refresh_interval': '30s',
+            'analysis.filter': ['a', 'b'],
+        }
+
+    def test_diff_index_settings(self):
+        current = {'index': {
+            'number_of_shards': '5', 'number_of_replicas': '1',
+            'uuid': 'x', 'refresh_interval': '1s'}}
+        desired = {
+            'number_of_shards': 3, 'number_of_replicas': 1,
+            'refresh_interval': '30s', 'codec': 'best_compression',
+            'uuid': 'y'}
+        assert indices.diff_index_settings(current, desired) == (
+            {'refresh_interval': '30s'}, ['codec', 'number_of_shards'])
+
+    def test_update_index_settings(self, conn):
+        conn.indices.get_settings.return_value = {
+            'foo_v1': {'settings': {'index': {
+                'number_of_shards': '5', 'refresh_interval': '1s'}}}}
+        updated = indices.update_index_settings(
+            'foo', {'number_of_shards': 3, 'refresh_interval': '30s'})
+        assert updated == {'foo_v1': {'refresh_interval': '30s'}}
+        conn.indices.get_settings.assert_called_once_with(index='foo')
+        conn.indices.put_settings.assert_called_once_with(
+            index='foo_v1', body={'index': {'refresh_interval': '30s'}})
+
+    def test_update_index_settings_unchanged(self, conn):
+        conn.indices.get_settings.return_value = {
+            'foo': {'settings': {'index': {'refresh_interval': '30s'}}}}
+        assert indices.update_index_settings(
+            'foo', {'refresh_interval': '30s'}) == {}
+        assert not conn.indices.put_settings.called
+
+
+class TestMappings(object):
+
+    def test_diff_mapping(self):
+        live = {
+            'name': {'type': 'string'},
+            'price': {'type': 'long'},
+            'meta': {'properties': {'a': {'type': 'string'}}},
+            'slug': {'type': 'string', 'index': 'not_analyzed'},
+        }
+        desired = {
+            'name': {'type': 'string', 'fields': {
+                'raw': {'type': 'string', 'index': 'not_analyzed'}}},
+            'price': {'type': 'double'},
+            'meta': {'type': 'object', 'properties': {
+                'a': {'type': 'string'}, 'b': {'type': 'long'}}},
+            'slug': {'type': 'string', 'index': 'no'},
+            'tags': {'type': 'string'},
+        }
+        additions, conflicts = indices.diff_mapping(live, desired)
+        assert additions == {
+            'name': {'type': 'string', 'fields': {
+                'raw': {'type': 'string', 'index': 'not_analyzed'}}},
+            'meta': {'properties': {'b': {'type': 'long'}}},
+            'tags': {'type': 'string'},
+        }
+        assert sorted(conflicts) == [
+            'price: type long -> double',
+            "slug: index 'not_analyzed' -> 'no'",
+        ]
+
+    def test_diff_mapping_unchanged(self):
+        mapping = {'name': {'type': 'string', 'fields': {
+            'raw': {'type': 'string'}}}}
+        assert indices.diff_mapping(mapping, mapping) == ({}, [])
+
+    def _doc_cls(self, mapping):
+        doc_cls = Mock()
+        doc_cls._doc_type.name = 'Item'
+        doc_cls._doc_type.mapping.to_dict.return_value = {'Item': mapping}
+        return doc_cls
+
+    def test_update_mappings(self, conn):
+        conn.indices.get_mapping.return_value = {'foo_v1': {'mappings': {
+            'Item': {'properties': {'name': {'type': 'string'}}}}}}
+        doc_cls = self._doc_cls({'properties': {
+            'name': {'type': 'long'}, 'price': {'type': 'long'}}})
+        report = indices.update_mappings('foo', [doc_cls])
+        assert report == {'foo_v1': {'Item': {
+            'added': ['price'],
+            'conflicts': ['name: type string -> long']}}}
+        conn.indices.get_mapping.assert_called_once_with(index='foo')
+        conn.indices.put_mapping.assert_called_once_with(
+            index='foo_v1', doc_type='Item', body={'Item': {
+                'properties': {'price': {'type': 'long'}}}})
+
+    def test_update_mappings_new_type(self, conn):
+        conn.indices.get_mapping.return_value = {'foo': {'mappings': {}}}
+        mapping = {'_routing': {'required': True},
+                   'properties': {'name': {'type': 'string'}}}
+        report = indices.update_mappings('foo', [self._doc_cls(mapping)])
+        assert report == {'foo': {'Item': {
+            'added': ['name'], 'conflicts': []}}}
+        conn.indices.put_mapping.assert_called_once_with(
+            index='foo', doc_type='Item', body={'Item': mapping})
+
+    def test_update_mappings_unchanged(self, conn):
+        mapping = {'properties': {'name': {'type': 'string'}}}
+        conn.indices.get_mapping.return_value = {'foo': {'mappings': {
+            'Item': mapping}}}
+        assert indices.update_mappings('foo', [self._doc_cls(mapping)]) == {}
+        assert not conn.indices.put_mapping.called
+
+
+@pytest.fixture
+def marker_dir(tmpdir):
+    with patch.dict('nefertari_es.Settings',
+                    {'bulk_load_marker_dir': str(tmpdir)}):
+        yield tmpdir
+
+
+class TestBulkLoadMode(object):
+
+    def test_bulk_load_mode(self, conn, marker_dir):
+        conn.indices.get_settings.return_value = {
+            'foo_v1': {'settings': {'index': {'number_of_replicas': '2'}}}}
+        marker = marker_dir.join('nefertari_es_bulk_load_foo.json')
+        with indices.bulk_load_mode('foo', force_merge=True):
+            conn.indices.put_settings.assert_called_once_with(
+                index='foo_v1', body={'index': {
+                    'refresh_interval': '-1', 'number_of_replicas': '0'}})
+            assert json.loads(marker.read()) == {
+                'owner': {'host': socket.gethostname(), 'pid': os.getpid()},
+                'settings': {'foo_v1': {
+                    'refresh_interval': '1s', 'number_of_replicas': '2'}}}
+        conn.indices.put_settings.assert_called_with(
+            index='foo_v1', body={'index': {
+                'refresh_interval': '1s', 'number_of_replicas': '2'}})
+        assert not marker.exists()
+        conn.indices.optimize.assert_called_once_with(
+            index='foo', max_num_segments=1, request_timeout=600)
+        conn.cluster.health.assert_called_once_with(
+            index='foo', wait_for_status='green', timeout='600s',
+            request_timeout=600)
+
+    def test_bulk_load_mode_error(self, conn, marker_dir):
+        conn.indices.get_settings.return_value = {'foo': {'settings': {}}}
+        with pytest.raises(ValueError):
+            with indices.bulk_load_mode('foo', wait_for_status=None):
+                raise ValueError()
+        assert conn.indices.put_settings.call_count == 2
+        assert not conn.cluster.health.called
+        assert not marker_dir.join('nefertari_es_bulk_load_foo.json').exists()
+
+    def test_recover_bulk_load(self, conn, marker_dir):
+        assert not indices.recover_bulk_load('foo')
+        marker = marker_dir.join('nefertari_es_bulk_load_foo.json')
+        marker.write(json.dumps({'foo_v1': {'refresh_interval': '5s'}}))
+        assert indices.recover_bulk_load('foo')
+        conn.indices.put_settings.assert_called_once_with(
+            index='foo_v1', body={'index': {'refresh_interval': '5s'}})
+        assert not marker.exists()
+
+    def _write_marker(self, marker_dir, pid, host=None):
+        marker = marker_dir.join('nefertari_es_bulk_load_foo.json')
+        marker.write(json.dumps({
+            'owner': {'host': host or socket.gethostname(), 'pid': pid},
+            'settings': {'foo_v1': {'refresh_interval': '5s'}}}))
+        return marker
+
+    @patch('nefertari_es.indices.os.kill')
+    def test_recover_bulk_load_running(self, mock_kill, conn, marker_dir):
+        marker = self._write_marker(marker_dir, 123)
+        assert not indices.recover_bulk_load('foo')
+        mock_kill.assert_called_once_with(123, 0)
+        assert marker.exists()
+        assert indices.recover_bulk_load('foo', force=True)
+        assert not marker.exists()
+
+    def test_recover_bulk_load_other_host(self, conn, marker_dir):
+        marker = self._write_marker(marker_dir, os.getpid(), 'otherhost')
+        assert not indices.recover_bulk_load('foo')
+        assert marker.exists()
+        assert not conn.indices.put_settings.called
+
+    @patch('nefertari_es.indices.os.kill')
+    def test_recover_bulk_load_crashed(self, mock_kill, conn, marker_dir):
+        mock_kill.side_effect = OSError(errno.ESRCH, 'No such process')
+        marker = self._write_marker(marker_dir, 123)
+        assert indices.recover_bulk_load('foo')
+        conn.indices.put_settings.assert_called_once_with(
+            index='foo_v1', body={'index': {'refresh_interval': '5s'}})
+        assert not marker.exists()
+
+    @patch('nefertari_es.indices.os.kill')
+    def test_bulk_load_mode_concurrent(self, mock_kill, conn, marker_dir):
+        marker = self._write_marker(marker_dir, 123)
+        with pytest.raises(RuntimeError):
+            with indices.bulk_load_mode('foo'):
+                pass
+        assert not conn.indices.put_settings.called
+        assert marker.exists()
+
+    def test_bulk_load_mode_marker_removed(self, conn, marker_dir):
+        conn.indices.get_settings.return_value = {'foo': {'settings': {}}}
+        with indices.bulk_load_mode('foo', wait_for_status=None):
+            marker_dir.join('nefertari_es_bulk_load_foo.json').remove()
+        assert conn.indices.put_settings.call_count == 2
+
+
+class TestPartitions(object):
+
+    def test_partition_name(self):
+        value = datetime.datetime(2016, 3, 7, 15)
+        assert indices.partition_name('ev', value, 'daily') == (
+            'ev-2016.03.07')
+        assert indices.partition_name('ev', value, 'monthly') == 'ev-2016.03'
+        assert indices.partition_name('ev', value, 'yearly') == 'ev-2016'
+        assert indices.partition_name(
+            'ev', '2016-03-31T23:00:00-02:00', 'monthly') == 'ev-2016.04'
+        with pytest.raises(ValueError):
+            indices.partition_name('ev', value, 'hourly')
+
+    def test_partition_names(self):
+        assert indices.partition_names(
+            'ev', datetime.date(2015, 11, 20), '2016-02-01', 'monthly') == [
+            'ev-2015.11', 'ev-2015.12', 'ev-2016.01', 'ev-2016.02']
+        assert indices.partition_names(
+            'ev', '2016-01-30', '2016-02-01T10:00', 'daily') == [
+            'ev-2016.01.30', 'ev-2016.01.31', 'ev-2016.02.01']
+        assert indices.partition_names(
+            'ev', '2000-01-01', '2016-01-01', 'daily') is None
+
+    @patch('nefertari_es.indices.get_index_settings')
+    def test_put_partition_template(self, mock_settings, conn):
+        mock_settings.return_value = {'refresh_interval': '30s'}
+        doc_cls = Mock()
+        doc_cls._doc_type.mapping.to_dict.return_value = {'Event': {}}
+        indices.put_partition_template('ev', [doc_cls])
+        conn.indices.put_template.assert_called_once_with(
+            name='ev-partitions', body={
+                'template': 'ev-*',
+                'settings': {'refresh_interval': '30s'},
+                'mappings': {'Event': {}},
+            })
+
+    def test_drop_partitions(self, conn):
+        conn.indices.get_settings.return_value = {
+            'ev-2016.01': {}, 'ev-2016.02': {}, 'ev-2016.03': {},
+            'ev-old': {}}
+        dropped = indices.drop_partitions(
+            'ev', 'monthly', datetime.datetime(2016, 3, 1))
+        assert dropped == ['ev-2016.01', 'ev-2016.02']
+        conn.indices.get_settings.assert_called_once_with(index='ev-*')
+        conn.indices.delete.assert_called_once_with(
+            index='ev-2016.01,ev-2016.02')
+        conn.indices.get_settings.side_effect = JHTTPNotFound()
+        assert indices.drop_partitions(
+            'ev', 'monthly', datetime.datetime(2016, 3, 1)) == []
+
+
+class TestReindex(object):
+
+    def test_copy_action(self):
+        hit = {'_type': 'Item', '_id': '1', '_source': {'a': 1},
+               'fields': {'_parent': '5'}}
+        assert indices._copy_action(hit, 'foo_v2') == {
+            '_index': 'foo_v2', '_type': 'Item', '_id': '1',
+            '_source': {'a': 1}, '_parent': '5'}
+        hit = {'_type': 'Item', '_id': '1', '_source': {'a': 1},
+               '_routing': 'x'}
+        assert indices._copy_action(hit, 'foo_v2') == {
+            '_index': 'foo_v2', '_type': 'Item', '_id': '1',
+            '_source': {'a': 1}, '_routing': 'x'}
+
+    @patch('nefertari_es.indices.helpers')
+    def test_copy_slice(self, mock_helpers):
+        mock_helpers.scan.return_value = [
+            {'_type': 'Item', '_id': '1', '_source': {}}]
+        mock_helpers.streaming_bulk.return_value = [(True, {})] * 3
+        counter = indices._Counter()
+        indices._copy_slice('conn', 'foo', 'foo_v2', 1, 4, 100, counter)
+        mock_helpers.scan.assert_called_once_with(
+            'conn', query={'slice': {'id': 1, 'max': 4}}, index='foo',
+            size=100, fields=['_source', '_routing', '_parent'])
+        assert counter.value == 3
+
+    @patch('nefertari_es.indices._copy_slice')
+    @patch('nefertari_es.indices.create_versioned_index')
+    def test_reindex(self, mock_create, mock_copy, conn):
+        mock_create.return_value = 'foo_v2'
+        conn.indices.get_alias.return_value = {'foo_v1': {}}
+        mock_copy.side_effect = (
+            lambda *args: args[-1].add(5))
+        progress = Mock()
+        result = indices.reindex(
+            'foo', slices=2, progress=progress, delete_old=True)
+        assert result == 'foo_v2'
+        mock_create.assert_called_once_with(
+            'foo', None, 'default', add_alias=False)
+        assert sorted(c[0][3] for c in mock_copy.call_args_list) == [0, 1]
+        conn.indices.refresh.assert_called_once_with(index='foo_v2')
+        conn.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': 'foo_v1', 'alias': 'foo'}},
+                {'add': {'index': 'foo_v2', 'alias': 'foo'}},
+            ]})
+        conn.indices.delete.assert_called_once_with(index='foo_v1')
+        assert progress.call_args[0][0] == 10
+
+    @patch('nefertari_es.indices._copy_slice')
+    @patch('nefertari_es.indices.create_versioned_index')
+    def test_reindex_error(self, mock_create, mock_copy, conn):
+        conn.indices.get_alias.return_value = {'foo_v1': {}}
+        mock_copy.side_effect = ValueError('fail')
+        with pytest.raises(ValueError):
+            indices.reindex('foo')
+        assert not conn.indices.update_aliases.called
+
+    @patch('nefertari_es.indices._copy_slice')
+    @patch('nefertari_es.indices.create_versioned_index')
+    def test_reindex_not_alias(self, mock_create, mock_copy, conn):
+        conn.indices.get_alias.side_effect = JHTTPNotFound()
+        with pytest.raises(ValueError) as ex:
+            indices.reindex('foo')
+        assert 'foo is not an alias' in str(ex.value)
+        assert not mock_create.called
+        assert not mock_copy.called
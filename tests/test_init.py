@@ -0,0 +1,200 @@
+import pytest
+from mock import patch, Mock
+from nefertari.utils import dictset
+
+import nefertari_es
+from nefertari_es import meta
+
+
+def _doc_mock(**kwargs):
+    attrs = dict(
+        _explicit_index=None, _index_settings=None, _partition_field=None)
+    attrs.update(kwargs)
+    return Mock(**attrs)
+
+
+@patch('nefertari_es.create_index')
+@patch('nefertari_es.get_document_classes')
+class TestSetupIndex(object):
+
+    @pytest.fixture(autouse=True)
+    def mock_update_mappings(self):
+        with patch('nefertari_es.update_mappings') as mock_update:
+            yield mock_update
+
+    def test_eager_exists(self, mock_classes, mock_create):
+        doc_cls = _doc_mock()
+        mock_classes.return_value = {'Item': doc_cls}
+        conn = Mock()
+        conn.indices.exists.return_value = True
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        conn.indices.exists.assert_called_once_with(['foo'])
+        assert not mock_create.called
+        assert doc_cls._doc_type.index == 'foo'
+        assert 'index_exists' in nefertari_es.get_startup_timings()
+
+    @patch('nefertari_es.update_index_settings')
+    def test_eager_exists_settings(
+            self, mock_update, mock_classes, mock_create):
+        doc_cls = _doc_mock(_index_settings={'refresh_interval': '5s'})
+        mock_classes.return_value = {'Item': doc_cls}
+        conn = Mock()
+        conn.indices.exists.return_value = True
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        mock_update.assert_called_once_with('foo', {'refresh_interval': '5s'})
+        assert not mock_create.called
+
+    def test_eager_exists_mappings(
+            self, mock_classes, mock_create, mock_update_mappings):
+        doc_cls = _doc_mock()
+        mock_classes.return_value = {'Item': doc_cls}
+        conn = Mock()
+        conn.indices.exists.return_value = True
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        mock_update_mappings.assert_called_once_with('foo', [doc_cls])
+        conn.indices.exists.return_value = False
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        assert mock_update_mappings.call_count == 1
+
+    @patch('nefertari_es.put_partition_template')
+    def test_eager_partition_templates(
+            self, mock_put, mock_classes, mock_create):
+        event = _doc_mock(_partition_field='created')
+        mock_classes.return_value = {'Event': event, 'Item': _doc_mock()}
+        conn = Mock()
+        conn.indices.exists.return_value = True
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        mock_put.assert_called_once_with('foo', [event])
+
+    @patch('nefertari_es.put_partition_template')
+    def test_eager_partitioned_index_not_created(
+            self, mock_put, mock_classes, mock_create,
+            mock_update_mappings):
+        item = _doc_mock()
+        event = _doc_mock(_explicit_index='ev', _partition_field='created')
+        mock_classes.return_value = {'Event': event, 'Item': item}
+        conn = Mock()
+        conn.indices.exists.return_value = False
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        conn.indices.exists.assert_called_once_with(['foo'])
+        mock_create.assert_called_once_with('foo', [item])
+        mock_put.assert_called_once_with('ev', [event])
+        mock_update_mappings.assert_called_once_with('ev-*', [event])
+        assert event._doc_type.index == 'ev'
+
+    @patch('nefertari_es.put_partition_template')
+    def test_eager_no_partitions(
+            self, mock_put, mock_classes, mock_create,
+            mock_update_mappings):
+        from nefertari.json_httpexceptions import JHTTPNotFound
+        event = _doc_mock(_partition_field='created')
+        mock_classes.return_value = {'Event': event}
+        mock_update_mappings.side_effect = JHTTPNotFound()
+        conn = Mock()
+        conn.indices.exists.return_value = False
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        mock_put.assert_called_once_with('foo', [event])
+        mock_update_mappings.assert_called_once_with('foo-*', [event])
+
+    def test_eager_missing(self, mock_classes, mock_create):
+        doc_cls = _doc_mock()
+        mock_classes.return_value = {'Item': doc_cls}
+        conn = Mock()
+        conn.indices.exists.return_value = False
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        mock_create.assert_called_once_with('foo', [doc_cls])
+
+    def test_eager_explicit_index(self, mock_classes, mock_create):
+        item = _doc_mock()
+        event = _doc_mock(_explicit_index='events')
+        mock_classes.return_value = {'Item': item, 'Event': event}
+        conn = Mock()
+        conn.indices.exists.side_effect = lambda names: names == ['foo']
+        nefertari_es.setup_index(conn, dictset(index_name='foo'))
+        assert conn.indices.exists.call_count == 2
+        mock_create.assert_called_once_with('events', [event])
+        assert item._doc_type.index == 'foo'
+        assert event._doc_type.index == 'events'
+
+    @patch('nefertari_es.create_versioned_index')
+    def test_eager_missing_aliases(
+            self, mock_create_versioned, mock_classes, mock_create):
+        doc_cls = _doc_mock()
+        mock_classes.return_value = {'Item': doc_cls}
+        conn = Mock()
+        conn.indices.exists.return_value = False
+        nefertari_es.setup_index(
+            conn, dictset(index_name='foo', use_aliases='true'))
+        mock_create_versioned.assert_called_once_with('foo', [doc_cls])
+        assert not mock_create.called
+
+    def test_lazy(self, mock_classes, mock_create):
+        doc_cls = _doc_mock()
+        mock_classes.return_value = {'Item': doc_cls}
+        conn = Mock()
+        conn.indices.exists.return_value = False
+        try:
+            nefertari_es.setup_index(
+                conn, dictset(index_name='foo', startup_mode='lazy'))
+            assert doc_cls._doc_type.index == 'foo'
+            assert not conn.indices.exists.called
+            meta.ensure_index()
+            meta.ensure_index()
+        finally:
+            meta.defer_index_setup(None)
+        conn.indices.exists.assert_called_once_with(['foo'])
+        mock_create.assert_called_once_with('foo', [doc_cls])
+
+    @patch('nefertari_es.mapping_fingerprint')
+    def test_cached(self, mock_fp, mock_classes, mock_create,
+                    mock_update_mappings, tmpdir):
+        mock_fp.return_value = 'abc'
+        cache_file = str(tmpdir.join('fp'))
+        settings = dictset(
+            index_name='foo', startup_mode='cached',
+            mapping_cache_file=cache_file)
+        conn = Mock()
+        conn.indices.exists.return_value = True
+        nefertari_es.setup_index(conn, settings)
+        assert conn.indices.exists.call_count == 1
+        with open(cache_file) as f:
+            assert f.read() == 'abc'
+        nefertari_es.setup_index(conn, settings)
+        # Cached fingerprint matches, only index existence is checked
+        assert conn.indices.exists.call_count == 2
+        assert not mock_update_mappings.called
+        mock_fp.return_value = 'def'
+        nefertari_es.setup_index(conn, settings)
+        assert conn.indices.exists.call_count == 3
+        mock_fp.assert_called_with('foo', None)
+
+    @patch('nefertari_es.mapping_fingerprint')
+    def test_cached_index_missing(
+            self, mock_fp, mock_classes, mock_create, tmpdir):
+        mock_fp.return_value = 'abc'
+        cache_file = str(tmpdir.join('fp'))
+        with open(cache_file, 'w') as f:
+            f.write('abc')
+        settings = dictset(
+            index_name='foo', startup_mode='cached',
+            mapping_cache_file=cache_file, hosts='localhost:9200')
+        conn = Mock()
+        conn.indices.exists.return_value = False
+        nefertari_es.setup_index(conn, settings)
+        mock_create.assert_called_once_with('foo', [])
+        mock_fp.assert_called_once_with('foo', 'localhost:9200')
+
+
+class TestMappingFingerprint(object):
+
+    @patch('nefertari_es.get_document_classes')
+    def test_fingerprint(self, mock_classes):
+        doc_cls = Mock()
+        doc_cls._doc_type.mapping.to_dict.return_value = {'a': 1}
+        mock_classes.return_value = {'Item': doc_cls}
+        first = nefertari_es.mapping_fingerprint('foo')
+        assert first == nefertari_es.mapping_fingerprint('foo')
+        assert first != nefertari_es.mapping_fingerprint('bar')
+        assert first != nefertari_es.mapping_fingerprint('foo', 'es2:9200')
+        doc_cls._doc_type.mapping.to_dict.return_value = {'a': 2}
+        assert first != nefertari_es.mapping_fingerprint('foo')
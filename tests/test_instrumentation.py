@@ -0,0 +1,97 @@
+import pytest
+from mock import Mock
+
+from nefertari_es import instrumentation
+
+
+@pytest.fixture
+def sink():
+    sink = Mock()
+    instrumentation.add_sink(sink)
+    yield sink
+    instrumentation.remove_sink(sink)
+
+
+class TestParseUrl(object):
+
+    def test_search(self):
+        assert instrumentation.parse_url('POST', '/foo/Item/_search') == (
+            'POST /{index}/{type}/_search', 'search', 'Item')
+
+    def test_bulk(self):
+        assert instrumentation.parse_url('POST', '/_bulk?refresh=true') == (
+            'POST /_bulk', 'bulk', None)
+
+    def test_update(self):
+        assert instrumentation.parse_url('POST', '/foo/Item/1/_update') == (
+            'POST /{index}/{type}/{id}/_update', 'update', 'Item')
+
+    def test_document(self):
+        assert instrumentation.parse_url('GET', '/foo/Item/1') == (
+            'GET /{index}/{type}/{id}', 'get', 'Item')
+        assert instrumentation.parse_url('PUT', '/foo/Item/1')[1] == 'index'
+        assert instrumentation.parse_url(
+            'DELETE', '/foo/Item/1')[1] == 'delete'
+
+
+class TestRecordRequest(object):
+
+    def test_no_sinks(self):
+        assert not instrumentation.is_enabled()
+        instrumentation.record_request('GET', '/foo/Item/1', None, 200, 0.1)
+
+    def test_record(self, sink):
+        assert instrumentation.is_enabled()
+        instrumentation.record_request(
+            'POST', '/foo/Item/_search', b'{"query": {}}', 200, 0.05,
+            '{"took":12,"timed_out":false}')
+        sink.assert_called_once_with(dict(
+            method='POST', url='/foo/Item/_search',
+            endpoint='POST /{index}/{type}/_search', operation='search',
+            doc_type='Item', status=200, duration=0.05, request_bytes=13,
+            response_bytes=29, took=12, body=b'{"query": {}}'))
+
+    def test_sink_error(self, sink):
+        sink.side_effect = ValueError
+        other = Mock()
+        instrumentation.add_sink(other)
+        try:
+            instrumentation.record_request('GET', '/foo', None, 200, 0.1)
+        finally:
+            instrumentation.remove_sink(other)
+        assert other.called
+
+
+class TestHistogram(object):
+
+    def test_histogram(self):
+        hist = instrumentation.Histogram(buckets=(10, 100, float('inf')))
+        for value in (1, 5, 50, 500):
+            hist.observe(value)
+        data = hist.to_dict()
+        assert data['count'] == 4
+        assert data['max'] == 500
+        assert data['avg'] == 139
+        assert data['p50'] == 10
+        assert data['p99'] == 500
+        assert data['buckets'] == [(10, 2), (100, 1), (float('inf'), 1)]
+
+
+class TestRequestStats(object):
+
+    def test_stats(self):
+        stats = instrumentation.RequestStats()
+        info = dict(
+            operation='search', doc_type='Item', status=200, duration=0.02,
+            request_bytes=10, response_bytes=100, took=5)
+        stats(info)
+        stats(dict(info, status=500, took=None))
+        data = stats.to_dict()[('search', 'Item')]
+        assert data['requests'] == 2
+        assert data['errors'] == 1
+        assert data['request_bytes'] == 20
+        assert data['response_bytes'] == 200
+        assert data['latency']['count'] == 2
+        assert data['took']['count'] == 1
+        stats.reset()
+        assert stats.to_dict() == {}
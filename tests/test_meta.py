@@ -15,6 +15,12 @@ class TestMetaHelpers(object):
         ], any_order=True)
         mock_index().create.assert_called_once_with()
 
+    @patch('nefertari_es.meta.Index')
+    def test_create_index_aliases(self, mock_index):
+        meta.create_index('index1_v1', ['first'], aliases=['index1'])
+        mock_index().aliases.assert_called_once_with(index1={})
+        mock_index().create.assert_called_once_with()
+
     @patch('nefertari_es.meta.get_document_classes')
     @patch('nefertari_es.meta.Index')
     def test_test_create_index_no_classes(self, mock_index, mock_get):
@@ -26,6 +32,84 @@ class TestMetaHelpers(object):
         mock_index().create.assert_called_once_with()
         mock_get.assert_called_once_with()
 
+    @patch('nefertari_es.meta.get_document_classes')
+    @patch('nefertari_es.meta.Index')
+    def test_create_index_no_classes_explicit_index(
+            self, mock_index, mock_get):
+        class Item(object):
+            _explicit_index = None
+            _index_settings = None
+
+        class Event(object):
+            _explicit_index = 'events'
+            _index_settings = {'number_of_shards': 2}
+        mock_get.return_value = {'Item': Item, 'Event': Event}
+        meta.create_index('events')
+        mock_index().doc_type.assert_called_once_with(Event)
+        mock_index().settings.assert_called_once_with(number_of_shards=2)
+
+    @patch('nefertari_es.Settings', {
+        'index.number_of_replicas': '2',
+        'index.refresh_interval': '1s',
+        'index.analysis.filter': '["lowercase"]',
+        'index_name': 'foo'})
+    def test_get_index_settings(self):
+        class Item(object):
+            _index_settings = {'refresh_interval': '30s'}
+        assert meta.get_index_settings([Item]) == {
+            'number_of_replicas': '2',
+            'refresh_interval': '30s',
+            'analysis.filter': ['lowercase'],
+        }
+
+    @patch('nefertari_es.meta.get_document_classes')
+    def test_get_index_groups(self, mock_get):
+        class Item(object):
+            _explicit_index = None
+
+        class Event(object):
+            _explicit_index = 'events'
+        mock_get.return_value = {'Item': Item, 'Event': Event}
+        assert meta.get_index_groups('foo') == {
+            'foo': [Item], 'events': [Event]}
+        assert meta.get_index_groups('foo', {}) == {'foo': []}
+        assert meta.get_index_classes('events', 'foo') == [Event]
+        assert meta.get_index_classes('foo', 'foo') == [Item]
+
+    def test_routing_required_mapping(self):
+        class RoutedItem(documents.BaseDocument):
+            _routing_field = 'tenant'
+            name = fields.StringField(primary_key=True)
+            tenant = fields.StringField()
+
+        try:
+            mapping = RoutedItem._doc_type.mapping.to_dict()
+            assert mapping['RoutedItem']['_routing'] == {'required': True}
+        finally:
+            meta._document_registry.pop('RoutedItem', None)
+
+    def test_index_placement(self):
+        class PlacedItem(documents.BaseDocument):
+            __index__ = 'placed'
+            name = fields.StringField(primary_key=True)
+
+        class MetaPlacedItem(documents.BaseDocument):
+            name = fields.StringField(primary_key=True)
+
+            class Meta:
+                index = 'meta_placed'
+                index_settings = {'number_of_shards': 1}
+
+        try:
+            assert PlacedItem._explicit_index == 'placed'
+            assert PlacedItem._doc_type.index == 'placed'
+            assert MetaPlacedItem._explicit_index == 'meta_placed'
+            assert MetaPlacedItem._index_settings == {'number_of_shards': 1}
+            assert documents.BaseDocument._explicit_index is None
+        finally:
+            meta._document_registry.pop('PlacedItem', None)
+            meta._document_registry.pop('MetaPlacedItem', None)
+
 
 class TestDocumentRegistry(object):
     def test_get_document_cls_key_error(self):
@@ -78,6 +162,25 @@ class TestNonDocumentInheritanceMixin(object):
         assert user.username == 'foo'
         assert user.password == 'bar'
 
+    def test_first_definition_in_mro_wins(self):
+        class Base(object):
+            name = fields.StringField()
+            price = fields.IntegerField()
+
+        class Mixin(Base):
+            name = fields.IntegerField()
+
+            @property
+            def price(self):
+                return 1
+
+        class Product(Mixin, documents.BaseDocument):
+            pass
+
+        mapping = Product._doc_type.mapping
+        assert isinstance(mapping['name'], fields.IntegerField)
+        assert 'price' not in mapping
+
 
 class TestGenerateMetaMixin(object):
 
@@ -110,3 +213,35 @@ class TestBackrefGeneratingDocMeta(object):
 
         story_tags = Story._doc_type.mapping['tags']
         assert story_tags._back_populates == 'stories'
+
+    def test_backref_forward_reference(self):
+        class Chapter(documents.BaseDocument):
+            name = fields.StringField(primary_key=True)
+            book = fields.Relationship(
+                document='ForwardBook', uselist=False,
+                backref_name='chapters', backref_uselist=True)
+
+        assert 'ForwardBook' in meta.get_unresolved_backrefs()
+
+        class ForwardBook(documents.BaseDocument):
+            name = fields.StringField(primary_key=True)
+
+        try:
+            assert 'ForwardBook' not in meta.get_unresolved_backrefs()
+            book_chapters = ForwardBook._doc_type.mapping['chapters']
+            assert book_chapters._back_populates == 'book'
+            assert book_chapters._doc_class is Chapter
+            assert book_chapters._multi
+            assert Chapter._doc_type.mapping['book']._back_populates == (
+                'chapters')
+        finally:
+            meta._document_registry.pop('ForwardBook', None)
+
+    def test_self_reference(self):
+        class Node(documents.BaseDocument):
+            name = fields.StringField(primary_key=True)
+            parent = fields.Relationship(
+                document='Node', uselist=False, backref_name='children')
+
+        assert 'Node' not in meta.get_unresolved_backrefs()
+        assert Node._doc_type.mapping['children']._back_populates == 'parent'
@@ -0,0 +1,84 @@
+import datetime
+import decimal
+
+import pytest
+from elasticsearch.exceptions import SerializationError
+
+from nefertari_es import serializers
+from nefertari_es.serializers import JSONSerializer
+
+
+def _codecs():
+    names = []
+    for codec_cls in serializers.CODECS:
+        try:
+            codec_cls()
+        except ImportError:
+            continue
+        names.append(codec_cls.name)
+    return names
+
+
+class TestGetCodec(object):
+
+    def test_default_is_first_installed(self):
+        codec = serializers.get_codec()
+        assert codec.name == _codecs()[0]
+
+    def test_by_name(self):
+        assert isinstance(
+            serializers.get_codec('json'), serializers.JSONCodec)
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            serializers.get_codec('foo')
+
+
+class TestJSONSerializer(object):
+
+    def test_loads_parsed(self):
+        data = {'foo': 1}
+        assert JSONSerializer().loads(data) is data
+        assert JSONSerializer().loads('{"foo": 1}') == data
+
+    def test_codec_name(self):
+        assert JSONSerializer(codec='json').codec.name == 'json'
+
+    @pytest.mark.parametrize('codec', _codecs())
+    def test_dumps_same_output(self, codec):
+        data = {
+            'dt': datetime.datetime(2015, 6, 1, 12, 30, 15),
+            'date': datetime.date(2015, 6, 1),
+            'time': datetime.time(9, 30),
+            'delta': datetime.timedelta(seconds=90),
+            'price': decimal.Decimal('1.5'),
+            'tags': ['a', 'b'],
+        }
+        serializer = JSONSerializer(codec=codec)
+        assert serializer.loads(serializer.dumps(data)) == {
+            'dt': '2015-06-01T12:30:15Z',
+            'date': '2015-06-01T00:00:00Z',
+            'time': '09:30:00',
+            'delta': 90,
+            'price': 1.5,
+            'tags': ['a', 'b'],
+        }
+
+    @pytest.mark.parametrize('codec', _codecs())
+    def test_dumps_big_int(self, codec):
+        serializer = JSONSerializer(codec=codec)
+        assert serializer.loads(serializer.dumps({'a': 2 ** 70})) == {
+            'a': 2 ** 70}
+
+    def test_dumps_string(self):
+        assert JSONSerializer().dumps('{"a": 1}') == '{"a": 1}'
+
+    @pytest.mark.parametrize('codec', _codecs())
+    def test_dumps_error(self, codec):
+        with pytest.raises(SerializationError):
+            JSONSerializer(codec=codec).dumps({'a': object()})
+
+    @pytest.mark.parametrize('codec', _codecs())
+    def test_loads_error(self, codec):
+        with pytest.raises(SerializationError):
+            JSONSerializer(codec=codec).loads('{foo')
@@ -0,0 +1,82 @@
+from mock import patch, Mock
+from nefertari.utils import dictset
+
+from nefertari_es import slowlog
+
+
+def make_response(took=None, total=3):
+    response = Mock(spec=['hits'], hits=Mock(total=total))
+    if took is not None:
+        response.took = took
+    return response
+
+
+class TestSlowQueryLog(object):
+
+    def test_disabled(self):
+        assert not slowlog.SlowQueryLog().enabled
+        assert slowlog.SlowQueryLog(threshold=1).enabled
+        assert slowlog.SlowQueryLog(took_threshold=100).enabled
+
+    def test_is_slow(self):
+        slow_log = slowlog.SlowQueryLog(threshold=1, took_threshold=100)
+        assert not slow_log.is_slow(0.5, 50)
+        assert not slow_log.is_slow(0.5, None)
+        assert slow_log.is_slow(1.5, 50)
+        assert slow_log.is_slow(0.5, 150)
+
+    @patch('nefertari_es.slowlog._current_view')
+    @patch('nefertari_es.slowlog.log')
+    def test_check_slow(self, mock_log, mock_view):
+        mock_view.return_value = 'GET /api/items'
+        search_obj = Mock()
+        search_obj.to_dict.return_value = {'query': {'match_all': {}}}
+        document_cls = Mock(__name__='Item')
+        slow_log = slowlog.SlowQueryLog(took_threshold=100)
+        slow_log.check(document_cls, search_obj, make_response(took=120), 0.2)
+        msg = mock_log.warning.call_args[0][0]
+        assert msg == (
+            'Slow query on Item: latency 0.200s, took 120ms, 3 hits, '
+            'view GET /api/items: {"query": {"match_all": {}}}')
+
+    @patch('nefertari_es.slowlog.log')
+    def test_check_fast(self, mock_log):
+        search_obj = Mock()
+        slow_log = slowlog.SlowQueryLog(threshold=1)
+        slow_log.check(Mock(), search_obj, make_response(), 0.2)
+        assert not search_obj.to_dict.called
+        assert not mock_log.warning.called
+
+    @patch('nefertari_es.slowlog.random')
+    @patch('nefertari_es.slowlog.log')
+    def test_check_sampling(self, mock_log, mock_random):
+        mock_random.random.return_value = 0.7
+        search_obj = Mock()
+        slow_log = slowlog.SlowQueryLog(threshold=1, sample_rate=0.5)
+        slow_log.check(Mock(), search_obj, make_response(), 2)
+        assert not mock_log.warning.called
+        mock_random.random.return_value = 0.3
+        search_obj.to_dict.return_value = {}
+        slow_log.check(Mock(__name__='Item'), search_obj, make_response(), 2)
+        assert mock_log.warning.called
+
+    def test_current_view_no_request(self):
+        assert slowlog._current_view() is None
+
+    @patch('pyramid.threadlocal.get_current_request')
+    def test_current_view(self, mock_request):
+        mock_request.return_value = Mock(
+            method='GET', path_qs='/api/items?a=1')
+        mock_request.return_value.matched_route.name = 'items'
+        assert slowlog._current_view() == 'GET /api/items?a=1 (route items)'
+
+    def test_get_slow_query_log(self):
+        with patch('nefertari_es.Settings', dictset({
+                'slow_query_threshold': '0.5',
+                'slow_query_sample_rate': '0.1'})):
+            with patch.object(slowlog, '_slow_query_log', None):
+                slow_log = slowlog.get_slow_query_log()
+                assert slow_log.threshold == 0.5
+                assert slow_log.took_threshold is None
+                assert slow_log.sample_rate == 0.1
+                assert slowlog.get_slow_query_log() is slow_log
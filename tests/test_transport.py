@@ -0,0 +1,217 @@
+import threading
+
+import pytest
+from elasticsearch.exceptions import ConnectionError
+from mock import patch, Mock
+from nefertari.json_httpexceptions import (
+    JHTTPBadRequest, JHTTPServiceUnavailable)
+
+from nefertari_es.connections import CircuitBreaker, ESHttpConnection
+from nefertari_es.transport import (
+    ESTransport, HedgingTransport, LatencyAwareSelector)
+
+
+def make_connection(latency=None, breaker=None):
+    return Mock(latency_ewma=latency, breaker=breaker)
+
+
+class TestLatencyAwareSelector(object):
+
+    def test_single(self):
+        conn = make_connection()
+        assert LatencyAwareSelector({}).select([conn]) is conn
+
+    @patch('nefertari_es.transport.random')
+    def test_weights(self, mock_random):
+        fast, slow = make_connection(0.01), make_connection(0.09)
+        selector = LatencyAwareSelector({})
+        mock_random.uniform.side_effect = lambda a, b: b * 0.85
+        assert selector.select([fast, slow]) is fast
+        assert mock_random.uniform.call_args[0][1] == pytest.approx(
+            100 + 100 / 9.0)
+        mock_random.uniform.side_effect = lambda a, b: b * 0.95
+        assert selector.select([fast, slow]) is slow
+
+    @patch('nefertari_es.transport.random')
+    def test_unknown_latency(self, mock_random):
+        new, known = make_connection(), make_connection(0.5)
+        mock_random.uniform.side_effect = lambda a, b: b * 0.4
+        assert LatencyAwareSelector({}).select([new, known]) is new
+        assert mock_random.uniform.call_args[0][1] == 4
+
+    def test_skips_open_breakers(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record_failure()
+        broken, healthy = make_connection(0.001, breaker), make_connection(1)
+        selector = LatencyAwareSelector({})
+        for _ in range(10):
+            assert selector.select([broken, healthy]) is healthy
+        assert selector.select([broken, broken]) is broken
+
+
+class TestESTransport(object):
+
+    def test_all_breakers_open(self):
+        transport = ESTransport(
+            [{'host': 'open1'}, {'host': 'open2'}],
+            connection_class=ESHttpConnection, breaker_failure_threshold=1)
+        for connection in transport.connection_pool.connections:
+            connection.breaker.record_failure()
+            connection.pool = Mock()
+        with pytest.raises(JHTTPServiceUnavailable) as ex:
+            transport.perform_request('GET', '/foo/Item/1')
+        assert 'Circuit breaker of' in str(ex.value.explanation)
+        for connection in transport.connection_pool.connections:
+            assert not connection.pool.urlopen.called
+
+
+class TestHedgingTransport(object):
+
+    def make_transport(self, *connections, **kwargs):
+        transport = HedgingTransport(
+            [{'host': 'a'}, {'host': 'b'}], **kwargs)
+        transport.connection_pool.connections = list(connections)
+        transport.connection_pool.selector = Mock(
+            select=lambda conns: conns[0])
+        transport.get_connection = Mock(return_value=connections[0])
+        return transport
+
+    def test_record_latency(self):
+        transport = self.make_transport(
+            Mock(), Mock(), hedge_min_samples=10, hedge_min_delay=0)
+        for latency in range(9):
+            transport._record_latency(latency)
+        assert transport._hedge_delay is None
+        transport._record_latency(9)
+        assert transport._hedge_delay == 9
+        transport = self.make_transport(
+            Mock(), Mock(), hedge_min_samples=10, hedge_min_delay=20)
+        for latency in range(10):
+            transport._record_latency(latency)
+        assert transport._hedge_delay == 20
+
+    def test_no_hedging_without_samples(self):
+        primary = Mock()
+        primary.perform_request.return_value = (200, {}, '{"a": 1}')
+        transport = self.make_transport(primary, Mock())
+        assert transport.perform_request('GET', '/foo/_search') == (
+            200, {'a': 1})
+        assert len(transport._latencies) == 1
+        assert transport.hedge_stats['requests'] == 0
+
+    def test_no_hedging_for_writes(self):
+        primary, other = Mock(), Mock()
+        primary.perform_request.return_value = (200, {}, '{}')
+        transport = self.make_transport(primary, other)
+        transport._hedge_delay = 0
+        transport.perform_request('PUT', '/foo/Item/1', body={'a': 1})
+        assert not other.perform_request.called
+        assert transport.hedge_stats['requests'] == 0
+
+    def test_fast_primary(self):
+        primary, other = Mock(), Mock()
+        primary.perform_request.return_value = (200, {}, '{"a": 1}')
+        transport = self.make_transport(primary, other)
+        transport._hedge_delay = 5
+        result = transport.perform_request(
+            'GET', '/foo/_search', params={'ignore': 404},
+            body={'query': {}})
+        assert result == (200, {'a': 1})
+        primary.perform_request.assert_called_once_with(
+            'GET', '/foo/_search', {}, b'{"query": {}}',
+            ignore=(404,), timeout=None)
+        assert not other.perform_request.called
+        assert transport.hedge_stats == dict(
+            requests=1, hedged=0, hedge_wins=0)
+
+    def test_hedge_wins(self):
+        release = threading.Event()
+        primary, other = Mock(), Mock()
+
+        def slow_request(*args, **kwargs):
+            release.wait(5)
+            return 200, {}, '{"primary": 1}'
+        primary.perform_request.side_effect = slow_request
+        other.perform_request.return_value = (200, {}, '{"hedge": 1}')
+        transport = self.make_transport(primary, other)
+        transport._hedge_delay = 0.01
+        try:
+            result = transport.perform_request('GET', '/foo/_search')
+        finally:
+            release.set()
+        assert result == (200, {'hedge': 1})
+        assert transport.hedge_stats == dict(
+            requests=1, hedged=1, hedge_wins=1)
+
+    def test_both_fail(self):
+        primary, other = Mock(), Mock()
+        primary.perform_request.side_effect = JHTTPBadRequest('primary')
+        other.perform_request.side_effect = JHTTPBadRequest('other')
+        transport = self.make_transport(primary, other)
+        transport._hedge_delay = 0.01
+        with pytest.raises(JHTTPBadRequest):
+            transport.perform_request('GET', '/foo/_search')
+
+    def test_other_errors_not_hedged(self):
+        primary, other = Mock(), Mock()
+        primary.perform_request.side_effect = JHTTPBadRequest('primary')
+        transport = self.make_transport(primary, other)
+        transport._hedge_delay = 5
+        with pytest.raises(JHTTPBadRequest):
+            transport.perform_request('GET', '/foo/_search')
+        assert not other.perform_request.called
+        assert primary in transport.connection_pool.connections
+
+    def test_primary_failure_hedged_immediately(self):
+        primary, other = Mock(), Mock()
+        primary.perform_request.side_effect = ConnectionError(
+            'N/A', 'down', None)
+        other.perform_request.return_value = (200, {}, '{"hedge": 1}')
+        transport = self.make_transport(primary, other)
+        transport._hedge_delay = 5
+        transport.connection_pool.mark_live = Mock()
+        result = transport.perform_request('GET', '/foo/_search')
+        assert result == (200, {'hedge': 1})
+        assert transport.connection_pool.connections == [other]
+        transport.connection_pool.mark_live.assert_called_once_with(other)
+        assert transport.hedge_stats == dict(
+            requests=1, hedged=1, hedge_wins=1)
+
+    def test_both_fail_falls_back(self):
+        primary, other, third = Mock(), Mock(), Mock()
+        primary.perform_request.side_effect = ConnectionError(
+            'N/A', 'down', None)
+        other.perform_request.side_effect = ConnectionError(
+            'N/A', 'down', None)
+        third.perform_request.return_value = (200, {}, '{"third": 1}')
+        transport = self.make_transport(primary, other, third)
+        transport._hedge_delay = 5
+        transport.get_connection.side_effect = [primary, third]
+        result = transport.perform_request(
+            'GET', '/foo/_search', params={'ignore': 404},
+            body={'query': {}})
+        assert result == (200, {'third': 1})
+        third.perform_request.assert_called_once_with(
+            'GET', '/foo/_search', {}, b'{"query": {}}',
+            ignore=(404,), timeout=None)
+        assert transport.connection_pool.connections == [third]
+
+    def test_workers_reused(self):
+        primary = Mock()
+        primary.perform_request.return_value = (200, {}, '{}')
+        transport = self.make_transport(primary, Mock())
+        transport._hedge_delay = 5
+        for _ in range(3):
+            transport.perform_request('GET', '/foo/_search')
+        assert transport._workers == 1
+
+    def test_no_free_workers(self):
+        primary, other = Mock(), Mock()
+        primary.perform_request.return_value = (200, {}, '{"a": 1}')
+        transport = self.make_transport(
+            primary, other, hedge_max_workers=0)
+        transport._hedge_delay = 0
+        result = transport.perform_request('GET', '/foo/_search')
+        assert result == (200, {'a': 1})
+        assert not other.perform_request.called
+        assert transport.hedge_stats['requests'] == 0